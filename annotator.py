@@ -6,55 +6,156 @@
 # @Desc    : convert dataset annotations
 
 import argparse
+import contextlib
+import multiprocessing
 import os
-import json
+import time
 from tqdm import tqdm
 
+from datasets.writer import coco_header, open_annotation_writer
+try:
+    from lxml import etree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
 def args_parser():
     parser = argparse.ArgumentParser(description='convert dataset annotations')
     parser.add_argument('--dest', default='vidor', help='source dataset')
     parser.add_argument('--src', default='coco', help='destination dataset')
     parser.add_argument('--input', help='root path of dataset')
     parser.add_argument('--output', help='directory to store converted annotations')
+    parser.add_argument('--workers', type=int, default=1, help='number of parsing processes (ilsvrc)')
+    parser.add_argument('--splits', default='train,val', help='splits to convert, comma separated (coco)')
+    parser.add_argument('--format', dest='anno_format', default='coco', help='(coco, columnar) annotation format')
 
     args = parser.parse_args()
     assert args.src in ['coco', 'ilsvrc']
     assert args.dest in ['vidvrd', 'vidor']
     assert args.input is not None
+    assert args.workers >= 1
+    args.splits = args.splits.split(',')
+    assert set(args.splits) <= {'train', 'val'}
+    assert args.anno_format in ['coco', 'columnar']
     args.output = args.input if args.output is None else args.output
 
     return args
 
-def dump_coco_file(src, categories, annotations, images, filename):
-    """dump coco annotation file
+@contextlib.contextmanager
+def timer(name, timings):
+    """time the block and store the seconds as timings[name]"""
+    start = time.perf_counter()
+    yield
+    timings[name] = time.perf_counter() - start
+
+def print_timings(timings):
+    for name, seconds in timings.items():
+        print('>>> {:24}: {:8.2f}s'.format(name, seconds))
+
+def get_ilsvrc_image_id(filename, mode, class_id):
+    """get image if for ILSVRC dataset image
+    filename: n00007846_21106, ILSVRC2014_train_00010002
+    mode: [2013, 2014]
+    class_id: 021
+    """
+    temp_id = filename.split('_')[-1][-5:]
+    return int('{}{}{}'.format(
+        mode,
+        str(class_id).zfill(3),
+        temp_id))
+
+def parse_ilsvrc_xml(anno_filename):
+    """read filename, folder, size and object/{name, bndbox} of an ILSVRC annotation in a
+    single iterparse pass, without building the full element tree
+
+    Args:
+        anno_filename (str): ~/ILSVRC2015/Annotations/DET/train/ILSVRC2013_train/n02419796/n02419796_3142.xml
+
+    Returns:
+        tuple: (filename, folder, height, width, objects), objects are (name, xmin, ymin, xmax, ymax)
+            tuples, None if the annotation has no object
+    """
+    fields = dict()
+    objects = list()
+    depth = 0
+    for event, elem in ET.iterparse(anno_filename, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 1 and elem.tag in ('filename', 'folder'):
+            fields[elem.tag] = elem.text
+        elif depth == 2 and elem.tag in ('height', 'width'):     # annotation/size/height
+            fields[elem.tag] = elem.text
+        elif depth == 1 and elem.tag == 'object':
+            bndbox = elem.find('bndbox')
+            objects.append((
+                elem.find('name').text,
+                int(bndbox.find('xmin').text),
+                int(bndbox.find('ymin').text),
+                int(bndbox.find('xmax').text),
+                int(bndbox.find('ymax').text)
+            ))
+            elem.clear()
+    if len(objects) == 0:
+        return None
+    return fields['filename'], fields['folder'], int(fields['height']), int(fields['width']), objects
+
+def convert_ilsvrc_split(anno_filenames, class_ids, year, ilsvrc_map, index_instance, pool, writer):
+    """convert the ILSVRC annotations of one year
+
+    The xml files are parsed in order by the pool, while images and instance ids are
+    assigned here, so the result is the same for any number of workers. Images and
+    annotations are streamed to the writer as they are converted.
 
     Args:
-        src (str): src video dataset type
-        categories (list): categories
-        annotations (list): annotations
-        images (list): images
-        filename (str): annotation filename
+        anno_filenames (list): xml filenames, in conversion order
+        class_ids (list): class id used in the image id of each file (999 for ILSVRC2014)
+        year (int): [2013, 2014]
+        ilsvrc_map (dict): ILSVRC wnid -> category id
+        index_instance (int): instance ids start after this one
+        pool (multiprocessing.Pool): None to parse in this process
+        writer (CocoWriter, ColumnarWriter): annotation file writer
     """
-    from datasets.vocab import coco_liscenses, coco_info
-    coco_annotation = {
-        'info': coco_info[src],
-        'type': 'instances',
-        'liscenses': coco_liscenses,
-        'categories': categories,
-        'images': images,
-        'annotations': annotations,
-    }
-    with open(filename, 'w') as f:
-        json.dump(coco_annotation, f)
-        print('>>> Successfully export annotations to {}'.format(filename))
+    if pool is not None:
+        parsed = pool.imap(parse_ilsvrc_xml, anno_filenames, chunksize=64)
+    else:
+        parsed = map(parse_ilsvrc_xml, anno_filenames)
+    for class_id, result in tqdm(zip(class_ids, parsed), total=len(anno_filenames)):
+        if result is None: continue
+        filename, folder, height, width, objects = result
+
+        # image info
+        image_id = get_ilsvrc_image_id(filename, year, class_id)
+        image_info = {
+            "file_name": '{}/{}.JPEG'.format(folder, filename),
+            "height": height,
+            "width": width,
+            "id": image_id
+        }
+        writer.add_image(image_info)
 
-def convert_from_ilsvrc(mode, input, output):
+        # instance annotation
+        for class_name, xmin, ymin, xmax, ymax in objects:
+            if class_name not in ilsvrc_map: continue       # 会有一些特殊情况，n00007846会随机出现
+            index_instance += 1
+            annotation_instance = {
+                "category_id": ilsvrc_map[class_name],
+                "area": (xmax - xmin) * (ymax - ymin),
+                "bbox": [xmin, ymin, xmax - xmin, ymax - ymin],
+                "bbox_mode": 1,
+                "image_id": image_id,
+                "id": index_instance,
+                "iscrowd": 0
+            }
+            writer.add_annotation(annotation_instance)
+
+def convert_from_ilsvrc(mode, input, output, workers=1, anno_format='coco'):
     """convert annos from image net according to given categories
     .input path
     ├── Annotations
-    │   └── DET
+    │   └── DET
     ├── Data
-    │   └── DET
+    │   └── DET
     └── ImageSets
         └── DET
 
@@ -62,23 +163,11 @@ def convert_from_ilsvrc(mode, input, output):
         mode (str): dest dataset type [vidvrd, vidor]
         input (str): ILSVRC dataset location
         output (str): path to store annotation file
-        categories (list): corresponding categories
+        workers (int): number of xml parsing processes
+        anno_format (str): (coco, columnar)
     """
 #   BEFORE RUN
-    def get_image_id(filename, mode, class_id):
-        """get image if for ILSVRC dataset image
-        filename: n00007846_21106, ILSVRC2014_train_00010002
-        mode: [2013, 2014]
-        class_id: 021
-        """
-        temp_id = filename.split('_')[-1][-5:]
-        return int('{}{}{}'.format(
-            mode,
-            str(class_id).zfill(3),
-            temp_id))
-
     from datasets.vocab import all_categories, all_ilsvrc_map
-    import xml.etree.ElementTree as ET
 
     categories = all_categories[mode]
     ilsvrc_map = all_ilsvrc_map[mode]
@@ -86,132 +175,63 @@ def convert_from_ilsvrc(mode, input, output):
 
     annos_path = os.path.join(input, 'Annotations/DET/train') # ILSVRC2013_train, ILSVRC2014_train_0000
 
-#   RUNNING
-#   convert ILSVRC2013_train
-    new_annos_train2013 = list()
-    new_images_train2013 = list()
+    # ILSVRC2013_train, per class folder
+    anno_filenames_train2013 = list()
+    class_ids_train2013 = list()
     dirty_data_train2013 = ['n02419796_3142.xml', 'n03467517_13624.xml']
-    index_instance_train2013 = 20130000000
-    for iter_class in tqdm(filtered_classes):
+    for iter_class in filtered_classes:
         annos_path_iter_class = os.path.join(annos_path, 'ILSVRC2013_train', iter_class)
-        anno_files = os.listdir(annos_path_iter_class)
-        for anno_file in anno_files:
+        for anno_file in os.listdir(annos_path_iter_class):
             # filte dirty data
             if anno_file in dirty_data_train2013: continue
-
-            anno_filename = os.path.join(annos_path_iter_class, anno_file)
-            # parse and convert
-            anno_xml = ET.parse(anno_filename)
-            objects = anno_xml.findall('object')
-
-            if len(objects) == 0: continue
-
-            # image info 
-            filename = anno_xml.find('filename').text
-            folder = anno_xml.find('folder').text
-            height = anno_xml.find('size').find('height').text
-            width = anno_xml.find('size').find('width').text
-            image_id = get_image_id(filename, 2013, ilsvrc_map[iter_class])
-            image_info = {
-                "file_name": '{}/{}.JPEG'.format(folder, filename),
-                "height": int(height),
-                "width": int(width),
-                "id": image_id
-            }
-            new_images_train2013.append(image_info)
-
-            # instance annotation
-            annotations_image = []  # image = instance1 + instance2 + ...
-            for obj in objects:          
-                class_name = obj.find('name').text    # n00007846
-                if class_name not in ilsvrc_map: continue       # 会有一些特殊情况，n00007846会随机出现
-                index_instance_train2013 += 1
-                category_id = ilsvrc_map[class_name] 
-                xmin = obj.find('bndbox').find('xmin').text
-                ymin = obj.find('bndbox').find('ymin').text
-                xmax = obj.find('bndbox').find('xmax').text
-                ymax = obj.find('bndbox').find('ymax').text
-                annotation_instance = {
-                    "category_id": category_id,
-                    "area": (int(xmax) - int(xmin)) * (int(ymax) - int(ymin)),
-                    "bbox": [int(xmin), int(ymin), int(xmax) - int(xmin), int(ymax) - int(ymin)],
-                    "bbox_mode": 1,
-                    "image_id": image_id,
-                    "id": index_instance_train2013,
-                    "iscrowd": 0
-                }
-                annotations_image.append(annotation_instance)
-            new_annos_train2013.extend(annotations_image)
-#   convert ILSVRC2014_train
-    new_annos_train2014 = []
-    new_images_train2014 = []
-    index_instance_train2014 = 20140000000
+            anno_filenames_train2013.append(os.path.join(annos_path_iter_class, anno_file))
+            class_ids_train2013.append(ilsvrc_map[iter_class])
+    # ILSVRC2014_train_0000 ~ ILSVRC2014_train_0006
+    anno_filenames_train2014 = list()
     ILSVRC2014_folders = ['ILSVRC2014_train_000' + str(i) for i in range(7)]
     for ILSVRC2014_folder in ILSVRC2014_folders:
         annos_fold = os.path.join(annos_path, ILSVRC2014_folder)
-        anno_files = os.listdir(annos_fold)
-        for anno_file in tqdm(anno_files):
-            anno_filename = os.path.join(annos_fold, anno_file)
-            # parse and convert
-            anno_xml = ET.parse(anno_filename)
-            objects = anno_xml.findall('object')
+        for anno_file in os.listdir(annos_fold):
+            anno_filenames_train2014.append(os.path.join(annos_fold, anno_file))
+    class_ids_train2014 = [999] * len(anno_filenames_train2014)
 
-            if len(objects) == 0:   continue
-            
-            # image info 
-            filename = anno_xml.find('filename').text
-            folder = anno_xml.find('folder').text
-            height = anno_xml.find('size').find('height').text
-            width = anno_xml.find('size').find('width').text
-            image_id = get_image_id(filename, 2014, 999)
-            image_info = {
-                "file_name": '{}/{}.JPEG'.format(folder, filename),
-                "height": int(height),
-                "width":int(width),
-                "id": image_id
-            }
-            new_images_train2014.append(image_info)
+#   RUNNING
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    header = coco_header('ilsvrc-det', categories)
+    with open_annotation_writer(os.path.join(input, 'train_2013_{}.json'.format(mode)), header, anno_format) as writer:
+        convert_ilsvrc_split(anno_filenames_train2013, class_ids_train2013, 2013,
+                             ilsvrc_map, 20130000000, pool, writer)
+    with open_annotation_writer(os.path.join(input, 'train_2014_{}.json'.format(mode)), header, anno_format) as writer:
+        convert_ilsvrc_split(anno_filenames_train2014, class_ids_train2014, 2014,
+                             ilsvrc_map, 20140000000, pool, writer)
+    if pool is not None:
+        pool.close()
+        pool.join()
 
-            # instance annotation
-            annotations_image = []  # image = instance1 + instance2 + ...
-            for obj in objects:
-                class_name = obj.find('name').text
-                if class_name not in ilsvrc_map: continue
-                index_instance_train2014 += 1
-                category_id = ilsvrc_map[class_name] 
-                xmin = obj.find('bndbox').find('xmin').text
-                ymin = obj.find('bndbox').find('ymin').text
-                xmax = obj.find('bndbox').find('xmax').text
-                ymax = obj.find('bndbox').find('ymax').text
-                annotation_instance = {
-                    "category_id": category_id,
-                    "area": (int(xmax) - int(xmin)) * (int(ymax) - int(ymin)),
-                    "bbox": [int(xmin), int(ymin), int(xmax) - int(xmin), int(ymax) - int(ymin)],
-                    "bbox_mode": 1,
-                    "image_id": image_id,
-                    "id": index_instance_train2014,
-                    "iscrowd": 0
-                }
-                annotations_image.append(annotation_instance)
-            new_annos_train2014.extend(annotations_image)
-    
-#   AFTER RUN
-    dump_coco_file(
-        'ilsvrc-det',
-        categories,
-        new_annos_train2013,
-        new_images_train2013,
-        os.path.join(input, 'train_2013_{}.json'.format(mode))
-    )
-    dump_coco_file(
-        'ilsvrc-det',
-        categories,
-        new_annos_train2014,
-        new_images_train2014,
-        os.path.join(input, 'train_2014_{}.json'.format(mode))
-    )
+def convert_coco_annotations(annos, category_map, writer):
+    """convert coco instance annotations, dropping those of unmapped categories
 
-def convert_from_coco(mode, input, output):
+    Args:
+        annos (list): coco instance annotations
+        category_map (dict): coco category id -> dest category id
+        writer (CocoWriter, ColumnarWriter): converted annotations are streamed to it
+    """
+    for anno in tqdm(annos):
+        category_id = category_map.get(anno['category_id'])
+        if category_id is None:
+            continue
+        new_anno_instance = {
+            "category_id": category_id,
+            "area": anno['area'],
+            "bbox": anno['bbox'],
+            "bbox_mode": 1,
+            "image_id": anno['image_id'],
+            "id": anno['id'],
+            "iscrowd": 0
+        }
+        writer.add_annotation(new_anno_instance)
+
+def convert_from_coco(mode, input, output, splits=('train', 'val'), anno_format='coco'):
     """convert annos from coco according to given categories
     .input path
     ├── annotations (train2014, val2014, minival2014)
@@ -222,94 +242,57 @@ def convert_from_coco(mode, input, output):
         mode (str) : dest dataset type [vidvrd, vidor]
         input (str): coco dataset path
         output (str): path to save annotation file
-        categories (dict): corresponding categories
+        splits (list): splits to convert, train (train2014) and/or val (val2014 - minival2014)
+        anno_format (str): (coco, columnar)
     """
 #   BEFRORE RUN
     from pycocotools.coco import COCO
     from datasets.vocab import all_categories, all_coco_map
 
+    timings = dict()
     categories = all_categories[mode]
     annos_path = os.path.join(input, 'annotations')
     minival2014_filename = os.path.join(annos_path, 'instances_minival2014.json')
     train2014_filename = os.path.join(annos_path, 'instances_train2014.json')
     val2014_filename = os.path.join(annos_path, 'instances_val2014.json')    
-    # load coco annotations
-    minival2014 = COCO(minival2014_filename)
-    train2014 = COCO(train2014_filename)
-    val2014 = COCO(val2014_filename)  
-    coco_categories = train2014.loadCats(train2014.getCatIds())
-    id2coco_categories = {item['id']: item['name'] for item in coco_categories}
+    # load coco annotations, only those of the requested splits
+    with timer('load', timings):
+        train2014 = COCO(train2014_filename) if 'train' in splits else None
+        val2014 = COCO(val2014_filename) if 'val' in splits else None
+        minival2014 = COCO(minival2014_filename) if 'val' in splits else None
+    coco = train2014 if train2014 is not None else val2014
+    coco_categories = coco.loadCats(coco.getCatIds())
     # vidor/vidvrd vocab
     categories2id = all_coco_map[mode]
-
-    filtered_classes = [item for item in categories2id]     # for video object classes
+    # coco category id -> vidor/vidvrd category id, for video object classes only
+    category_map = {item['id']: categories2id[item['name']]
+                    for item in coco_categories if item['name'] in categories2id}
 
 #   RUNNING
+    header = coco_header('coco', categories)
 #   convert coco train2014 annotation
-    new_annos_train2014 = []
-    image_ids_train2014 = train2014.getImgIds()     # image ids
-    images_train2014 = train2014.loadImgs(image_ids_train2014)  # image info
-    anno_ids_train2014 = train2014.getAnnIds(image_ids_train2014)  # instance anno ids
-    annos_train2014 = train2014.loadAnns(anno_ids_train2014)      # instance annos
-    
-    for anno in tqdm(annos_train2014):
-        coco_category = id2coco_categories[anno['category_id']]
-        if coco_category not in filtered_classes:
-            continue
-        new_anno_instance = {
-            "category_id": categories2id[coco_category],
-            "area": anno['area'],
-            "bbox": anno['bbox'],
-            "bbox_mode": 1,
-            "image_id": anno['image_id'],
-            "id": anno['id'],
-            "iscrowd": 0
-        }
-        new_annos_train2014.append(new_anno_instance)
+    if train2014 is not None:
+        with timer('convert train2014', timings), \
+                open_annotation_writer(os.path.join(input, 'train_{}.json'.format(mode)), header, anno_format) as writer:
+            image_ids_train2014 = train2014.getImgIds()     # image ids
+            writer.add_images(train2014.loadImgs(image_ids_train2014))  # image info
+            anno_ids_train2014 = train2014.getAnnIds(image_ids_train2014)  # instance anno ids
+            annos_train2014 = train2014.loadAnns(anno_ids_train2014)      # instance annos
+            convert_coco_annotations(annos_train2014, category_map, writer)
 
 #   convert coco val2014 - minival2014 annotation
-    image_ids_val2014 = val2014.getImgIds()     # val2014 image ids
-    image_ids_val_minus_minival2014 = image_ids_val2014.copy()
-    image_ids_minival2014 = minival2014.getImgIds()  # minival2014 image ids
-
-    for item in image_ids_minival2014:
-        image_ids_val_minus_minival2014.remove(item)    # val_minus_minival
-    
-    images_val_minus_minival2014 = val2014.loadImgs(image_ids_val_minus_minival2014)
-    anno_ids_val_minus_minival2014 = val2014.getAnnIds(image_ids_val_minus_minival2014)
-    annos_val_minus_minival2014 = val2014.loadAnns(anno_ids_val_minus_minival2014)
-
-    new_annos_val_minus_minival2014 = []
-    for anno in tqdm(annos_val_minus_minival2014):
-        coco_category = id2coco_categories[anno['category_id']]
-        if coco_category not in filtered_classes:
-            continue
-        new_anno_instance = {
-            "category_id": categories2id[coco_category],
-            "area": anno['area'],
-            "bbox": anno['bbox'],
-            "bbox_mode": 1,
-            "image_id": anno['image_id'],
-            "id": anno['id'],
-            "iscrowd": 0
-        }
-        new_annos_val_minus_minival2014.append(new_anno_instance)
-    
-#   AFTER RUN
-    dump_coco_file(
-        'coco',
-        categories,
-        new_annos_train2014,
-        images_train2014,
-        os.path.join(input, 'train_{}.json'.format(mode))
-    )
-    dump_coco_file(
-        'coco',
-        categories,
-        new_annos_val_minus_minival2014,
-        images_val_minus_minival2014,
-        os.path.join(input, 'val_minus_minival_{}.json'.format(mode))
-    )
+    if val2014 is not None:
+        with timer('convert val-minival2014', timings), \
+                open_annotation_writer(os.path.join(input, 'val_minus_minival_{}.json'.format(mode)), header,
+                                       anno_format) as writer:
+            image_ids_minival2014 = set(minival2014.getImgIds())  # minival2014 image ids
+            image_ids_val_minus_minival2014 = [image_id for image_id in val2014.getImgIds()
+                                               if image_id not in image_ids_minival2014]
+            writer.add_images(val2014.loadImgs(image_ids_val_minus_minival2014))
+            anno_ids_val_minus_minival2014 = val2014.getAnnIds(image_ids_val_minus_minival2014)
+            annos_val_minus_minival2014 = val2014.loadAnns(anno_ids_val_minus_minival2014)
+            convert_coco_annotations(annos_val_minus_minival2014, category_map, writer)
+    print_timings(timings)
 
 if __name__ == "__main__":
     args = args_parser()
@@ -317,8 +300,8 @@ if __name__ == "__main__":
         print('>>> {:10}: {}'.format(key, value))
 
     if args.src == 'coco':
-        convert_from_coco(args.dest, args.input, args.output)
+        convert_from_coco(args.dest, args.input, args.output, args.splits, args.anno_format)
     elif args.src == 'ilsvrc':
-        convert_from_ilsvrc(args.dest, args.input, args.output)
+        convert_from_ilsvrc(args.dest, args.input, args.output, args.workers, args.anno_format)
     else:
         print('Coming soom...')
\ No newline at end of file
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2021-01-31
+# @Author  : Yifer Huang
+# @File    : eval_bbox.py
+# @Desc    : pycocotools COCOeval vs engine/cocoeval.py on a synthetic split
+
+# python -m benchmark.eval_bbox --images 20000 --dets-per-image 300 --workers 8
+
+import argparse
+import contextlib
+import io
+import multiprocessing
+import resource
+import sys
+import time
+
+import numpy as np
+
+
+def args_parser():
+    parser = argparse.ArgumentParser(description='pycocotools COCOeval vs engine/cocoeval.py (bbox)')
+    parser.add_argument('--images', type=int, default=5000, help='images of the synthetic split')
+    parser.add_argument('--gts-per-image', dest='gts_per_image', type=int, default=8, help='mean ground truth per image')
+    parser.add_argument('--dets-per-image', dest='dets_per_image', type=int, default=300, help='detections per image')
+    parser.add_argument('--categories', type=int, default=80)
+    parser.add_argument('--workers', type=int, default=4, help='processes of engine/cocoeval.py')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--skip-pycocotools', dest='skip_pycocotools', action='store_true')
+    parser.add_argument('--atol', type=float, default=1e-6,
+                        help='max |difference| of the stats and precision to pycocotools, exit 1 beyond it')
+    return parser.parse_args()
+
+
+def synthetic_split(images, gts_per_image, dets_per_image, categories, seed=0):
+    """coco annotation and results resembling vidor frames: a few objects per frame,
+    detections are jittered ground truth plus background boxes, some crowd ground truth
+
+    Returns:
+        tuple: (coco annotation dict, coco results list)
+    """
+    rng = np.random.default_rng(seed)
+    width, height = 640, 480
+    num_gts = rng.poisson(gts_per_image, images)
+    gt_image = np.repeat(np.arange(1, images + 1), num_gts)
+    n = len(gt_image)
+    wh = np.exp(rng.uniform(np.log(8), np.log(400), (n, 2)))
+    xy = rng.uniform(0, 1, (n, 2)) * np.maximum([width, height] - wh, 1)
+    gt_boxes = np.round(np.concatenate([xy, wh], axis=1), 2)
+    gt_category = rng.integers(1, categories + 1, n)
+    annotations = [{
+        'id': i + 1, 'image_id': int(gt_image[i]), 'category_id': int(gt_category[i]),
+        'bbox': gt_boxes[i].tolist(), 'area': float(gt_boxes[i, 2] * gt_boxes[i, 3]),
+        'iscrowd': int(rng.random() < 0.01),
+    } for i in range(n)]
+
+    # about a third of the detections hit ground truth, the rest is background
+    num_hits = np.minimum(dets_per_image // 3, num_gts * 4)
+    results = list()
+    starts = np.concatenate([[0], np.cumsum(num_gts)])
+    for image_id in range(1, images + 1):
+        gts = np.arange(starts[image_id - 1], starts[image_id])
+        hits = rng.choice(gts, num_hits[image_id - 1]) if len(gts) > 0 else np.zeros(0, np.int64)
+        boxes = gt_boxes[hits] * (1 + rng.normal(0, 0.1, (len(hits), 4)))
+        category = np.where(rng.random(len(hits)) < 0.9, gt_category[hits], rng.integers(1, categories + 1, len(hits)))
+        num_background = dets_per_image - len(hits)
+        wh = np.exp(rng.uniform(np.log(8), np.log(400), (num_background, 2)))
+        xy = rng.uniform(0, 1, (num_background, 2)) * np.maximum([width, height] - wh, 1)
+        boxes = np.concatenate([boxes, np.concatenate([xy, wh], axis=1)])
+        boxes[:, 2:] = np.maximum(boxes[:, 2:], 1)
+        category = np.concatenate([category, rng.integers(1, categories + 1, num_background)])
+        scores = np.concatenate([rng.beta(5, 2, len(hits)), rng.beta(1, 5, num_background)])
+        results.extend({'image_id': image_id, 'category_id': int(c), 'bbox': b, 'score': float(s)}
+                       for c, b, s in zip(category.tolist(), np.round(boxes, 2).tolist(), scores.tolist()))
+
+    gt = {
+        'images': [{'id': i, 'width': width, 'height': height, 'file_name': '{}.jpg'.format(i)}
+                   for i in range(1, images + 1)],
+        'annotations': annotations,
+        'categories': [{'id': i, 'name': str(i)} for i in range(1, categories + 1)],
+    }
+    return gt, results
+
+
+def run_pycocotools(gt, results):
+    from pycocotools.coco import COCO
+    from pycocotools.cocoeval import COCOeval
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        coco_gt = COCO()
+        coco_gt.dataset = gt
+        coco_gt.createIndex()
+        coco_eval = COCOeval(coco_gt, coco_gt.loadRes(results), 'bbox')
+        coco_eval.evaluate()
+        coco_eval.accumulate()
+        coco_eval.summarize()
+    return coco_eval.stats, coco_eval.eval['precision']
+
+
+def run_vectorized(gt, results, workers):
+    from engine.cocoeval import evaluate_bbox, summarize
+
+    evaluation = evaluate_bbox(gt, results, workers)
+    return summarize(evaluation), evaluation['precision']
+
+
+def measure(queue, name, gt, results, workers):
+    """child process: evaluate, report seconds, peak RSS (including its pool) and stats"""
+    start = time.perf_counter()
+    if name == 'pycocotools':
+        stats, precision = run_pycocotools(gt, results)
+    else:
+        stats, precision = run_vectorized(gt, results, workers)
+    seconds = time.perf_counter() - start
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    queue.put((seconds, rss / 1024, stats, precision))
+
+
+def main(args):
+    start = time.perf_counter()
+    gt, results = synthetic_split(args.images, args.gts_per_image, args.dets_per_image, args.categories, args.seed)
+    print('>>> {} images, {} ground truth, {} detections, generated in {:.1f}s'.format(
+        len(gt['images']), len(gt['annotations']), len(results), time.perf_counter() - start))
+
+    names = ['vectorized'] if args.skip_pycocotools else ['pycocotools', 'vectorized']
+    outputs = dict()
+    for name in names:
+        # a fresh process each, so the peak RSS of one does not hide the other's
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=measure, args=(queue, name, gt, results, args.workers))
+        process.start()
+        outputs[name] = queue.get()
+        process.join()
+        print('>>> {:12} {:8.1f}s {:8.0f} MB peak RSS'.format(name, outputs[name][0], outputs[name][1]))
+
+    if len(outputs) == 2:
+        (reference_seconds, _, reference_stats, reference_precision), (seconds, _, stats, precision) = \
+            outputs['pycocotools'], outputs['vectorized']
+        stats_difference = np.abs(stats - reference_stats).max()
+        precision_difference = np.abs(precision - reference_precision).max()
+        print('>>> speedup {:.1f}x, max |stats difference| {:.2e}, max |precision difference| {:.2e}'.format(
+            reference_seconds / max(seconds, 1e-9), stats_difference, precision_difference))
+        if not (stats_difference <= args.atol and precision_difference <= args.atol):
+            print('>>> MISMATCH with pycocotools beyond atol {:.0e}'.format(args.atol))
+            print('>>> pycocotools: ' + ' '.join('{:.4f}'.format(value) for value in reference_stats))
+            print('>>> vectorized:  ' + ' '.join('{:.4f}'.format(value) for value in stats))
+            sys.exit(1)
+    print('>>> stats: ' + ' '.join('{:.4f}'.format(value) for value in outputs['vectorized'][2]))
+
+
+if __name__ == "__main__":
+    args = args_parser()
+    for key, value in vars(args).items():
+        print('>>> {:10}: {}'.format(key, value))
+    main(args)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2021-02-01
+# @Author  : Yifer Huang
+# @File    : fixtures.py
+# @Desc    : synthetic vidor / ILSVRC / COCO datasets for the benchmarks
+
+import json
+import os
+import random
+
+import cv2
+import numpy as np
+
+from datasets.vocab import coco2vidor, ilsvrc2vidor, vidor_categories
+
+# .{root}
+# ├── videos/0000/{video_id}.mp4            # vidor: moving boxes on a changing background
+# ├── training/0000/{video_id}.json         # vidor: raw trajectories of every video
+# ├── ILSVRC2015/Annotations/DET/train/     # ILSVRC2013_train/{wnid}/*.xml, ILSVRC2014_train_000{0-6}/*.xml
+# └── coco/annotations/                     # instances_{train,val,minival}2014.json
+
+SCALES = {
+    'small': {'videos': 4, 'frames': 160, 'ilsvrc_per_class': 4, 'ilsvrc_per_folder': 20, 'coco_images': 500},
+    'medium': {'videos': 16, 'frames': 320, 'ilsvrc_per_class': 16, 'ilsvrc_per_folder': 80, 'coco_images': 4000},
+    'large': {'videos': 64, 'frames': 640, 'ilsvrc_per_class': 64, 'ilsvrc_per_folder': 320, 'coco_images': 32000},
+}
+WIDTH, HEIGHT = 320, 240
+VIDEOS_PER_DIR = 8
+
+
+def make_vidor(root, videos, frames, seed=0):
+    """short mp4s (written with opencv) and raw vidor annotations of their trajectories"""
+    rng = np.random.RandomState(seed)
+    names = [item['name'] for item in vidor_categories]
+    for v in range(videos):
+        sub_dir = '{:04d}'.format(v // VIDEOS_PER_DIR)
+        video_id = str(1000000000 + v)
+        os.makedirs(os.path.join(root, 'videos', sub_dir), exist_ok=True)
+        os.makedirs(os.path.join(root, 'training', sub_dir), exist_ok=True)
+        num_objects = rng.randint(1, 5)
+        sizes = rng.randint(20, 80, (num_objects, 2))
+        starts = rng.randint(0, 160, (num_objects, 2))
+        velocities = rng.uniform(-1, 1, (num_objects, 2))
+        colors = rng.randint(0, 256, (num_objects, 3))
+        # objects come and go, some frames have no boxes
+        spans = np.sort(rng.randint(0, frames, (num_objects, 2)), axis=1)
+        writer = cv2.VideoWriter(os.path.join(root, 'videos', sub_dir, video_id + '.mp4'),
+                                 cv2.VideoWriter_fourcc(*'mp4v'), 30, (WIDTH, HEIGHT))
+        trajectories = list()
+        for i in range(frames):
+            image = np.full((HEIGHT, WIDTH, 3), (i * 3) % 256, dtype=np.uint8)
+            boxes = list()
+            for tid in range(num_objects):
+                x, y = (starts[tid] + velocities[tid] * i).astype(int) % [WIDTH - sizes[tid, 0], HEIGHT - sizes[tid, 1]]
+                cv2.rectangle(image, (int(x), int(y)), (int(x + sizes[tid, 0]), int(y + sizes[tid, 1])),
+                              colors[tid].tolist(), -1)
+                if spans[tid, 0] <= i <= spans[tid, 1]:
+                    boxes.append({'tid': tid, 'bbox': {'xmin': int(x), 'ymin': int(y),
+                                                       'xmax': int(x + sizes[tid, 0]), 'ymax': int(y + sizes[tid, 1])}})
+            writer.write(image)
+            trajectories.append(boxes)
+        writer.release()
+        with open(os.path.join(root, 'training', sub_dir, video_id + '.json'), 'w') as f:
+            json.dump({
+                'video_id': video_id, 'width': WIDTH, 'height': HEIGHT, 'frame_count': frames, 'fps': 30,
+                'subject/objects': [{'tid': tid, 'category': names[rng.randint(len(names))]}
+                                    for tid in range(num_objects)],
+                'trajectories': trajectories,
+                'relation_instances': [],
+            }, f)
+
+
+def _ilsvrc_xml(folder, filename, objects):
+    return '<annotation><folder>{}</folder><filename>{}</filename><source><database>ILSVRC_2014</database>' \
+           '</source><size><width>500</width><height>375</height></size>{}</annotation>'.format(
+               folder, filename, ''.join(
+                   '<object><name>{}</name><bndbox><xmin>{}</xmin><ymin>{}</ymin><xmax>{}</xmax><ymax>{}</ymax>'
+                   '</bndbox><truncated>0</truncated><occluded>0</occluded></object>'.format(*obj) for obj in objects))
+
+
+def make_ilsvrc(root, per_class, per_folder, seed=0):
+    """ILSVRC DET xml annotations, for every wnid convert_from_ilsvrc reads"""
+    rng = random.Random(seed)
+    wnids = list(ilsvrc2vidor) + ['n00007846']  # plus one unmapped class, dropped by the converter
+    base = os.path.join(root, 'Annotations', 'DET', 'train')
+
+    def objects():
+        return [(rng.choice(wnids), rng.randint(0, 100), rng.randint(0, 100), rng.randint(150, 400), rng.randint(150, 300))
+                for _ in range(rng.randint(0, 4))]
+
+    for wnid in ilsvrc2vidor:
+        folder = os.path.join(base, 'ILSVRC2013_train', wnid)
+        os.makedirs(folder, exist_ok=True)
+        for i in range(per_class):
+            with open(os.path.join(folder, '{}_{}.xml'.format(wnid, i)), 'w') as f:
+                f.write(_ilsvrc_xml(wnid, '{}_{}'.format(wnid, i), objects()))
+    for j in range(7):
+        folder_name = 'ILSVRC2014_train_000{}'.format(j)
+        os.makedirs(os.path.join(base, folder_name), exist_ok=True)
+        for i in range(per_folder):
+            filename = '{}{:04d}'.format(folder_name, i)
+            with open(os.path.join(base, folder_name, filename + '.xml'), 'w') as f:
+                f.write(_ilsvrc_xml(folder_name, filename, objects()))
+
+
+def make_coco(root, images, seed=0):
+    """tiny COCO instances files, val2014 contains a minival2014 subset"""
+    rng = random.Random(seed)
+    names = list(coco2vidor) + ['toothbrush', 'kite']   # plus unmapped categories
+    categories = [{'id': i * 2 + 1, 'name': name, 'supercategory': 'coco'} for i, name in enumerate(names)]
+    annotation_id = [1]
+
+    def split(image_ids):
+        coco_images = [{'id': i, 'file_name': 'COCO_{:012d}.jpg'.format(i), 'height': 480, 'width': 640}
+                       for i in image_ids]
+        annotations = list()
+        for i in image_ids:
+            for _ in range(rng.randint(0, 6)):
+                w, h = rng.uniform(4, 300), rng.uniform(4, 300)
+                annotations.append({'id': annotation_id[0], 'image_id': i, 'category_id': rng.choice(categories)['id'],
+                                    'bbox': [rng.uniform(0, 300), rng.uniform(0, 200), w, h], 'area': w * h,
+                                    'iscrowd': int(rng.random() < 0.01), 'segmentation': []})
+                annotation_id[0] += 1
+        rng.shuffle(annotations)
+        return {'images': coco_images, 'annotations': annotations, 'categories': categories}
+
+    os.makedirs(os.path.join(root, 'annotations'), exist_ok=True)
+    train = split(list(range(1, images // 2 + 1)))
+    val = split(list(range(1000000, 1000000 + images // 2)))
+    minival_ids = set(image['id'] for image in val['images'][::5])
+    minival = {'images': [image for image in val['images'] if image['id'] in minival_ids],
+               'annotations': [anno for anno in val['annotations'] if anno['image_id'] in minival_ids],
+               'categories': categories}
+    for name, data in [('train2014', train), ('val2014', val), ('minival2014', minival)]:
+        with open(os.path.join(root, 'annotations', 'instances_{}.json'.format(name)), 'w') as f:
+            json.dump(data, f)
+
+
+def make_fixtures(root, scale):
+    """generate all fixtures of a scale under root, unless they already exist
+
+    Returns:
+        dict: paths of the vidor, ILSVRC and COCO roots
+    """
+    params = SCALES[scale]
+    paths = {'vidor': os.path.join(root, 'vidor'), 'ilsvrc': os.path.join(root, 'ILSVRC2015'),
+             'coco': os.path.join(root, 'coco')}
+    done = os.path.join(root, '.done')
+    if not os.path.exists(done):
+        make_vidor(paths['vidor'], params['videos'], params['frames'])
+        make_ilsvrc(paths['ilsvrc'], params['ilsvrc_per_class'], params['ilsvrc_per_folder'])
+        make_coco(paths['coco'], params['coco_images'])
+        with open(done, 'w') as f:
+            json.dump(params, f)
+    return paths
@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2021-02-01
+# @Author  : Yifer Huang
+# @File    : pipeline.py
+# @Desc    : time extract -> annotate -> convert -> register -> test on synthetic fixtures
+
+# python -m benchmark.pipeline --scales small,medium --output bench.json --baseline benchmark/baseline.json
+# python -m benchmark.pipeline --scales small,medium --save-baseline benchmark/baseline.json
+# benchmark/baseline.json: small and medium, its environment lists the commit and machine; a run
+# in another environment (cpus, dependencies, detectron2 missing or not) refuses to compare with it
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+
+from benchmark.fixtures import SCALES, make_fixtures
+
+# .{workdir}/{scale}
+# ├── vidor/                # fixtures, plus frames@{f}/ and d2_train_{f}.json of extract/annotate
+# ├── ILSVRC2015/           # fixtures, plus train_201{3,4}_vidor.json of ilsvrc
+# ├── coco/                 # fixtures, plus train_vidor.json, val_minus_minival_vidor.json of coco
+# ├── cache/                # PackedRecords of register/load
+# ├── output/               # OUTPUT_DIR of test
+# └── logs/{stage}.log      # stdout/stderr of each stage
+
+STAGES = ['extract', 'annotate', 'ilsvrc', 'coco', 'register', 'load', 'test']
+# metric: True if higher is better
+METRICS = OrderedDict([
+    ('items_per_second', True),
+    ('peak_rss_mb', False),
+    ('read_calls', False),
+    ('write_calls', False),
+])
+
+
+def args_parser():
+    parser = argparse.ArgumentParser(description='end-to-end benchmark of the data and inference pipeline')
+    parser.add_argument('--scales', default='small', help='comma separated, of {}'.format(', '.join(SCALES)))
+    parser.add_argument('--stages', default=','.join(STAGES), help='comma separated, later stages read the '
+                                                                   'outputs of earlier ones')
+    parser.add_argument('--workdir', default='/tmp/vidor_benchmark', help='fixtures and outputs, kept across runs')
+    parser.add_argument('--f', dest='frequency', type=int, default=16, help='sample frequency of extract/annotate')
+    parser.add_argument('--workers', type=int, default=1, help='processes of extract, annotate and ilsvrc')
+    parser.add_argument('--test-images', dest='test_images', type=int, default=16, help='images predicted by test')
+    parser.add_argument('--config-file', dest='config_file', default='configs/vidor_faster_rcnn_R_101_C4_GPU_2.yaml')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per stage, the fastest one is reported')
+    parser.add_argument('--output', default=None, help='results json, {workdir}/results.json by default')
+    parser.add_argument('--baseline', default=None, help='results json to compare against')
+    parser.add_argument('--save-baseline', dest='save_baseline', default=None, help='store the results as baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative change flagged as a regression')
+    parser.add_argument('--allow-mismatch', dest='allow_mismatch', action='store_true',
+                        help='compare against a baseline measured in another environment or with other args')
+
+    args = parser.parse_args()
+    args.scales = args.scales.split(',')
+    assert set(args.scales) <= set(SCALES), args.scales
+    args.stages = [stage for stage in STAGES if stage in args.stages.split(',')]
+    assert args.workers >= 1 and args.repeat >= 1
+    args.output = os.path.join(args.workdir, 'results.json') if args.output is None else args.output
+    return args
+
+
+def _d2_train_json(paths, args):
+    return os.path.join(paths['vidor'], 'd2_train_{}.json'.format(args.frequency))
+
+
+def _frames_dir(paths, args):
+    return os.path.join(paths['vidor'], 'frames@{}'.format(args.frequency))
+
+
+def _datasets(paths, args):
+    """(name, json_file, image_root) of the converted annotations"""
+    return [
+        ('benchmark_vidor_train', _d2_train_json(paths, args), _frames_dir(paths, args)),
+        ('benchmark_coco_train', os.path.join(paths['coco'], 'train_vidor.json'), paths['coco']),
+        ('benchmark_coco_val_minus_minival', os.path.join(paths['coco'], 'val_minus_minival_vidor.json'),
+         paths['coco']),
+        ('benchmark_ilsvrc_train2013', os.path.join(paths['ilsvrc'], 'train_2013_vidor.json'), paths['ilsvrc']),
+        ('benchmark_ilsvrc_train2014', os.path.join(paths['ilsvrc'], 'train_2014_vidor.json'), paths['ilsvrc']),
+    ]
+
+
+def _num_images(*json_files):
+    num_images = 0
+    for json_file in json_files:
+        with open(json_file, 'r') as f:
+            num_images += len(json.load(f)['images'])
+    return num_images
+
+
+def run_extract(paths, args):
+    from extract_frames import list_frames, vidor_extractor
+
+    # the manifests would turn a rerun into a no-op
+    shutil.rmtree(_frames_dir(paths, args), ignore_errors=True)
+    vidor_extractor(args.frequency, paths['vidor'], _frames_dir(paths, args), workers=args.workers)
+    return lambda: (len(list_frames(_frames_dir(paths, args))), 'frames')
+
+
+def run_annotate(paths, args):
+    from extract_frames import vidor_annotator
+
+    vidor_annotator(args.frequency, paths['vidor'], _frames_dir(paths, args), 'train', workers=args.workers)
+    return lambda: (_num_images(_d2_train_json(paths, args)), 'images')
+
+
+def run_ilsvrc(paths, args):
+    from annotator import convert_from_ilsvrc
+
+    convert_from_ilsvrc('vidor', paths['ilsvrc'], paths['ilsvrc'], args.workers)
+    return lambda: (sum(len(files) for _, _, files in os.walk(os.path.join(paths['ilsvrc'], 'Annotations'))),
+                    'xml files')
+
+
+def run_coco(paths, args):
+    from annotator import convert_from_coco
+
+    convert_from_coco('vidor', paths['coco'], paths['coco'])
+    return lambda: (_num_images(os.path.join(paths['coco'], 'train_vidor.json'),
+                                os.path.join(paths['coco'], 'val_minus_minival_vidor.json')), 'images')
+
+
+def _load_datasets(paths, args):
+    from datasets.dataset import load_cached
+    from detectron2.data.datasets import load_coco_json
+
+    num_records = 0
+    for name, json_file, image_root in _datasets(paths, args):
+        records = load_cached(name, lambda: load_coco_json(json_file, image_root, name), json_file, image_root)
+        num_records += sum(1 for _ in records)
+    return num_records
+
+
+def run_register(paths, args):
+    """parse the annotation files into the (empty) dataset cache, see datasets/dataset.py"""
+    shutil.rmtree(os.environ['VIDOR_DATASET_CACHE'], ignore_errors=True)
+    num_records = _load_datasets(paths, args)
+    return lambda: (num_records, 'records')
+
+
+def run_load(paths, args):
+    """map the dataset cache filled by register, as later runs / data loader workers do"""
+    num_records = _load_datasets(paths, args)
+    return lambda: (num_records, 'records')
+
+
+def run_test(paths, args):
+    """Trainer.test of a randomly initialized model on CPU, on the first --test-images frames"""
+    from detectron2.config import get_cfg
+    from detectron2.data import DatasetCatalog, MetadataCatalog
+    from detectron2.data.datasets import load_coco_json
+
+    from config import add_vidor_config
+    from train_net import Trainer, setup_threads
+
+    _, json_file, image_root = _datasets(paths, args)[0]
+    name = 'benchmark_vidor_test'
+    DatasetCatalog.register(name, lambda: load_coco_json(json_file, image_root, name)[:args.test_images])
+    MetadataCatalog.get(name).set(json_file=json_file, image_root=image_root, evaluator_type='coco')
+
+    cfg = get_cfg()
+    add_vidor_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list([
+        'MODEL.DEVICE', 'cpu', 'MODEL.WEIGHTS', '', 'DATASETS.TEST', (name, ),
+        'OUTPUT_DIR', os.path.join(os.path.dirname(paths['vidor']), 'output'),
+    ])
+    cfg.freeze()
+    setup_threads(cfg)
+    model = Trainer.build_model(cfg)
+    Trainer.test(cfg, model)
+    return lambda: (min(args.test_images, _num_images(json_file)), 'images')
+
+
+def read_io():
+    """counters of /proc/self/io, i.e. of this process and its finished threads"""
+    counters = dict()
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                key, value = line.split(':')
+                counters[key] = int(value)
+    except OSError:     # not linux
+        pass
+    return counters
+
+
+def peak_rss():
+    """peak RSS of this process in MB, VmHWM starts over at exec, unlike ru_maxrss which
+    a spawned process inherits from its parent"""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:     # not linux
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(queue, stage, paths, args, log_filename):
+    """child process: run one stage with its output in log_filename and report
+    seconds, items, peak RSS (including its pools) and I/O counters
+    """
+    os.environ['VIDOR_DATASET_CACHE'] = os.path.join(os.path.dirname(paths['vidor']), 'cache')
+    log = open(log_filename, 'w')
+    os.dup2(log.fileno(), sys.stdout.fileno())
+    os.dup2(log.fileno(), sys.stderr.fileno())
+    result = {'stage': stage}
+    try:
+        io_start = read_io()
+        start = time.perf_counter()
+        count = globals()['run_' + stage](paths, args)
+        result['seconds'] = time.perf_counter() - start
+        io_end = read_io()
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        result['items'], result['unit'] = count()
+        result['items_per_second'] = result['items'] / max(result['seconds'], 1e-9)
+        result['peak_rss_mb'] = max(peak_rss(), children_usage.ru_maxrss / 1024)
+        # read()/write()-family calls (syscr/syscw), not all syscalls, of the stage process
+        # only, --workers > 1 moves part of them to the pool
+        result['read_calls'] = io_end.get('syscr', 0) - io_start.get('syscr', 0)
+        result['write_calls'] = io_end.get('syscw', 0) - io_start.get('syscw', 0)
+        result['read_bytes'] = io_end.get('rchar', 0) - io_start.get('rchar', 0)
+        result['write_bytes'] = io_end.get('wchar', 0) - io_start.get('wchar', 0)
+        # block I/O (page cache misses / writeback) including the pools
+        result['block_inputs'] = self_usage.ru_inblock + children_usage.ru_inblock
+        result['block_outputs'] = self_usage.ru_oublock + children_usage.ru_oublock
+    except Exception as e:
+        # register, load and test without detectron2, any other import error is a failure
+        if isinstance(e, ModuleNotFoundError) and (e.name or '').split('.')[0] == 'detectron2':
+            result['skipped'] = str(e)
+        else:
+            result['error'] = '{}: {}'.format(type(e).__name__, e)
+            import traceback
+            traceback.print_exc()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    queue.put(result)
+
+
+def run_stage(stage, paths, args, log_filename):
+    """run a stage in a fresh (spawned) process, so the peak RSS and I/O counters of
+    one stage do not include those of the others"""
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=measure, args=(queue, stage, paths, args, log_filename))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def environment():
+    import cv2
+    import numpy as np
+
+    info = OrderedDict([
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('cpus', os.cpu_count()),
+        ('numpy', np.__version__),
+        ('opencv', cv2.__version__),
+    ])
+    for module in ['torch', 'detectron2']:
+        try:
+            info[module] = __import__(module).__version__
+        except ImportError:
+            info[module] = None
+    try:
+        info['commit'] = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                                 cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        info['commit'] = None
+    return info
+
+
+def environment_mismatches(results, baseline):
+    """differences between the machine, dependencies (detectron2 None when missing), args
+    and measured stages of results and baseline, which make their numbers incomparable
+
+    Returns:
+        list: (key, baseline value, value) tuples
+    """
+    mismatches = list()
+    for key in ['cpus', 'python', 'numpy', 'opencv', 'torch', 'detectron2']:
+        if baseline.get('environment', {}).get(key) != results['environment'][key]:
+            mismatches.append((key, baseline.get('environment', {}).get(key), results['environment'][key]))
+    for key in ['frequency', 'workers', 'test_images', 'config_file']:
+        if baseline.get('args', {}).get(key) != results['args'][key]:
+            mismatches.append((key, baseline.get('args', {}).get(key), results['args'][key]))
+    for scale, stages in results['scales'].items():
+        for stage, result in stages.items():
+            reference = baseline.get('scales', {}).get(scale, {}).get(stage)
+            if reference is not None and ('seconds' in reference) != ('seconds' in result):
+                mismatches.append(('{} {}'.format(scale, stage), 'measured' if 'seconds' in reference else 'skipped',
+                                   'measured' if 'seconds' in result else 'skipped'))
+    return mismatches
+
+
+def compare(results, baseline, tolerance):
+    """regressions of results against baseline, for the scales and stages both measured
+
+    Returns:
+        list: (scale, stage, metric, baseline value, value) tuples
+    """
+    regressions = list()
+    for scale, stages in results['scales'].items():
+        for stage, result in stages.items():
+            reference = baseline.get('scales', {}).get(scale, {}).get(stage)
+            if reference is None or 'seconds' not in reference or 'seconds' not in result:
+                continue
+            for metric, higher_is_better in METRICS.items():
+                if metric not in reference:     # baseline of an older version
+                    continue
+                if higher_is_better:
+                    regressed = result[metric] < reference[metric] * (1 - tolerance)
+                else:
+                    # small counters are noise, e.g. 3 -> 5 read calls
+                    regressed = result[metric] > reference[metric] * (1 + tolerance) + 16
+                if regressed:
+                    regressions.append((scale, stage, metric, reference[metric], result[metric]))
+    return regressions
+
+
+def main(args):
+    results = OrderedDict([('environment', environment()), ('args', vars(args)), ('scales', OrderedDict())])
+    for scale in args.scales:
+        root = os.path.join(args.workdir, scale)
+        start = time.perf_counter()
+        paths = make_fixtures(root, scale)
+        print('>>> {} fixtures ready in {:.1f}s: {}'.format(scale, time.perf_counter() - start, SCALES[scale]))
+        os.makedirs(os.path.join(root, 'logs'), exist_ok=True)
+        results['scales'][scale] = OrderedDict()
+        for stage in args.stages:
+            log_filename = os.path.join(root, 'logs', '{}.log'.format(stage))
+            runs = [run_stage(stage, paths, args, log_filename) for _ in range(args.repeat)]
+            timed = [run for run in runs if 'seconds' in run]
+            result = min(timed, key=lambda run: run['seconds']) if len(timed) > 0 else runs[0]
+            results['scales'][scale][stage] = result
+            if 'seconds' in result:
+                print('>>> {:6} {:9} {:8.2f}s {:10.1f} {}/s {:8.0f} MB peak RSS {:9} read {:9} write calls'.format(
+                    scale, stage, result['seconds'], result['items_per_second'], result['unit'],
+                    result['peak_rss_mb'], result['read_calls'], result['write_calls']))
+            else:
+                print('>>> {:6} {:9} {}: {} (see {})'.format(
+                    scale, stage, 'skipped' if 'skipped' in result else 'failed',
+                    result.get('skipped', result.get('error')), log_filename))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('>>> Successfully save results to {}'.format(args.output))
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('>>> Successfully save baseline to {}'.format(args.save_baseline))
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        mismatches = environment_mismatches(results, baseline)
+        for key, reference, value in mismatches:
+            print('>>> {}: baseline was measured with {} = {}, not {}'.format(
+                'WARNING' if args.allow_mismatch else 'MISMATCH', key, reference, value))
+        if len(mismatches) > 0 and not args.allow_mismatch:
+            print('>>> Refuse to compare against {}, rerun it here or pass --allow-mismatch'.format(args.baseline))
+            sys.exit(3)
+        regressions = compare(results, baseline, args.tolerance)
+        for scale, stage, metric, reference, value in regressions:
+            print('>>> REGRESSION {:6} {:9} {:16}: {:.1f} -> {:.1f}'.format(scale, stage, metric, reference, value))
+        print('>>> {} regressions against {} (tolerance {:.0%})'.format(len(regressions), args.baseline, args.tolerance))
+        if len(regressions) > 0:
+            sys.exit(1)
+    if any('error' in result for stages in results['scales'].values() for result in stages.values()):
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    args = args_parser()
+    for key, value in vars(args).items():
+        print('>>> {:10}: {}'.format(key, value))
+    main(args)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2021-01-24
+# @Author  : Yifer Huang
+# @File    : config.py
+# @Desc    : project specific config options (on top of detectron2 defaults)
+
+from detectron2.config import CfgNode as CN
+
+
+def add_vidor_config(cfg):
+    """add project specific config options, call it before merging a config file
+
+    Args:
+        cfg (CfgNode): detectron2 default config
+    """
+    # decoded-frame cache, see datasets/cache.py
+    cfg.INPUT.CACHE = CN()
+    cfg.INPUT.CACHE.ENABLED = False
+    # shared by the data loader workers and GPU processes of a node, tmpfs keeps it in RAM
+    cfg.INPUT.CACHE.DIR = '/dev/shm/vidor_frame_cache'
+    cfg.INPUT.CACHE.MAX_GB = 64.0
+    cfg.INPUT.CACHE.LOG_PERIOD = 20
+
+    # merged train dataset dicts packed into one memory-mapped file (datasets/serialize.py)
+    # instead of a list of dicts per process, see Trainer.build_train_dataset; empty to
+    # disable. Files of other keys (older configs or annotations) found in the directory are
+    # removed, so give concurrent jobs with different datasets their own directories
+    cfg.DATALOADER.PACKED_DICTS_DIR = '/dev/shm/vidor_dataset_dicts'
+    # used when PACKED_DICTS_DIR lacks the space (docker limits /dev/shm to 64 MB unless run
+    # with --shm-size), still memory-mapped and shared through the page cache; empty for
+    # {OUTPUT_DIR}/dataset_dicts
+    cfg.DATALOADER.PACKED_DICTS_FALLBACK_DIR = ''
+
+    # DATALOADER.SAMPLER_TRAIN = 'WeightedSourceSampler' (datasets/sampler.py) draws each
+    # dataset of DATASETS.TRAIN with its weight instead of uniformly over their concatenation;
+    # empty weights for proportional to the dataset sizes
+    cfg.DATALOADER.SOURCE_WEIGHTS = ()
+    # keep 1 of every FRAME_STRIDE frames of a video per epoch (random phase per epoch)
+    cfg.DATALOADER.FRAME_STRIDE = 1
+    # drop video frames whose boxes all match the previous kept frame with this IoU, 0 keeps all
+    cfg.DATALOADER.DEDUP_IOU = 0.0
+    # width / height bin edges, batches are drawn within a bin; keep 1.0 as an edge, so the
+    # bins nest in the landscape / portrait groups of ASPECT_RATIO_GROUPING
+    cfg.DATALOADER.ASPECT_RATIO_BINS = (0.75, 1.0, 1.4, 1.7)
+
+    # batched inference for eval-only runs, see engine/inference.py; 1 keeps detectron2's
+    # one image per forward pass
+    cfg.TEST.IMS_PER_BATCH = 1
+    cfg.TEST.NUM_WORKERS = 4
+    # torch intra-op / inter-op threads of each process, 0 keeps torch's default
+    cfg.TEST.NUM_THREADS = 0
+    cfg.TEST.NUM_INTEROP_THREADS = 0
+
+    # sharded, resumable evaluation, see engine/inference.py; 1 disables sharding
+    cfg.TEST.SHARDS = CN()
+    cfg.TEST.SHARDS.NUM_SHARDS = 1
+    # shards run by this job (spread over its processes), empty for all; the job which
+    # finds every shard finished merges them into the final metrics
+    cfg.TEST.SHARDS.IDS = ()
+    # shard files go to {DIR}/{dataset_name}, shared by all jobs; empty for
+    # {OUTPUT_DIR}/inference/{dataset_name}/shards
+    cfg.TEST.SHARDS.DIR = ''
+
+    # bbox evaluator of Trainer.build_evaluator: coco (detectron2's COCOEvaluator) or
+    # fast_coco (engine/evaluation.py, same AP/AR, vectorized, EVAL_WORKERS processes)
+    cfg.TEST.EVALUATOR = 'coco'
+    cfg.TEST.EVAL_WORKERS = 4
+
+    # per-iteration stage timers of training (data loader wait, decode, augmentation,
+    # forward, backward, optimizer, all-reduce) and the prefetch depth, see engine/hooks.py
+    # ProfilingHook; written to EventStorage and {OUTPUT_DIR}/profiling/rank{rank}.csv
+    cfg.PROFILING = CN()
+    cfg.PROFILING.ENABLED = False
+    cfg.PROFILING.PERIOD = 20
+    # synchronize CUDA at the stage boundaries, slightly slower but the times are attributable
+    cfg.PROFILING.SYNC_CUDA = True
+    # time the gradient all-reduce with a DDP comm hook (torch >= 1.8)
+    cfg.PROFILING.COMM_HOOK = True
+    # (start, end) iterations traced into a chrome trace json, empty for no trace
+    cfg.PROFILING.TRACE_ITERS = ()
+    # torch (torch.profiler) or py-spy (attached to the process, needs ptrace permission)
+    cfg.PROFILING.TRACE_MODE = 'torch'
+    cfg.PROFILING.TRACE_RANKS = (0, )
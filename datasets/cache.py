@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2021-01-24
+# @Author  : Yifer Huang
+# @File    : cache.py
+# @Desc    : memory-mapped cache of decoded and resized frames
+
+import fcntl
+import hashlib
+import multiprocessing
+import os
+import struct
+
+import numpy as np
+
+from datasets import shards
+
+# .cache root (e.g. /dev/shm/vidor_frame_cache)
+# ├── .size                     # int64, bytes of the cached files, shared by all processes
+# ├── .evict.lock               # held by the process evicting
+# └── 3f/
+#     └── 3f2a...e1.npy         # uint8 HxWxC, key = sha1(file name + source mtime/size + resized shape)
+
+
+def source_version(file_name):
+    """(st_mtime_ns, st_size) of an image, of its shard for shard:// frames, so frames
+    extracted again in place get new cache keys"""
+    if file_name.startswith('shard://'):
+        frames_dir, basename = os.path.split(file_name[len('shard://'):])
+        file_name = shards.shard_filename(frames_dir, shards.video_of(basename))
+    stat = os.stat(file_name)
+    return stat.st_mtime_ns, stat.st_size
+
+class FrameCache(object):
+    """cache of decoded, pre-resized uint8 frames stored as .npy files and read back with
+    np.load(mmap_mode='r'), so every data loader worker and every GPU process of a node
+    maps the same pages instead of decoding the same JPEG again each epoch
+
+    Files are written under a temporary name and renamed, hits touch the mtime. The
+    processes of a node keep a running total of the cached bytes in the .size file,
+    and once it exceeds `max_bytes` one of them scans the cache and evicts the least
+    recently used files down to `low_water` of the budget, so a scan happens every
+    (1 - low_water) * max_bytes written, not on every miss. Hit/miss counters live in
+    shared memory, create the cache before the data loader forks its workers.
+
+    Args:
+        root (string): cache directory
+        max_bytes (int): byte budget of the cache
+        low_water (float): fraction of the budget kept after an eviction
+    """
+    def __init__(self, root, max_bytes, low_water=0.9):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        os.makedirs(root, exist_ok=True)
+        self.hits = multiprocessing.Value('q', 0)
+        self.misses = multiprocessing.Value('q', 0)
+        self.evictions = multiprocessing.Value('q', 0)
+        self.size_filename = os.path.join(root, '.size')
+        if not os.path.exists(self.size_filename):
+            self._scan()    # existing cache directory, sets the total
+
+    def _filename(self, file_name, shape):
+        key = '{}@{}@{}x{}'.format(file_name, '{}:{}'.format(*source_version(file_name)), *shape)
+        key = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.root, key[:2], key + '.npy')
+
+    def _add_size(self, delta=0, total=None):
+        """add delta to (or set) the running total of cached bytes, returns the new total"""
+        fd = os.open(self.size_filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            data = os.pread(fd, 8, 0)
+            value = struct.unpack('<q', data)[0] if len(data) == 8 else 0
+            value = max(value + delta if total is None else total, 0)
+            os.pwrite(fd, struct.pack('<q', value), 0)
+            return value
+        finally:
+            os.close(fd)
+
+    def _scan(self):
+        """(mtime, size, path) of every cached file, also resets the running total"""
+        entries = list()
+        for sub_dir in os.scandir(self.root):
+            if not sub_dir.is_dir():
+                continue
+            for entry in os.scandir(sub_dir.path):
+                if not entry.name.endswith('.npy'):  # being written
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:   # evicted by another process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        self._add_size(total=sum(size for _, size, _ in entries))
+        return entries
+
+    def get(self, file_name, shape, load):
+        """the cached frame, or load() it, cache and return it
+
+        Args:
+            file_name (string): image file name
+            shape (tuple): (height, width) of the resized frame
+            load (callable): returns the resized uint8 frame on a miss
+
+        Returns:
+            np.ndarray: read-only (memory-mapped) frame on a hit
+        """
+        filename = self._filename(file_name, shape)
+        try:
+            image = np.load(filename, mmap_mode='r')
+            os.utime(filename)  # LRU
+            with self.hits.get_lock():
+                self.hits.value += 1
+            return image
+        except FileNotFoundError:
+            pass
+        with self.misses.get_lock():
+            self.misses.value += 1
+        image = np.ascontiguousarray(load())
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        temp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(temp_filename, 'wb') as f:
+            np.save(f, image)
+        os.replace(temp_filename, filename)
+        if self._add_size(os.path.getsize(filename)) > self.max_bytes:
+            self.evict()
+        return image
+
+    def evict(self):
+        """delete the least recently used files down to low_water of the budget, in one
+        batch; skipped while another process is evicting"""
+        with open(os.path.join(self.root, '.evict.lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            entries = self._scan()
+            total = sum(size for _, size, _ in entries)
+            if total <= self.max_bytes:
+                return
+            entries.sort()
+            evicted, freed = 0, 0
+            for _, size, path in entries:
+                if total - freed <= self.max_bytes * self.low_water:
+                    break
+                try:
+                    os.remove(path)     # processes which mapped it keep their pages
+                    evicted += 1
+                except FileNotFoundError:
+                    pass
+                freed += size
+            self._add_size(-freed)
+        with self.evictions.get_lock():
+            self.evictions.value += evicted
+
+    def stats(self):
+        return {
+            'hits': self.hits.value,
+            'misses': self.misses.value,
+            'evictions': self.evictions.value
+        }
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2021-01-26
+# @Author  : Yifer Huang
+# @File    : columnar.py
+# @Desc    : columnar annotation store (memory-mapped numpy arrays)
+
+import array
+import json
+import os
+import shutil
+
+import numpy as np
+
+# .d2_train_16.columnar (next to d2_train_16.json)
+# ├── meta.json                 # coco header (info, categories, ...) and counts
+# ├── image_id.npy              # int64 [N]
+# ├── image_hw.npy              # int32 [N, 2], height and width
+# ├── file_name.bin             # utf-8 file names, concatenated
+# ├── file_name_offsets.npy     # int64 [N + 1], file name i is file_name.bin[offsets[i]:offsets[i + 1]]
+# ├── ann_offsets.npy           # int64 [N + 1], annotations of image i are rows ann_offsets[i]:ann_offsets[i + 1]
+# ├── ann_id.npy                # int64 [M]
+# ├── bbox.npy                  # float64 [M, 4], xywh, as in the coco json
+# ├── area.npy                  # float64 [M]
+# ├── category_id.npy           # int32 [M], dataset category ids
+# └── iscrowd.npy               # uint8 [M]
+
+def columnar_dirname(filename):
+    """d2_train_16.json -> d2_train_16.columnar"""
+    return os.path.splitext(filename)[0] + '.columnar'
+
+class ColumnarWriter(object):
+    """CocoWriter counterpart writing the columnar store, see the layout above
+
+    Each column is appended to its own raw file in a temporary directory next to
+    `dirname` (through a small buffer), so memory does not grow with the dataset.
+    close() groups the annotations by image (they may arrive in any order), turns the
+    raw files into .npy columns one at a time and renames the directory into place.
+
+    Args:
+        dirname (str): store directory, see `columnar_dirname`
+        header (dict): see `datasets.writer.coco_header`
+    """
+    # column -> (array typecode, numpy dtype, values per row)
+    COLUMNS = {
+        'image_id': ('q', np.int64, 1),
+        'image_hw': ('i', np.int32, 2),
+        'file_name_offsets': ('q', np.int64, 1),
+        'ann_image_id': ('q', np.int64, 1),
+        'ann_id': ('q', np.int64, 1),
+        'bbox': ('d', np.float64, 4),
+        'area': ('d', np.float64, 1),
+        'category_id': ('i', np.int32, 1),
+        'iscrowd': ('B', np.uint8, 1),
+    }
+    BUFFER_SIZE = 1 << 16     # values buffered per column before writing
+
+    def __init__(self, dirname, header):
+        self.dirname = dirname
+        self.header = header
+        self.temp_dirname = '{}.{}.tmp'.format(dirname, os.getpid())
+        if os.path.exists(self.temp_dirname):
+            shutil.rmtree(self.temp_dirname)
+        os.makedirs(self.temp_dirname)
+        self.files = {name: open(self._raw_filename(name), 'wb') for name in self.COLUMNS}
+        self.buffers = {name: array.array(typecode) for name, (typecode, _, _) in self.COLUMNS.items()}
+        self.file_name = open(os.path.join(self.temp_dirname, 'file_name.bin'), 'wb')
+        self.file_name_size = 0
+        self.num_images, self.num_annotations = 0, 0
+        self._append('file_name_offsets', 0)
+
+    def _raw_filename(self, name):
+        return os.path.join(self.temp_dirname, name + '.raw')
+
+    def _append(self, name, *values):
+        buffer = self.buffers[name]
+        buffer.extend(values)
+        if len(buffer) >= self.BUFFER_SIZE:
+            self._flush(name)
+
+    def _flush(self, name):
+        self.buffers[name].tofile(self.files[name])
+        del self.buffers[name][:]
+
+    def _load(self, name):
+        """memory-mapped raw column"""
+        _, dtype, width = self.COLUMNS[name]
+        filename = self._raw_filename(name)
+        if os.path.getsize(filename) == 0:
+            return np.zeros((0, width) if width > 1 else 0, dtype=dtype)
+        column = np.memmap(filename, dtype=dtype, mode='r')
+        return column.reshape(-1, width) if width > 1 else column
+
+    def add_image(self, image):
+        self._append('image_id', image['id'])
+        self._append('image_hw', image['height'], image['width'])
+        file_name = image['file_name'].encode('utf-8')
+        self.file_name.write(file_name)
+        self.file_name_size += len(file_name)
+        self._append('file_name_offsets', self.file_name_size)
+        self.num_images += 1
+
+    def add_images(self, images):
+        for image in images:
+            self.add_image(image)
+
+    def add_annotation(self, annotation):
+        self._append('ann_image_id', annotation['image_id'])
+        self._append('ann_id', annotation['id'])
+        self._append('bbox', *annotation['bbox'])
+        self._append('area', annotation['area'])
+        self._append('category_id', annotation['category_id'])
+        self._append('iscrowd', annotation.get('iscrowd', 0))
+        self.num_annotations += 1
+
+    def add_annotations(self, annotations):
+        for annotation in annotations:
+            self.add_annotation(annotation)
+
+    def _close_files(self):
+        for name, f in self.files.items():
+            if not f.closed:
+                self._flush(name)
+                f.close()
+        self.file_name.close()
+
+    def close(self):
+        try:
+            self._close_files()
+            image_id = np.array(self._load('image_id'))
+            ann_image_id = np.array(self._load('ann_image_id'))
+            # row of the image of each annotation, then annotations grouped by image row
+            order = np.argsort(image_id, kind='stable')
+            position = np.searchsorted(image_id[order], ann_image_id)
+            position = np.minimum(position, max(len(order) - 1, 0))
+            assert len(ann_image_id) == 0 or (image_id[order][position] == ann_image_id).all(), \
+                'annotations of unknown images'
+            ann_row = order[position]
+            ann_order = np.argsort(ann_row, kind='stable')
+            grouped = bool((np.diff(ann_row) >= 0).all())   # streamed image by image, nothing to reorder
+            ann_offsets = np.zeros(len(image_id) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(ann_row, minlength=len(image_id)), out=ann_offsets[1:])
+            del image_id, ann_image_id, order, position, ann_row
+            np.save(os.path.join(self.temp_dirname, 'ann_offsets.npy'), ann_offsets)
+
+            for name in self.COLUMNS:
+                if name != 'ann_image_id':
+                    column = self._load(name)
+                    if name in ['ann_id', 'bbox', 'area', 'category_id', 'iscrowd'] and not grouped:
+                        column = column[ann_order]
+                    np.save(os.path.join(self.temp_dirname, name + '.npy'), column)
+                    del column
+                os.remove(self._raw_filename(name))
+            meta = dict(self.header, num_images=self.num_images, num_annotations=self.num_annotations)
+            with open(os.path.join(self.temp_dirname, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+            if os.path.exists(self.dirname):
+                shutil.rmtree(self.dirname)
+            os.replace(self.temp_dirname, self.dirname)
+        except BaseException:
+            self.abort()
+            raise
+        print('>>> Successfully export {} images and {} annotations to {}'.format(
+            self.num_images, self.num_annotations, self.dirname))
+
+    def abort(self):
+        """drop the partial store, the previous one is kept"""
+        self._close_files()
+        shutil.rmtree(self.temp_dirname, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        self.abort()
+
+class ColumnarDataset(object):
+    """detectron2 dataset dicts built lazily from a memory-mapped columnar store
+
+    Opening it only maps the arrays, record i is built on access, with the category ids
+    mapped to contiguous ids like load_coco_json does. Processes which open the same
+    store share its pages.
+
+    Args:
+        dirname (str): store directory
+        image_root (str): directory of the images
+        bbox_mode (int): bbox_mode of the annotations (BoxMode.XYWH_ABS)
+    """
+    def __init__(self, dirname, image_root, bbox_mode=1):
+        self.dirname = dirname
+        self.image_root = image_root
+        self.bbox_mode = bbox_mode
+        with open(os.path.join(dirname, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        load = lambda name: np.load(os.path.join(dirname, name + '.npy'), mmap_mode='r')
+        self.image_id = load('image_id')
+        self.image_hw = load('image_hw')
+        self.file_name = np.memmap(os.path.join(dirname, 'file_name.bin'), dtype=np.uint8, mode='r') \
+            if os.path.getsize(os.path.join(dirname, 'file_name.bin')) > 0 else np.zeros(0, np.uint8)
+        self.file_name_offsets = load('file_name_offsets')
+        self.ann_offsets = load('ann_offsets')
+        self.ann_id = load('ann_id')
+        self.bbox = load('bbox')
+        self.category_id = load('category_id')
+        self.iscrowd = load('iscrowd')
+        # dataset category id -> contiguous id, as in load_coco_json
+        categories = sorted(self.meta['categories'], key=lambda item: item['id'])
+        self.thing_classes = [item['name'] for item in categories]
+        self.thing_dataset_id_to_contiguous_id = {item['id']: i for i, item in enumerate(categories)}
+        self.contiguous_id = np.full(max(self.thing_dataset_id_to_contiguous_id) + 1, -1, dtype=np.int64)
+        for dataset_id, contiguous_id in self.thing_dataset_id_to_contiguous_id.items():
+            self.contiguous_id[dataset_id] = contiguous_id
+
+    def __len__(self):
+        return len(self.image_id)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        start, end = int(self.file_name_offsets[index]), int(self.file_name_offsets[index + 1])
+        file_name = bytes(self.file_name[start:end]).decode('utf-8')
+        start, end = int(self.ann_offsets[index]), int(self.ann_offsets[index + 1])
+        bboxes = self.bbox[start:end].tolist()
+        category_ids = self.contiguous_id[self.category_id[start:end]].tolist()
+        iscrowds = self.iscrowd[start:end].tolist()
+        return {
+            'file_name': os.path.join(self.image_root, file_name),
+            'height': int(self.image_hw[index, 0]),
+            'width': int(self.image_hw[index, 1]),
+            'image_id': int(self.image_id[index]),
+            'annotations': [
+                {'iscrowd': iscrowd, 'bbox': bbox, 'category_id': category_id, 'bbox_mode': self.bbox_mode}
+                for bbox, category_id, iscrowd in zip(bboxes, category_ids, iscrowds)
+            ]
+        }
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
@@ -5,72 +5,198 @@
 # @File    : dataset.py
 # @Desc    : dataset register based on detectron2.data.dataset
 
-from detectron2.data.datasets import register_coco_instances
+import hashlib
+import io
+import json
+import os
+import pickle
+import tempfile
+
+from detectron2.data import DatasetCatalog, MetadataCatalog
+from detectron2.data.datasets import load_coco_json
+from detectron2.structures import BoxMode
+try:
+    from detectron2.utils.file_io import PathHandler, PathManager
+except ImportError:     # detectron2 <= 0.3
+    from fvcore.common.file_io import PathHandler, PathManager
+
+from datasets import shards
+from datasets.columnar import ColumnarDataset, columnar_dirname
+from datasets.serialize import PackedRecords
+
+# parsed dataset dicts are cached here (datasets/.cache of the repo, wherever the run starts),
+# VIDOR_DATASET_CACHE overrides it, empty to disable the cache
+CACHE_DIR = os.environ.get('VIDOR_DATASET_CACHE', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache'))
+CACHE_DIR = os.path.abspath(CACHE_DIR) if CACHE_DIR else CACHE_DIR
+
+
+class ShardPathHandler(PathHandler):
+    """resolve shard://{frames_dir}/{video_id}_{frame_index:04d}.jpg to the frame packed
+    into {frames_dir}/{video_id}.tar, so detectron2's DatasetMapper (read_image goes
+    through PathManager) trains on packed frames without any loose file
+    """
+    PREFIX = 'shard://'
+    # frames extracted for get_local_path (visualization, some evaluators)
+    LOCAL_DIR = os.path.join(tempfile.gettempdir(), 'vidor_shard_frames')
+
+    def _get_supported_prefixes(self):
+        return [self.PREFIX]
+
+    def _get_local_path(self, path, **kwargs):
+        """extract the frame into LOCAL_DIR once per shard version and return that file"""
+        frames_dir, basename = os.path.split(path[len(self.PREFIX):])
+        stat = os.stat(shards.shard_filename(frames_dir, shards.video_of(basename)))
+        key = json.dumps([os.path.abspath(frames_dir), stat.st_mtime, stat.st_size])
+        filename = os.path.join(self.LOCAL_DIR, hashlib.sha1(key.encode()).hexdigest()[:16], basename)
+        if not os.path.exists(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            temp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+            with open(temp_filename, 'wb') as f:
+                f.write(shards.read_frame(frames_dir, basename))
+            os.replace(temp_filename, filename)
+        return filename
+
+    def _exists(self, path, **kwargs):
+        frames_dir, basename = os.path.split(path[len(self.PREFIX):])
+        video_id = shards.video_of(basename)
+        return shards.ShardReader.exists(frames_dir, video_id) and \
+            basename in shards.get_reader(frames_dir, video_id)
+
+    def _open(self, path, mode='rb', buffering=-1, **kwargs):
+        assert mode in ['r', 'rb'], 'packed frames are read-only'
+        frames_dir, basename = os.path.split(path[len(self.PREFIX):])
+        return io.BytesIO(shards.read_frame(frames_dir, basename))
+
+
+PathManager.register_handler(ShardPathHandler())
+
+
+def load_shard_json(json_file, frames_dir, dataset_name=None):
+    """load_coco_json, with file names pointing into the per-video shards of frames_dir"""
+    dataset_dicts = load_coco_json(json_file, frames_dir, dataset_name)
+    for record in dataset_dicts:
+        record['file_name'] = ShardPathHandler.PREFIX + record['file_name']
+    return dataset_dicts
+
+
+def load_cached(name, load, json_file, image_root):
+    """load() the dataset dicts of `name` once per annotation file version, later calls
+    (other ranks, data loader workers, later runs) map the cached PackedRecords instead
+    of parsing the json again
+
+    The cache key is the annotation file's path, mtime and size plus the image root,
+    see `PackedRecords.build` for how concurrent processes share it. Metadata set by
+    load() (thing_classes, category id mapping) is cached along with the dicts. Once
+    built, the entries of older versions of the same dataset are removed.
+
+    Training does not go through here on every rank: the merged train dicts are packed
+    once per node and mapped by the other ranks, see Trainer.build_train_dataset.
+
+    Returns:
+        PackedRecords: read-only sequence of dataset dicts
+    """
+    if not CACHE_DIR:
+        return load()
+    stat = os.stat(json_file)
+    key = json.dumps([os.path.abspath(json_file), stat.st_mtime, stat.st_size, image_root])
+    path = os.path.join(CACHE_DIR, '{}-{}'.format(name, hashlib.sha1(key.encode()).hexdigest()[:16]))
+
+    def load_with_metadata():
+        # the metadata is written before the records, so it exists once they do
+        dataset_dicts = load()
+        meta = MetadataCatalog.get(name)
+        meta = {field: getattr(meta, field) for field in ('thing_classes', 'thing_dataset_id_to_contiguous_id')
+                if hasattr(meta, field)}
+        temp_filename = '{}.meta.pkl.{}.tmp'.format(path, os.getpid())
+        with open(temp_filename, 'wb') as f:
+            pickle.dump(meta, f)
+        os.replace(temp_filename, path + '.meta.pkl')
+        return dataset_dicts
+
+    records = PackedRecords.build(load_with_metadata, path)
+    PackedRecords.remove_stale(CACHE_DIR, path, prefix=name + '-')   # older annotation versions
+    with open(path + '.meta.pkl', 'rb') as f:
+        MetadataCatalog.get(name).set(**pickle.load(f))
+    return records
+
+
+def register_cached_coco_instances(name, metadata, json_file, image_root):
+    """register_coco_instances, with the parsed dataset dicts cached, see `load_cached`"""
+    DatasetCatalog.register(name, lambda: load_cached(
+        name, lambda: load_coco_json(json_file, image_root, name), json_file, image_root
+    ))
+    MetadataCatalog.get(name).set(
+        json_file=json_file, image_root=image_root, evaluator_type='coco', **metadata
+    )
+
+
+def register_shard_instances(name, metadata, json_file, frames_dir):
+    """register_coco_instances for frames packed by `extract_frames.py --pack`"""
+    DatasetCatalog.register(name, lambda: load_cached(
+        name, lambda: load_shard_json(json_file, frames_dir, name), json_file, frames_dir
+    ))
+    MetadataCatalog.get(name).set(
+        json_file=json_file, image_root=frames_dir, evaluator_type='coco', **metadata
+    )
+
+def load_columnar_instances(dirname, image_root, dataset_name=None):
+    """dataset dicts of a columnar store (datasets/columnar.py), built lazily on access
+    from memory-mapped arrays instead of parsing the whole coco json
+
+    Like load_coco_json, sets thing_classes and the category id mapping of dataset_name.
+    """
+    dataset = ColumnarDataset(dirname, image_root, BoxMode.XYWH_ABS)
+    if dataset_name is not None:
+        meta = MetadataCatalog.get(dataset_name)
+        meta.thing_classes = dataset.thing_classes
+        meta.thing_dataset_id_to_contiguous_id = dataset.thing_dataset_id_to_contiguous_id
+    return dataset
+
+
+def register_columnar_instances(name, metadata, dirname, image_root):
+    """register_coco_instances for a columnar store written with --format columnar
+
+    No json_file is set, COCOEvaluator converts the dataset to coco json once and caches it.
+    """
+    DatasetCatalog.register(name, lambda: load_columnar_instances(dirname, image_root, name))
+    MetadataCatalog.get(name).set(columnar_dir=dirname, image_root=image_root, evaluator_type='coco', **metadata)
 
 # NOTICE: ILSVRC 2016 DET = ILSVRC 2015 DET = ILSVRC 2014 DET + ILSVRC 2013 DET
 
-# VIDOR
-register_coco_instances(
-    'vidor_train_16',
-    {},
-    'datasets/vidor/d2_train_16.json',
-    'datasets/vidor/frames@16'
-)
-register_coco_instances(
-    'vidor_test_16',
-    {},
-    'datasets/vidor/d2_test_16.json',
-    'datasets/vidor/frames@16'
-)
-register_coco_instances(
-    'vidor_train_32',
-    {},
-    'datasets/vidor/d2_train_32.json',
-    'datasets/vidor/frames@32'
-)
-register_coco_instances(
-    'vidor_test_32',
-    {},
-    'datasets/vidor/d2_test_32.json',
-    'datasets/vidor/frames@32'
-)
-register_coco_instances(
-    'vidor_train_64',
-    {},
-    'datasets/vidor/d2_train_64.json',
-    'datasets/vidor/frames@64'
-)
-register_coco_instances(
-    'vidor_test_64',
-    {},
-    'datasets/vidor/d2_test_64.json',
-    'datasets/vidor/frames@64'
-)
-
-# MS-COCO-VIDOR
-register_coco_instances(
-    'vidor_coco_train',
-    {},
-    'datasets/coco/train_vidor.json',
-    'datasets/coco/train2014'
-)
-register_coco_instances(
-    'vidor_coco_val_minus_minival',
-    {},
-    'datasets/coco/val_minus_minival_vidor.json',
-    'datasets/coco/val2014'
-)
-
-# ILSVRC-VIDOR
-register_coco_instances(
-    'vidor_ilsvrc_train2013',
-    {},
-    'datasets/ILSVRC2015/train_2013_vidor.json',
-    'datasets/ILSVRC2015/Data/DET/train/ILSVRC2013_train'
-)
-register_coco_instances(
-    'vidor_ilsvrc_train2014',
-    {},
-    'datasets/ILSVRC2015/train_2014_vidor.json',
-    'datasets/ILSVRC2015/Data/DET/train'
-)
\ No newline at end of file
+# name: (annotation file, image root)
+SPLITS = {
+    # VIDOR
+    'vidor_train_16': ('datasets/vidor/d2_train_16.json', 'datasets/vidor/frames@16'),
+    'vidor_test_16': ('datasets/vidor/d2_test_16.json', 'datasets/vidor/frames@16'),
+    'vidor_train_32': ('datasets/vidor/d2_train_32.json', 'datasets/vidor/frames@32'),
+    'vidor_test_32': ('datasets/vidor/d2_test_32.json', 'datasets/vidor/frames@32'),
+    'vidor_train_64': ('datasets/vidor/d2_train_64.json', 'datasets/vidor/frames@64'),
+    'vidor_test_64': ('datasets/vidor/d2_test_64.json', 'datasets/vidor/frames@64'),
+    # motion-aware sampling (extract_frames.py --sampling motion --budget 0.25), train only
+    'vidor_train_16_motion': ('datasets/vidor/d2_train_16-motion0.25.json', 'datasets/vidor/frames@16-motion0.25'),
+    # MS-COCO-VIDOR
+    'vidor_coco_train': ('datasets/coco/train_vidor.json', 'datasets/coco/train2014'),
+    'vidor_coco_val_minus_minival': ('datasets/coco/val_minus_minival_vidor.json', 'datasets/coco/val2014'),
+    # ILSVRC-VIDOR
+    'vidor_ilsvrc_train2013': (
+        'datasets/ILSVRC2015/train_2013_vidor.json',
+        'datasets/ILSVRC2015/Data/DET/train/ILSVRC2013_train'
+    ),
+    'vidor_ilsvrc_train2014': ('datasets/ILSVRC2015/train_2014_vidor.json', 'datasets/ILSVRC2015/Data/DET/train'),
+}
+
+# registering is cheap, no annotation file is read before a split is used
+for name, (json_file, image_root) in SPLITS.items():
+    register_cached_coco_instances(name, {}, json_file, image_root)
+    # same annotations in the columnar store (--format columnar), e.g. vidor_train_16_columnar
+    register_columnar_instances(name + '_columnar', {}, columnar_dirname(json_file), image_root)
+
+# VIDOR (packed frames, extract_frames.py --pack)
+for split in ['train', 'test']:
+    for frequency in [16, 32, 64]:
+        register_shard_instances(
+            'vidor_{}_{}_packed'.format(split, frequency),
+            {},
+            'datasets/vidor/d2_{}_{}.json'.format(split, frequency),
+            'datasets/vidor/frames@{}'.format(frequency)
+        )
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2021-01-24
+# @Author  : Yifer Huang
+# @File    : mapper.py
+# @Desc    : dataset mappers
+
+import copy
+
+import numpy as np
+import torch
+from detectron2.config import configurable
+from detectron2.data import DatasetMapper
+from detectron2.data import detection_utils as utils
+from detectron2.data import transforms as T
+
+
+def resized_shape(height, width, short_edge, max_size):
+    """output shape of ResizeShortestEdge for the given short edge"""
+    scale = short_edge * 1.0 / min(height, width)
+    if height < width:
+        new_height, new_width = short_edge, scale * width
+    else:
+        new_height, new_width = scale * height, short_edge
+    if max(new_height, new_width) > max_size:
+        scale = max_size * 1.0 / max(new_height, new_width)
+        new_height, new_width = new_height * scale, new_width * scale
+    return int(new_height + 0.5), int(new_width + 0.5)
+
+
+class CachedDatasetMapper(DatasetMapper):
+    """DatasetMapper which reads frames already resized to one of the INPUT.MIN_SIZE_TRAIN
+    scales from a FrameCache (see datasets/cache.py), instead of decoding and resizing
+    the JPEG every epoch. The ResizeShortestEdge augmentation is replaced by picking
+    the scale up front, the remaining augmentations (flip) run as usual.
+
+    Only boxes are supported: configs with masks, keypoints, precomputed proposals or
+    cropping (which must run before the resize) are rejected.
+    """
+    @configurable
+    def __init__(self, is_train=True, *, cache, **kwargs):
+        super().__init__(is_train, **kwargs)
+        assert not self.use_instance_mask, 'CachedDatasetMapper does not support masks'
+        assert not self.use_keypoint, 'CachedDatasetMapper does not support keypoints'
+        assert self.proposal_topk is None, 'CachedDatasetMapper does not support precomputed proposals'
+        self.cache = cache
+        augs = self.augmentations.augs
+        crops = [aug for aug in augs if isinstance(aug, (T.RandomCrop, T.RandomCrop_CategoryAreaConstraint))]
+        assert not crops, 'CachedDatasetMapper resizes before the augmentations, crop is not supported'
+        resizes = [aug for aug in augs if isinstance(aug, T.ResizeShortestEdge)]
+        assert len(resizes) == 1, 'expect exactly one ResizeShortestEdge, got {}'.format(augs)
+        self.resize = resizes[0]
+        self.augmentations = T.AugmentationList([aug for aug in augs if aug is not self.resize])
+
+    @classmethod
+    def from_config(cls, cfg, is_train=True, cache=None):
+        ret = super().from_config(cfg, is_train)
+        ret['cache'] = cache
+        return ret
+
+    def _short_edge(self):
+        if self.resize.is_range:
+            return np.random.randint(self.resize.short_edge_length[0], self.resize.short_edge_length[1] + 1)
+        return np.random.choice(self.resize.short_edge_length)
+
+    def __call__(self, dataset_dict):
+        dataset_dict = copy.deepcopy(dataset_dict)  # it will be modified by code below
+        height, width = dataset_dict['height'], dataset_dict['width']
+        shape = resized_shape(height, width, self._short_edge(), self.resize.max_size)
+        resize = T.ResizeTransform(height, width, shape[0], shape[1], self.resize.interp)
+
+        def load():
+            image = utils.read_image(dataset_dict['file_name'], format=self.image_format)
+            utils.check_image_size(dataset_dict, image)
+            return resize.apply_image(image)
+
+        image = self.cache.get(dataset_dict['file_name'], shape, load)
+        aug_input = T.AugInput(image)
+        transforms = T.TransformList([resize] + self.augmentations(aug_input).transforms)
+        image = aug_input.image
+        image_shape = image.shape[:2]  # h, w
+        dataset_dict['image'] = torch.as_tensor(np.ascontiguousarray(image.transpose(2, 0, 1)))
+
+        if not self.is_train:
+            dataset_dict.pop('annotations', None)
+            return dataset_dict
+
+        if 'annotations' in dataset_dict:
+            for anno in dataset_dict['annotations']:  # MASK_ON/KEYPOINT_ON are off
+                anno.pop('segmentation', None)
+                anno.pop('keypoints', None)
+            annos = [
+                utils.transform_instance_annotations(obj, transforms, image_shape)
+                for obj in dataset_dict.pop('annotations')
+                if obj.get('iscrowd', 0) == 0
+            ]
+            instances = utils.annotations_to_instances(annos, image_shape)
+            dataset_dict['instances'] = utils.filter_empty_instances(instances)
+        return dataset_dict
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2021-02-03
+# @Author  : Yifer Huang
+# @File    : sampler.py
+# @Desc    : weighted multi-source training sampler
+
+import itertools
+import logging
+import os
+import re
+
+import numpy as np
+from torch.utils.data import Sampler
+
+from detectron2.utils import comm
+from engine.boxes import near_duplicate
+
+# vidor frames: {video_id}_{frame_index:04d}.jpg, COCO and ILSVRC file names do not match
+FRAME_PATTERN = re.compile(r'^(\d+)_(\d{4,})\.jpg$')
+
+
+def _boxes(dataset_dict):
+    annotations = [anno for anno in dataset_dict.get('annotations', []) if not anno.get('iscrowd', 0)]
+    boxes = np.asarray([anno['bbox'] for anno in annotations], dtype=np.float32).reshape(-1, 4)
+    if len(annotations) > 0 and annotations[0].get('bbox_mode', 1) == 1:    # XYWH_ABS
+        boxes[:, 2:] += boxes[:, :2]
+    return boxes, np.asarray([anno['category_id'] for anno in annotations], dtype=np.int64)
+
+
+class WeightedSourceSampler(Sampler):
+    """infinite training sampler over several concatenated datasets (DATASETS.TRAIN),
+    replacing TrainingSampler's uniform draw over the concatenation
+
+    Every epoch (all ranks compute the same one from the shared seed):
+
+    1. video frames (vidor file names) that are near duplicates of the previous kept
+       frame of their video are dropped once, see `near_duplicate`
+    2. each video keeps every `frame_stride`-th of its frames, from a random phase per
+       video and epoch, so adjacent frames are not drawn together but all are used
+    3. each source contributes weights[s] of the epoch's images, drawn without
+       replacement (repeated when its pool is too small)
+    4. images are split into aspect ratio bins, shuffled within a bin and cut into
+       batches of `batch_size`, whose order is shuffled; rank r takes batches
+       r, r + world_size, ...
+
+    Each rank yields its batches back to back, so with batch_size the per-GPU batch
+    size and bins split at 1.0, detectron2's AspectRatioGroupedDataset (or a plain
+    BatchSampler) forms exactly these batches.
+
+    Args:
+        dataset_dicts (sequence): merged dataset dicts, each with `source`, the index of
+            its dataset, plus height, width and annotations
+        batch_size (int): images per batch and GPU
+        weights (list): fraction of the images drawn from each source, None for
+            proportional to the sources' sizes (after dedup and stride)
+        frame_stride (int): keep 1 of every frame_stride frames of a video per epoch
+        dedup_iou (float): IoU of a near duplicate frame, 0 keeps all frames
+        aspect_ratio_bins (list): increasing width / height bin edges
+        seed (int): None for a random seed shared by all ranks
+    """
+    def __init__(self, dataset_dicts, batch_size, weights=None, frame_stride=1, dedup_iou=0.,
+                 aspect_ratio_bins=(1.0, ), seed=None):
+        assert frame_stride >= 1
+        self.batch_size = batch_size
+        self.frame_stride = frame_stride
+        self.seed = int(comm.shared_random_seed() if seed is None else seed)
+        self.rank, self.world_size = comm.get_rank(), comm.get_world_size()
+
+        size = len(dataset_dicts)
+        self.sources = np.zeros(size, dtype=np.int64)
+        ratios = np.zeros(size, dtype=np.float32)
+        videos = np.full(size, -1, dtype=np.int64)
+        frames = np.zeros(size, dtype=np.int64)
+        keep = np.ones(size, dtype=bool)
+        last_kept = dict()     # video -> (frame index, boxes, categories) of its last kept frame
+        for i in range(size):
+            dataset_dict = dataset_dicts[i]
+            self.sources[i] = dataset_dict['source']
+            ratios[i] = dataset_dict['width'] / dataset_dict['height']
+            match = FRAME_PATTERN.match(os.path.basename(dataset_dict['file_name']))
+            if match is None:
+                continue
+            videos[i], frames[i] = int(match.group(1)), int(match.group(2))
+            if dedup_iou <= 0:
+                continue
+            boxes, categories = _boxes(dataset_dict)
+            previous = last_kept.get(videos[i])
+            # the records of a video come in frame order, like vidor_annotator writes them
+            if previous is not None and previous[0] < frames[i] and \
+                    near_duplicate(previous[1], previous[2], boxes, categories, dedup_iou):
+                keep[i] = False
+            else:
+                last_kept[videos[i]] = (frames[i], boxes, categories)
+
+        self.num_sources = int(self.sources.max()) + 1 if size > 0 else 0
+        self.bins = np.digitize(ratios, aspect_ratio_bins, right=True)
+        self.indices = np.nonzero(keep)[0]
+        # position of each kept frame within its video, for the per-epoch stride
+        order = np.lexsort((frames[self.indices], videos[self.indices]))
+        sorted_videos = videos[self.indices][order]
+        starts = np.r_[0, np.nonzero(np.diff(sorted_videos))[0] + 1]
+        positions = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+        self.positions = np.zeros(len(order), dtype=np.int64)
+        self.positions[order] = positions
+        self.videos = videos[self.indices]
+        self.weights = None if weights is None or len(weights) == 0 else np.asarray(weights, dtype=np.float64)
+        assert self.weights is None or len(self.weights) == self.num_sources, \
+            'expect one weight per dataset of DATASETS.TRAIN, got {}'.format(weights)
+
+        logger = logging.getLogger(__name__)
+        kept = np.bincount(self.sources[self.indices], minlength=self.num_sources)
+        total = np.bincount(self.sources, minlength=self.num_sources)
+        logger.info('WeightedSourceSampler: images kept after dedup per source: {}, {} videos, frame stride {}, '
+                    'weights {}'.format(', '.join('{}/{}'.format(k, t) for k, t in zip(kept, total)),
+                                        len(np.unique(self.videos[self.videos >= 0])), frame_stride,
+                                        'proportional' if self.weights is None else self.weights.tolist()))
+
+    def _epoch(self, rng):
+        """batches of this rank for one epoch"""
+        indices = self.indices
+        if self.frame_stride > 1:
+            _, video_ids = np.unique(self.videos, return_inverse=True)
+            phases = rng.randint(self.frame_stride, size=video_ids.max() + 1 if len(video_ids) > 0 else 0)
+            eligible = (self.videos < 0) | ((self.positions + phases[video_ids]) % self.frame_stride == 0)
+            indices = indices[eligible]
+        sources = self.sources[indices]
+        pools = [indices[sources == source] for source in range(self.num_sources)]
+
+        if self.weights is None:
+            chosen = [rng.permutation(pool) for pool in pools]
+        else:
+            weights = self.weights / self.weights[[len(pool) > 0 for pool in pools]].sum()
+            counts = np.round(weights * len(indices)).astype(np.int64)
+            chosen = list()
+            for pool, count in zip(pools, counts):
+                if len(pool) == 0:
+                    continue
+                repeats, rest = divmod(count, len(pool))
+                chosen.append(np.concatenate([np.tile(pool, repeats), rng.choice(pool, rest, replace=False)]))
+        chosen = np.concatenate(chosen) if len(chosen) > 0 else np.zeros(0, dtype=np.int64)
+
+        batches = list()
+        bins = self.bins[chosen]
+        for value in np.unique(bins):
+            members = rng.permutation(chosen[bins == value])
+            num_batches = len(members) // self.batch_size
+            batches.extend(members[:num_batches * self.batch_size].reshape(num_batches, self.batch_size))
+        # every rank runs the same number of iterations
+        num_batches = len(batches) // self.world_size * self.world_size
+        order = rng.permutation(len(batches))[:num_batches]
+        return [batches[i] for i in order[self.rank::self.world_size]]
+
+    def __iter__(self):
+        for epoch in itertools.count():
+            rng = np.random.RandomState((self.seed + epoch) % 2 ** 32)
+            batches = self._epoch(rng)
+            assert len(batches) > 0, 'no complete batch in an epoch, too few images or too many bins'
+            for batch in batches:
+                yield from batch.tolist()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2021-01-27
+# @Author  : Yifer Huang
+# @File    : serialize.py
+# @Desc    : dataset dicts packed into one memory-mapped byte buffer
+
+import errno
+import fcntl
+import os
+import pickle
+
+import numpy as np
+
+# .{path}.bin                   # pickled records, concatenated
+# .{path}.offsets.npy           # int64 [N + 1], record i is bin[offsets[i]:offsets[i + 1]]
+
+class PackedRecords(object):
+    """read-only sequence of records (dataset dicts) pickled into one file and
+    memory-mapped, records are unpickled on access
+
+    Unlike a list of dicts, it holds no Python objects, so forked data loader workers
+    do not turn it into private memory through refcount updates, and every process
+    which maps the same file shares its pages through the page cache.
+
+    Args:
+        path (str): path prefix of the .bin and .offsets.npy files, see `dump`
+    """
+    def __init__(self, path):
+        self.path = path
+        self.offsets = np.load(path + '.offsets.npy', mmap_mode='r')
+        if self.offsets[-1] > 0:
+            self.data = np.memmap(path + '.bin', dtype=np.uint8, mode='r')
+        else:
+            self.data = np.zeros(0, dtype=np.uint8)
+
+    @staticmethod
+    def dump(records, path):
+        """pickle records one by one into path.bin, memory stays bounded by one record;
+        both files are written under temporary names and renamed, offsets last
+        """
+        offsets = [0]
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(temp_path + '.bin', 'wb') as f:
+                for record in records:
+                    data = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+                    f.write(data)
+                    offsets.append(offsets[-1] + len(data))
+            np.save(temp_path + '.offsets.npy', np.asarray(offsets, dtype=np.int64))
+        except BaseException:   # e.g. ENOSPC, do not leave a partial file in RAM-backed /dev/shm
+            for suffix in ('.bin', '.offsets.npy'):
+                if os.path.exists(temp_path + suffix):
+                    os.remove(temp_path + suffix)
+            raise
+        os.replace(temp_path + '.bin', path + '.bin')
+        os.replace(temp_path + '.offsets.npy', path + '.offsets.npy')
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(path + '.offsets.npy')
+
+    @staticmethod
+    def build(load, path):
+        """PackedRecords of path, dumping load() there first unless it exists
+
+        Concurrent processes (ranks of a node, several runs) build it once: the first one
+        calls load() under an exclusive file lock, the others wait for it and only map
+        the result.
+        """
+        if not PackedRecords.exists(path):
+            dirname = os.path.dirname(path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            with open(path + '.lock', 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if not PackedRecords.exists(path):
+                    PackedRecords.dump(load(), path)
+        return PackedRecords(path)
+
+    @staticmethod
+    def remove_stale(dirname, keep, prefix=''):
+        """remove the records under dirname other than `keep` (a path as for build), e.g.
+        those of older configs or annotation files; records being built by another
+        process (lock held) are left alone, mapped ones stay readable until unmapped
+
+        Only records whose name starts with `prefix` are considered, e.g. one dataset's.
+
+        The .lock files are kept: a builder may already hold the old one open, and a
+        new process must lock the same inode, not a fresh file, see `build`.
+
+        Returns:
+            int: number of removed records
+        """
+        keep = os.path.basename(keep)
+        prefixes = set(name.split('.')[0] for name in os.listdir(dirname) if name.startswith(prefix)) - {keep}
+        removed = 0
+        for prefix in sorted(prefixes):
+            with open(os.path.join(dirname, prefix + '.lock'), 'a') as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                names = [name for name in os.listdir(dirname)
+                         if name.split('.')[0] == prefix and name != prefix + '.lock']
+                for name in names:
+                    os.remove(os.path.join(dirname, name))
+            removed += len(names) > 0
+        return removed
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        start, end = int(self.offsets[index]), int(self.offsets[index + 1])
+        return pickle.loads(self.data[start:end].tobytes())
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+def free_bytes(dirname):
+    """bytes available to us in dirname, created if missing, 0 if it cannot be"""
+    try:
+        os.makedirs(dirname, exist_ok=True)
+        stat = os.statvfs(dirname)
+    except OSError:
+        return 0
+    return stat.f_bavail * stat.f_frsize
+
+
+def build_packed(load, dirnames, name, min_free=0):
+    """PackedRecords.build of {dirname}/{name} in the first of dirnames which already holds
+    it or has min_free bytes available, e.g. /dev/shm first and a disk directory after it;
+    a directory running out of space while the records are written is skipped as well
+
+    Returns:
+        tuple: (PackedRecords, path)
+    """
+    for i, dirname in enumerate(dirnames):
+        path = os.path.join(dirname, name)
+        last = i == len(dirnames) - 1
+        if not last and not PackedRecords.exists(path) and free_bytes(dirname) < min_free:
+            continue
+        try:
+            return PackedRecords.build(load, path), path
+        except OSError as e:
+            if e.errno != errno.ENOSPC or last:
+                raise
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2021-01-24
+# @Author  : Yifer Huang
+# @File    : shards.py
+# @Desc    : packed per-video frame shards (tar + offset index)
+
+import collections
+import io
+import json
+import os
+import tarfile
+import threading
+
+# .frames@{frequency}
+# ├── 2401075277.tar            # plain tar, `tar tf` lists {video_id}_{frame_index:04d}.jpg
+# └── 2401075277.idx.json       # {basename: [offset, size]} of each member's data in the tar
+
+def shard_filename(frames_dir, video_id):
+    return os.path.join(frames_dir, '{}.tar'.format(video_id))
+
+def index_filename(frames_dir, video_id):
+    return os.path.join(frames_dir, '{}.idx.json'.format(video_id))
+
+def video_of(basename):
+    """2401075277_0016.jpg -> 2401075277"""
+    return basename.rsplit('_', 1)[0]
+
+class ShardWriter(object):
+    """write the frames of one video into a tar shard, thread-safe
+
+    The tar is written under a temporary name and renamed on close, the index is
+    written after it, so an existing index always points into a complete shard.
+    Frames added with a sequence number are written in that order, whichever thread
+    finishes first, so the same frames always give the same tar bytes.
+
+    Args:
+        frames_dir (string): directory to store shards
+        video_id (string): video the frames belong to
+    """
+    def __init__(self, frames_dir, video_id):
+        self.filename = shard_filename(frames_dir, video_id)
+        self.index_filename = index_filename(frames_dir, video_id)
+        self.temp_filename = '{}.{}.tmp'.format(self.filename, os.getpid())
+        self.tar = tarfile.open(self.temp_filename, 'w', format=tarfile.USTAR_FORMAT)
+        self.index = dict()
+        self.pending = dict()   # sequence number -> (basename, data) waiting for earlier frames
+        self.next_seq = 0
+        self.lock = threading.Lock()
+
+    def _write(self, basename, data):
+        info = tarfile.TarInfo(basename)
+        info.size = len(data)
+        offset = self.tar.offset + len(info.tobuf(self.tar.format, self.tar.encoding, self.tar.errors))
+        self.tar.addfile(info, io.BytesIO(data))
+        self.index[basename] = [offset, info.size]
+
+    def add(self, basename, data, seq=None):
+        """append a frame, or with `seq` (0, 1, 2, ... over all frames) hold it back until
+        the frames before it are written"""
+        with self.lock:
+            if seq is None:
+                self._write(basename, data)
+                return
+            self.pending[seq] = (basename, data)
+            while self.next_seq in self.pending:
+                self._write(*self.pending.pop(self.next_seq))
+                self.next_seq += 1
+
+    def abort(self):
+        """drop the unfinished shard, a previous complete one (if any) is left untouched"""
+        try:
+            self.tar.close()
+        finally:
+            if os.path.exists(self.temp_filename):
+                os.remove(self.temp_filename)
+
+    def close(self):
+        assert len(self.pending) == 0, 'frames {} of {} were never added'.format(self.next_seq, self.filename)
+        self.tar.close()
+        os.replace(self.temp_filename, self.filename)
+        temp_filename = '{}.{}.tmp'.format(self.index_filename, os.getpid())
+        with open(temp_filename, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(temp_filename, self.index_filename)
+
+class ShardReader(object):
+    """O(1) random access to the frames of a shard
+
+    Reads go through os.pread on a descriptor opened lazily per process, so a reader
+    may be shared by threads and survives forking into data loader workers.
+    """
+    def __init__(self, frames_dir, video_id):
+        self.filename = shard_filename(frames_dir, video_id)
+        with open(index_filename(frames_dir, video_id), 'r') as f:
+            self.index = json.load(f)
+        self.fd = None
+        self.pid = None
+
+    def __contains__(self, basename):
+        return basename in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def read(self, basename):
+        if self.pid != os.getpid():
+            self.fd = os.open(self.filename, os.O_RDONLY)
+            self.pid = os.getpid()
+        offset, size = self.index[basename]
+        return os.pread(self.fd, size, offset)
+
+    def close(self):
+        if self.fd is not None and self.pid == os.getpid():
+            os.close(self.fd)
+        self.fd = None
+
+    @staticmethod
+    def exists(frames_dir, video_id):
+        return os.path.exists(index_filename(frames_dir, video_id))
+
+_readers = collections.OrderedDict()    # (frames_dir, video_id) -> ShardReader, LRU
+_readers_lock = threading.Lock()
+MAX_OPEN_SHARDS = 256
+
+def get_reader(frames_dir, video_id):
+    """cached ShardReader, keeps at most MAX_OPEN_SHARDS descriptors open per process"""
+    key = (frames_dir, video_id)
+    with _readers_lock:
+        reader = _readers.pop(key, None)
+        if reader is None:
+            reader = ShardReader(frames_dir, video_id)
+        _readers[key] = reader
+        while len(_readers) > MAX_OPEN_SHARDS:
+            _readers.popitem(last=False)[1].close()
+    return reader
+
+def read_frame(frames_dir, basename):
+    """bytes of a packed frame, e.g. read_frame('datasets/vidor/frames@16', '2401075277_0016.jpg')"""
+    return get_reader(frames_dir, video_of(basename)).read(basename)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2021-01-25
+# @Author  : Yifer Huang
+# @File    : writer.py
+# @Desc    : streaming coco-style annotation writer
+
+import os
+import shutil
+
+try:
+    import orjson
+
+    def dumps(obj):
+        return orjson.dumps(obj)
+except ImportError:
+    import json
+
+    def dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+
+def coco_header(src, categories):
+    """everything of a coco-style annotation file but images and annotations
+
+    Args:
+        src (str): dataset type, key of coco_info
+        categories (list): categories
+    """
+    from datasets.vocab import coco_liscenses, coco_info
+    return {
+        'info': coco_info[src],
+        'type': 'instances',
+        'liscenses': coco_liscenses,
+        'categories': categories,
+    }
+
+class CocoWriter(object):
+    """write a coco-style annotation file while images and annotations are produced,
+    instead of collecting every dict and calling json.dump once
+
+    Images and annotations are streamed to two temporary files next to `filename`,
+    close() concatenates them into the final file under a temporary name and renames
+    it, so memory stays bounded and a crash never leaves a truncated annotation file.
+    Uses orjson when installed.
+
+    Args:
+        filename (str): annotation filename
+        header (dict): see `coco_header`
+    """
+    def __init__(self, filename, header):
+        self.filename = filename
+        self.header = header
+        self.temp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+        self.parts = {
+            'images': open(self.temp_filename + '.images', 'wb'),
+            'annotations': open(self.temp_filename + '.annotations', 'wb'),
+        }
+        self.counts = {'images': 0, 'annotations': 0}
+
+    def _add(self, part, item):
+        if self.counts[part] > 0:
+            self.parts[part].write(b',')
+        self.parts[part].write(dumps(item))
+        self.counts[part] += 1
+
+    def add_image(self, image):
+        self._add('images', image)
+
+    def add_images(self, images):
+        for image in images:
+            self._add('images', image)
+
+    def add_annotation(self, annotation):
+        self._add('annotations', annotation)
+
+    def add_annotations(self, annotations):
+        for annotation in annotations:
+            self._add('annotations', annotation)
+
+    def close(self):
+        try:
+            with open(self.temp_filename, 'wb') as f:
+                f.write(dumps(self.header)[:-1])    # without the closing brace
+                for name, part in self.parts.items():
+                    part.close()
+                    f.write(b',"' + name.encode('utf-8') + b'":[')
+                    with open(part.name, 'rb') as p:
+                        shutil.copyfileobj(p, f)
+                    f.write(b']')
+                f.write(b'}')
+            os.replace(self.temp_filename, self.filename)
+        except BaseException:
+            if os.path.exists(self.temp_filename):
+                os.remove(self.temp_filename)
+            raise
+        finally:
+            for part in self.parts.values():
+                part.close()
+                if os.path.exists(part.name):
+                    os.remove(part.name)
+        print('>>> Successfully export {} images and {} annotations to {}'.format(
+            self.counts['images'], self.counts['annotations'], self.filename))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        for part in self.parts.values():    # keep the previous annotation file on errors
+            part.close()
+            if os.path.exists(part.name):
+                os.remove(part.name)
+
+def open_annotation_writer(filename, header, anno_format='coco'):
+    """CocoWriter for coco json, ColumnarWriter (datasets/columnar.py) for the columnar
+    store, which is written next to `filename` (d2_train_16.json -> d2_train_16.columnar)
+    """
+    if anno_format == 'columnar':
+        from datasets.columnar import ColumnarWriter, columnar_dirname
+        return ColumnarWriter(columnar_dirname(filename), header)
+    return CocoWriter(filename, header)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2021-02-04
+# @Author  : Yifer Huang
+# @File    : boxes.py
+# @Desc    : box IoU and matching helpers, shared by the tracker, sampler and frame extraction
+
+import numpy as np
+
+
+def iou_matrix(boxes1, boxes2):
+    """pairwise IoU of two sets of xyxy boxes
+
+    Args:
+        boxes1 (ndarray): [N, 4]
+        boxes2 (ndarray): [M, 4]
+
+    Returns:
+        ndarray: [N, M]
+    """
+    lt = np.maximum(boxes1[:, None, :2], boxes2[None, :, :2])
+    rb = np.minimum(boxes1[:, None, 2:], boxes2[None, :, 2:])
+    wh = np.clip(rb - lt, 0, None)
+    inter = wh[..., 0] * wh[..., 1]
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    union = area1[:, None] + area2[None, :] - inter
+    return inter / np.maximum(union, 1e-9)
+
+
+def _hungarian(cost):
+    """minimum cost assignment of every row of cost ([N, M], N <= M) to a distinct column,
+    shortest augmenting paths with potentials, O(N^2 M); used without scipy
+
+    Returns:
+        tuple: (rows, cols) index arrays, rows increasing
+    """
+    n, m = cost.shape
+    u, v = np.zeros(n + 1), np.zeros(m + 1)
+    owner = np.zeros(m + 1, dtype=np.int64)    # 1-based row assigned to column j, 0 for none
+    way = np.zeros(m + 1, dtype=np.int64)
+    for i in range(1, n + 1):
+        owner[0], j0 = i, 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = owner[j0]
+            free = ~used[1:]
+            reduced = cost[i0 - 1] - u[i0] - v[1:]
+            better = free & (reduced < minv[1:])
+            minv[1:][better] = reduced[better]
+            way[1:][better] = j0
+            candidates = np.where(free, minv[1:], np.inf)
+            j1 = int(np.argmin(candidates)) + 1
+            delta = candidates[j1 - 1]
+            columns = np.nonzero(used)[0]
+            u[owner[columns]] += delta
+            v[columns] -= delta
+            minv[1:][free] -= delta
+            j0 = j1
+            if owner[j0] == 0:  break
+        while j0 != 0:
+            j1 = way[j0]
+            owner[j0] = owner[j1]
+            j0 = j1
+    cols = np.nonzero(owner[1:])[0]
+    rows = owner[1:][cols] - 1
+    order = np.argsort(rows)
+    return rows[order], cols[order]
+
+
+def assign(affinity, threshold):
+    """one-to-one matching with the most pairs of affinity >= threshold, and among those
+    the highest total affinity
+
+    Pairs below threshold are made infeasible before solving (a cost larger than any
+    total affinity), so they never displace a feasible pair. Uses scipy's
+    linear_sum_assignment when installed, otherwise `_hungarian`; both find the optimum.
+
+    Args:
+        affinity (ndarray): [N, M]
+        threshold (float): minimum affinity of a match
+
+    Returns:
+        tuple: (rows, cols) index arrays of the matches
+    """
+    if affinity.size == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    feasible = affinity >= threshold
+    infeasible = min(affinity.shape) * (float(np.abs(affinity).max()) + 1) + 1
+    cost = np.where(feasible, -affinity, infeasible).astype(np.float64)
+    # imported on first use, scipy.optimize costs frame extraction ~0.3s and ~40 MB per process
+    try:
+        from scipy.optimize import linear_sum_assignment
+    except ImportError:
+        linear_sum_assignment = None
+    if linear_sum_assignment is not None:
+        rows, cols = linear_sum_assignment(cost)
+    elif cost.shape[0] <= cost.shape[1]:
+        rows, cols = _hungarian(cost)
+    else:
+        cols, rows = _hungarian(cost.T)
+        order = np.argsort(rows)
+        rows, cols = rows[order], cols[order]
+    keep = feasible[rows, cols]
+    return rows[keep].astype(np.int64), cols[keep].astype(np.int64)
+
+
+def near_duplicate(boxes1, categories1, boxes2, categories2, threshold):
+    """whether two frames carry the same objects at nearly the same place: same
+    categories (or track ids) and a one-to-one matching (same category) with IoU >= threshold
+
+    Args:
+        boxes1 (ndarray): [N, 4] xyxy boxes
+        categories1 (ndarray): [N]
+    """
+    if len(boxes1) != len(boxes2) or sorted(categories1) != sorted(categories2):
+        return False
+    affinity = iou_matrix(boxes1, boxes2)
+    affinity[categories1[:, None] != categories2[None, :]] = 0
+    rows, _ = assign(affinity, threshold)
+    return len(rows) == len(boxes1)
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2021-01-31
+# @Author  : Yifer Huang
+# @File    : cocoeval.py
+# @Desc    : vectorized coco bbox evaluation (pycocotools COCOeval semantics)
+
+import multiprocessing
+
+import numpy as np
+
+IOU_THRESHOLDS = np.linspace(.5, 0.95, int(np.round((0.95 - .5) / .05)) + 1, endpoint=True)
+RECALL_THRESHOLDS = np.linspace(.0, 1.00, int(np.round((1.00 - .0) / .01)) + 1, endpoint=True)
+MAX_DETS = (1, 10, 100)
+AREA_RANGES = ((0 ** 2, 1e5 ** 2), (0 ** 2, 32 ** 2), (32 ** 2, 96 ** 2), (96 ** 2, 1e5 ** 2))    # all, small, medium, large
+CHUNK_ELEMENTS = 1 << 22    # bound of pairs * areas * thresholds * (G + D) per matching chunk
+
+
+def box_iou(dt_boxes, gt_boxes, gt_crowd):
+    """IoU of xywh boxes like pycocotools' maskUtils.iou, crowd ground truth is divided
+    by the detection area only
+
+    Args:
+        dt_boxes (ndarray): [..., D, 4]
+        gt_boxes (ndarray): [..., G, 4]
+        gt_crowd (ndarray): [..., G] bool
+
+    Returns:
+        ndarray: [..., D, G]
+    """
+    dt_x1, dt_y1 = dt_boxes[..., :, None, 0], dt_boxes[..., :, None, 1]
+    dt_x2, dt_y2 = dt_x1 + dt_boxes[..., :, None, 2], dt_y1 + dt_boxes[..., :, None, 3]
+    gt_x1, gt_y1 = gt_boxes[..., None, :, 0], gt_boxes[..., None, :, 1]
+    gt_x2, gt_y2 = gt_x1 + gt_boxes[..., None, :, 2], gt_y1 + gt_boxes[..., None, :, 3]
+    w = np.clip(np.minimum(dt_x2, gt_x2) - np.maximum(dt_x1, gt_x1), 0, None)
+    h = np.clip(np.minimum(dt_y2, gt_y2) - np.maximum(dt_y1, gt_y1), 0, None)
+    inter = w * h
+    dt_area = dt_boxes[..., :, None, 2] * dt_boxes[..., :, None, 3]
+    gt_area = gt_boxes[..., None, :, 2] * gt_boxes[..., None, :, 3]
+    union = np.where(gt_crowd[..., None, :], dt_area, dt_area + gt_area - inter)
+    return np.where(union > 0, inter / np.where(union > 0, union, 1), 0)
+
+
+def _group(keys, size):
+    """start offsets of runs of equal keys in sorted order"""
+    starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]])) if size > 0 else np.zeros(0, np.int64)
+    return starts, np.append(starts[1:], size)
+
+
+def match_chunk(dt_boxes, dt_valid, dt_area, gt_boxes, gt_valid, gt_area, gt_crowd):
+    """greedy matching of COCOeval.evaluateImg for a batch of (image, category) pairs,
+    all area ranges and IoU thresholds at once
+
+    Detections are sorted by score, padding is marked invalid. For each detection, the
+    best available non-ignored ground truth above the threshold wins, an ignored one
+    only if there is none (crowd ground truth can be matched repeatedly), ties go to the
+    later ground truth in annotation order, exactly like the Python loops of pycocotools.
+
+    Args:
+        dt_boxes (ndarray): [P, D, 4] xywh
+        dt_valid (ndarray): [P, D] bool
+        dt_area (ndarray): [P, D]
+        gt_boxes (ndarray): [P, G, 4] xywh
+        gt_valid (ndarray): [P, G] bool
+        gt_area (ndarray): [P, G] annotation areas
+        gt_crowd (ndarray): [P, G] bool
+
+    Returns:
+        tuple: dt_matched [P, A, T, D], dt_ignore [P, A, T, D], gt_ignore [P, A, G]
+    """
+    P, D, G = dt_valid.shape[0], dt_valid.shape[1], gt_valid.shape[1]
+    A, T = len(AREA_RANGES), len(IOU_THRESHOLDS)
+    lo = np.asarray([r[0] for r in AREA_RANGES])[None, :, None]
+    hi = np.asarray([r[1] for r in AREA_RANGES])[None, :, None]
+    gt_ignore = gt_crowd[:, None, :] | (gt_area[:, None, :] < lo) | (gt_area[:, None, :] > hi)     # [P, A, G]
+    dt_outside = (dt_area[:, None, :] < lo) | (dt_area[:, None, :] > hi)     # [P, A, D]
+    dt_matched = np.zeros((P, A, T, D), dtype=bool)
+    dt_ignore = np.zeros((P, A, T, D), dtype=bool)
+    if G > 0:
+        ious = box_iou(dt_boxes, gt_boxes, gt_crowd)    # [P, D, G]
+        thresholds = np.minimum(IOU_THRESHOLDS, 1 - 1e-10)[None, None, :, None]
+        gt_taken = np.zeros((P, A, T, G), dtype=bool)
+        free = gt_valid[:, None, None, :] & ~gt_ignore[:, :, None, :]       # non-ignored candidates
+        ignored = gt_valid[:, None, None, :] & gt_ignore[:, :, None, :]     # ignored candidates
+        crowd = gt_crowd[:, None, None, :]
+        reverse = np.arange(G - 1, -1, -1)
+        # only detections overlapping some ground truth by the lowest threshold can match,
+        # most detections are background and skip the matching entirely
+        candidates = dt_valid & (np.where(gt_valid[:, None, :], ious, 0) >= thresholds.min()).any(axis=-1)
+        for d in range(D):
+            rows = np.flatnonzero(candidates[:, d])
+            if len(rows) == 0:  continue
+            taken = gt_taken[rows]
+            iou = ious[rows, None, None, d, :]
+            available = (~taken | crowd[rows]) & (iou >= thresholds)
+            best = None
+            for group in (free[rows], ignored[rows]):
+                value = np.where(available & group, iou, -1.)
+                # argmax of the reversed axis: the last of equal IoUs wins
+                index = G - 1 - np.argmax(value[..., reverse], axis=-1)
+                found = np.take_along_axis(value, index[..., None], axis=-1)[..., 0] >= 0
+                if best is None:
+                    best, best_found = index, found
+                else:
+                    best = np.where(best_found, best, index)
+                    best_found = best_found | found
+            dt_matched[rows, :, :, d] = best_found
+            dt_ignore[rows, :, :, d] = best_found & np.take_along_axis(
+                gt_ignore[rows][:, :, None, :], best[..., None], axis=-1)[..., 0]
+            np.put_along_axis(taken, best[..., None], np.take_along_axis(
+                taken, best[..., None], axis=-1) | best_found[..., None], axis=-1)
+            gt_taken[rows] = taken
+    dt_ignore |= ~dt_matched & dt_outside[:, :, None, :]
+    return dt_matched, dt_ignore, gt_ignore
+
+
+def _pad(values, starts, ends, width, fill=0):
+    """[len(starts), width, ...] rows values[starts[i]:ends[i]], padded"""
+    counts = ends - starts
+    out = np.full((len(starts), width) + values.shape[1:], fill, dtype=values.dtype)
+    valid = np.arange(width)[None, :] < counts[:, None]
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    out[valid] = values[np.repeat(starts, counts) + offsets]
+    return out, valid
+
+
+def _chunks(gt_counts, dt_counts):
+    """pairs grouped by their number of ground truth, cut into chunks of at most
+    CHUNK_ELEMENTS matching elements, so padding stays small"""
+    A, T = len(AREA_RANGES), len(IOU_THRESHOLDS)
+    max_dt = int(dt_counts.max()) if len(dt_counts) > 0 else 0
+    for num_gt in np.unique(gt_counts):
+        pairs = np.flatnonzero(gt_counts == num_gt)
+        size = max(CHUNK_ELEMENTS // (A * T * (int(num_gt) + max_dt + 1)), 1)
+        for begin in range(0, len(pairs), size):
+            yield pairs[begin:begin + size]
+
+
+def evaluate_category(job):
+    """match and accumulate one category, see `evaluate_bbox`
+
+    Args:
+        job (tuple): (gt_image, gt_boxes, gt_area, gt_crowd, dt_image, dt_boxes, dt_scores),
+            ground truth in annotation order, detections sorted by (image, -score) and cut
+            to MAX_DETS[-1] per image
+
+    Returns:
+        tuple: precision [T, R, A, M], recall [T, A, M], scores [T, R, A, M]
+    """
+    gt_image, gt_boxes, gt_area, gt_crowd, dt_image, dt_boxes, dt_scores = job
+    T, R, A, M = len(IOU_THRESHOLDS), len(RECALL_THRESHOLDS), len(AREA_RANGES), len(MAX_DETS)
+    precision = -np.ones((T, R, A, M))
+    recall = -np.ones((T, A, M))
+    scores = -np.ones((T, R, A, M))
+
+    # (image, category) pairs with ground truth or detections, in image order
+    images = np.union1d(gt_image, dt_image)
+    gt_pair = np.searchsorted(images, gt_image)
+    dt_pair = np.searchsorted(images, dt_image)
+    gt_order = np.argsort(gt_pair, kind='stable')
+    gt_starts = np.searchsorted(gt_pair[gt_order], np.arange(len(images)), side='left')
+    gt_ends = np.searchsorted(gt_pair[gt_order], np.arange(len(images)), side='right')
+    dt_starts = np.searchsorted(dt_pair, np.arange(len(images)), side='left')
+    dt_ends = np.searchsorted(dt_pair, np.arange(len(images)), side='right')
+    gt_boxes, gt_area, gt_crowd = gt_boxes[gt_order], gt_area[gt_order], gt_crowd[gt_order]
+    dt_area = dt_boxes[:, 2] * dt_boxes[:, 3]
+
+    # match in chunks of pairs with similar numbers of ground truth and detections
+    dt_matched = np.zeros((A, T, len(dt_scores)), dtype=bool)
+    dt_ignore = np.zeros((A, T, len(dt_scores)), dtype=bool)
+    num_gt = np.zeros(A, dtype=np.int64)    # non-ignored ground truth per area range
+    gt_counts, dt_counts = gt_ends - gt_starts, dt_ends - dt_starts
+    for pairs in _chunks(gt_counts, dt_counts):
+        G, D = int(gt_counts[pairs].max()), int(dt_counts[pairs].max())
+        chunk_gt_boxes, gt_valid = _pad(gt_boxes, gt_starts[pairs], gt_ends[pairs], G)
+        chunk_gt_area, _ = _pad(gt_area, gt_starts[pairs], gt_ends[pairs], G)
+        chunk_gt_crowd, _ = _pad(gt_crowd, gt_starts[pairs], gt_ends[pairs], G, False)
+        chunk_dt_boxes, dt_valid = _pad(dt_boxes, dt_starts[pairs], dt_ends[pairs], D)
+        chunk_dt_area, _ = _pad(dt_area, dt_starts[pairs], dt_ends[pairs], D)
+        matched, ignored, gt_ignore = match_chunk(chunk_dt_boxes, dt_valid, chunk_dt_area,
+                                                  chunk_gt_boxes, gt_valid, chunk_gt_area, chunk_gt_crowd)
+        num_gt += (gt_valid[:, None, :] & ~gt_ignore).sum(axis=(0, 2))
+        # scatter back to the flat detection order
+        rows, cols = np.nonzero(dt_valid)
+        index = dt_starts[pairs][rows] + cols
+        dt_matched[:, :, index] = matched[rows, :, :, cols].transpose(1, 2, 0)
+        dt_ignore[:, :, index] = ignored[rows, :, :, cols].transpose(1, 2, 0)
+
+    # accumulate like COCOeval.accumulate, detections of all images ordered by score
+    rank = np.arange(len(dt_scores)) - np.repeat(dt_starts, dt_counts)
+    for m, max_det in enumerate(MAX_DETS):
+        keep = rank < max_det
+        order = np.argsort(-dt_scores[keep], kind='mergesort')
+        sorted_scores = dt_scores[keep][order]
+        index = np.flatnonzero(keep)[order]
+        tps = np.cumsum(dt_matched[:, :, index] & ~dt_ignore[:, :, index], axis=2)
+        fps = np.cumsum(~dt_matched[:, :, index] & ~dt_ignore[:, :, index], axis=2)
+        for a in range(A):
+            if num_gt[a] == 0:  continue
+            tp, fp = tps[a].astype(np.float64), fps[a].astype(np.float64)
+            num_dt = tp.shape[1]
+            rc = tp / num_gt[a]
+            pr = tp / (fp + tp + np.spacing(1))
+            recall[:, a, m] = rc[:, -1] if num_dt > 0 else 0
+            # precision envelope, then sampled at the recall thresholds
+            pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+            for t in range(len(IOU_THRESHOLDS)):
+                index = np.searchsorted(rc[t], RECALL_THRESHOLDS, side='left')
+                valid = index < num_dt
+                precision[t, :, a, m] = np.where(valid, pr[t][np.minimum(index, max(num_dt - 1, 0))] if num_dt else 0, 0)
+                scores[t, :, a, m] = np.where(valid, sorted_scores[np.minimum(index, max(num_dt - 1, 0))]
+                                              if num_dt else 0, 0)
+    return precision, recall, scores
+
+
+def evaluate_bbox(gt, results, workers=1):
+    """COCOeval(gt, gt.loadRes(results), 'bbox').evaluate() + accumulate() on numpy arrays
+
+    Matching runs batched over (image, category) pairs, categories are spread over
+    `workers` processes.
+
+    Args:
+        gt (dict): coco annotation (images, annotations, categories)
+        results (list): coco results (image_id, category_id, bbox xywh, score)
+        workers (int): evaluation processes
+
+    Returns:
+        dict: precision [T, R, K, A, M], recall [T, K, A, M], scores [T, R, K, A, M] and
+            category_ids [K], the layout of COCOeval.eval
+    """
+    image_ids = np.asarray(sorted(image['id'] for image in gt['images']), dtype=np.int64)
+    category_ids = sorted(category['id'] for category in gt['categories'])
+    annotations = gt['annotations']
+    gt_image = np.asarray([ann['image_id'] for ann in annotations], dtype=np.int64)
+    gt_category = np.asarray([ann['category_id'] for ann in annotations], dtype=np.int64)
+    gt_boxes = np.asarray([ann['bbox'] for ann in annotations], dtype=np.float64).reshape(-1, 4)
+    gt_area = np.asarray([ann['area'] for ann in annotations], dtype=np.float64)
+    gt_crowd = np.asarray([bool(ann.get('iscrowd', 0)) for ann in annotations], dtype=bool)
+
+    dt_image = np.asarray([result['image_id'] for result in results], dtype=np.int64)
+    dt_category = np.asarray([result['category_id'] for result in results], dtype=np.int64)
+    dt_boxes = np.asarray([result['bbox'] for result in results], dtype=np.float64).reshape(-1, 4)
+    dt_scores = np.asarray([result['score'] for result in results], dtype=np.float64)
+    keep = np.isin(dt_image, image_ids)
+    dt_image, dt_category, dt_boxes, dt_scores = dt_image[keep], dt_category[keep], dt_boxes[keep], dt_scores[keep]
+    # by category, image, score (stable, so equal scores keep the result order), cut to MAX_DETS[-1]
+    order = np.lexsort((-dt_scores, dt_image, dt_category))
+    dt_image, dt_category, dt_boxes, dt_scores = dt_image[order], dt_category[order], dt_boxes[order], dt_scores[order]
+    starts, ends = _group(dt_category * (image_ids.max() + 1 if len(image_ids) else 1) + dt_image, len(dt_image))
+    rank = np.arange(len(dt_image)) - np.repeat(starts, ends - starts)
+    keep = rank < MAX_DETS[-1]
+    dt_image, dt_category, dt_boxes, dt_scores = dt_image[keep], dt_category[keep], dt_boxes[keep], dt_scores[keep]
+
+    gt_order = np.argsort(gt_category, kind='stable')
+    jobs = list()
+    for category_id in category_ids:
+        g = gt_order[np.searchsorted(gt_category[gt_order], category_id, 'left'):
+                     np.searchsorted(gt_category[gt_order], category_id, 'right')]
+        d = slice(np.searchsorted(dt_category, category_id, 'left'), np.searchsorted(dt_category, category_id, 'right'))
+        jobs.append((gt_image[g], gt_boxes[g], gt_area[g], gt_crowd[g],
+                     dt_image[d], dt_boxes[d], dt_scores[d]))
+
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    outputs = pool.map(evaluate_category, jobs, chunksize=1) if pool is not None else map(evaluate_category, jobs)
+    outputs = list(outputs)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return {
+        'precision': np.stack([output[0] for output in outputs], axis=2),
+        'recall': np.stack([output[1] for output in outputs], axis=1),
+        'scores': np.stack([output[2] for output in outputs], axis=2),
+        'category_ids': category_ids,
+    }
+
+
+def summarize(evaluation):
+    """the 12 numbers of COCOeval.summarize() (stats), -1 where undefined"""
+    precision, recall = evaluation['precision'], evaluation['recall']
+
+    def _summarize(ap, iou=None, area=0, max_det=2):
+        if ap:
+            s = precision[:, :, :, area, max_det]
+            if iou is not None:
+                s = s[np.flatnonzero(np.isclose(IOU_THRESHOLDS, iou))]
+        else:
+            s = recall[:, :, area, max_det]
+        s = s[s > -1]
+        return float(np.mean(s)) if s.size > 0 else -1.
+
+    return np.asarray([
+        _summarize(1), _summarize(1, iou=.5), _summarize(1, iou=.75),
+        _summarize(1, area=1), _summarize(1, area=2), _summarize(1, area=3),
+        _summarize(0, max_det=0), _summarize(0, max_det=1), _summarize(0, max_det=2),
+        _summarize(0, area=1), _summarize(0, area=2), _summarize(0, area=3),
+    ])
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2021-01-31
+# @Author  : Yifer Huang
+# @File    : evaluation.py
+# @Desc    : evaluators
+
+import itertools
+import json
+import logging
+import os
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from detectron2.data import MetadataCatalog
+from detectron2.data.datasets.coco import convert_to_coco_json
+from detectron2.evaluation import COCOEvaluator, DatasetEvaluator
+from detectron2.evaluation.coco_evaluation import instances_to_coco_json
+from detectron2.utils import comm
+from detectron2.utils.logger import create_small_table
+try:
+    from detectron2.utils.file_io import PathManager
+except ImportError:     # detectron2 <= 0.3
+    from fvcore.common.file_io import PathManager
+
+from engine.cocoeval import evaluate_bbox, summarize
+
+
+class FastCOCOEvaluator(DatasetEvaluator):
+    """drop-in COCOEvaluator for the bbox task, the matching and accumulation of
+    pycocotools' COCOeval run on numpy arrays (engine/cocoeval.py), batched over
+    (image, category) pairs and spread over `workers` processes; AP/AR are the same
+
+    Args:
+        dataset_name (str): registered dataset with a coco json_file (converted if missing)
+        distributed (bool): gather the predictions of all processes before evaluating
+        output_dir (str): coco_instances_results.json is saved there if given
+        workers (int): evaluation processes
+    """
+    def __init__(self, dataset_name, distributed=True, output_dir=None, workers=4):
+        self._dataset_name = dataset_name
+        self._distributed = distributed
+        self._output_dir = output_dir
+        self._workers = workers
+        self._metadata = MetadataCatalog.get(dataset_name)
+        self._logger = logging.getLogger(__name__)
+        self._cpu_device = torch.device('cpu')
+        if not hasattr(self._metadata, 'json_file'):
+            assert output_dir is not None, 'output_dir is needed to convert {} to coco json'.format(dataset_name)
+            cache_path = os.path.join(output_dir, '{}_coco_format.json'.format(dataset_name))
+            self._metadata.json_file = cache_path
+            convert_to_coco_json(dataset_name, cache_path)
+
+    def reset(self):
+        self._predictions = list()  # same per-image format as COCOEvaluator
+
+    def load_predictions(self, predictions):
+        """add saved per-image predictions ({image_id, instances} dicts), like process()"""
+        self._predictions.extend(predictions)
+
+    def process(self, inputs, outputs):
+        for input, output in zip(inputs, outputs):
+            prediction = {'image_id': input['image_id']}
+            if 'instances' in output:
+                instances = output['instances'].to(self._cpu_device)
+                prediction['instances'] = instances_to_coco_json(instances, input['image_id'])
+            self._predictions.append(prediction)
+
+    def evaluate(self):
+        if self._distributed:
+            comm.synchronize()
+            predictions = list(itertools.chain(*comm.gather(self._predictions, dst=0)))
+            if not comm.is_main_process():
+                return {}
+        else:
+            predictions = self._predictions
+        if len(predictions) == 0:
+            self._logger.warning('[FastCOCOEvaluator] Did not receive valid predictions.')
+            return {}
+
+        results = list(itertools.chain(*[prediction.get('instances', []) for prediction in predictions]))
+        if hasattr(self._metadata, 'thing_dataset_id_to_contiguous_id'):
+            contiguous_id_to_dataset_id = {v: k for k, v in self._metadata.thing_dataset_id_to_contiguous_id.items()}
+            for result in results:
+                result['category_id'] = contiguous_id_to_dataset_id[result['category_id']]
+        if self._output_dir:
+            PathManager.mkdirs(self._output_dir)
+            with PathManager.open(os.path.join(self._output_dir, 'coco_instances_results.json'), 'w') as f:
+                f.write(json.dumps(results))
+
+        with PathManager.open(self._metadata.json_file, 'r') as f:
+            gt = json.load(f)
+        self._logger.info('Evaluating {} detections of {} images with {} processes'.format(
+            len(results), len(gt['images']), self._workers))
+        evaluation = evaluate_bbox(gt, results, self._workers)
+        return OrderedDict(bbox=self._derive_coco_results(evaluation, gt['categories']))
+
+    def _derive_coco_results(self, evaluation, categories):
+        """same metrics as COCOEvaluator._derive_coco_results for bbox, in percent"""
+        metrics = ['AP', 'AP50', 'AP75', 'APs', 'APm', 'APl']
+        stats = summarize(evaluation)
+        results = {metric: float(stats[idx] * 100 if stats[idx] >= 0 else 'nan') for idx, metric in enumerate(metrics)}
+        self._logger.info('Evaluation results for bbox: \n' + create_small_table(results))
+        if not np.isfinite(sum(results.values())):
+            self._logger.info('Some metrics cannot be computed and is shown as NaN.')
+
+        id2name = {category['id']: category['name'] for category in categories}
+        results_per_category = OrderedDict()
+        for idx, category_id in enumerate(evaluation['category_ids']):
+            precision = evaluation['precision'][:, :, idx, 0, -1]
+            precision = precision[precision > -1]
+            ap = np.mean(precision) if precision.size else float('nan')
+            results_per_category['AP-{}'.format(id2name[category_id])] = float(ap * 100)
+        self._logger.info('Per-category bbox AP: \n' + create_small_table(results_per_category))
+        results.update(results_per_category)
+        return results
+
+
+class ShardCOCOEvaluator(COCOEvaluator):
+    """COCOEvaluator that can also evaluate saved per-image predictions, e.g. the shards
+    of engine/inference.py, like FastCOCOEvaluator.load_predictions"""
+    def load_predictions(self, predictions):
+        """add saved per-image predictions ({image_id, instances} dicts), like process()"""
+        self._predictions.extend(predictions)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2021-01-24
+# @Author  : Yifer Huang
+# @File    : hooks.py
+# @Desc    : training hooks
+
+import csv
+import functools
+import logging
+import os
+import signal
+import subprocess
+import time
+
+import torch
+from detectron2.engine import HookBase
+from detectron2.utils import comm
+
+
+class FrameCacheHook(HookBase):
+    """log the hit/miss counters of the decoded-frame cache (datasets/cache.py) to the
+    trainer log and EventStorage (thus metrics.json and TensorBoard)
+
+    Args:
+        cache (FrameCache): cache used by the train loader
+        period (int): log every `period` iterations
+    """
+    def __init__(self, cache, period=20):
+        self.cache = cache
+        self.period = period
+        self.logger = logging.getLogger(__name__)
+
+    def after_step(self):
+        if (self.trainer.iter + 1) % self.period != 0:
+            return
+        stats = self.cache.stats()
+        lookups = max(stats['hits'] + stats['misses'], 1)
+        storage = self.trainer.storage
+        storage.put_scalar('cache/hits', stats['hits'], smoothing_hint=False)
+        storage.put_scalar('cache/misses', stats['misses'], smoothing_hint=False)
+        storage.put_scalar('cache/evictions', stats['evictions'], smoothing_hint=False)
+        storage.put_scalar('cache/hit_rate', stats['hits'] / lookups, smoothing_hint=False)
+        self.logger.info('frame cache: {} hits, {} misses ({:.1%} hit rate), {} evictions'.format(
+            stats['hits'], stats['misses'], stats['hits'] / lookups, stats['evictions']))
+
+
+class ProfilingHook(HookBase):
+    """per-iteration timers of the training loop, to tell which stage slows it down
+
+    Every iteration puts profile/{stage} seconds into EventStorage (thus metrics.json
+    and TensorBoard) and appends a row to {output_dir}/rank{rank}.csv:
+
+    - data_wait, decode, augment, prefetch_age, queue_depth: see engine/profiling.py
+    - forward: model forward (forward pre-hook to forward hook)
+    - backward: forward end to optimizer step, the loss backward including the DDP
+      all-reduce it waits for and the metrics gather of the trainer
+    - optimizer: optimizer.step()
+    - allreduce: launch to completion of the DDP gradient buckets (comm hook), summed,
+      it overlaps backward
+    - iteration: before_step to after_step of this hook
+
+    Iterations [trace_iters[0], trace_iters[1]) are traced with torch.profiler or
+    py-spy into a chrome trace json, on the ranks in trace_ranks.
+
+    Args:
+        loader (ProfilingLoader): train loader of the trainer
+        output_dir (str): directory of the csv and trace files
+        period (int): flush the csv and log the mean stage times every `period` iterations
+        sync_cuda (bool): synchronize CUDA at the stage boundaries, otherwise asynchronous
+            kernels are charged to the stage which waits for them
+        comm_hook (bool): time the all-reduce, for DistributedDataParallel models
+        trace_iters (tuple): (start, end) iterations to trace, empty for none
+        trace_mode (str): (torch, py-spy)
+        trace_ranks (tuple): ranks which trace
+    """
+    STAGES = ['iteration', 'data_wait', 'decode', 'augment', 'forward', 'backward', 'optimizer', 'allreduce',
+              'prefetch_age', 'queue_depth']
+
+    def __init__(self, loader, output_dir, period=20, sync_cuda=True, comm_hook=True,
+                 trace_iters=(), trace_mode='torch', trace_ranks=(0, )):
+        assert trace_mode in ['torch', 'py-spy'], trace_mode
+        self.loader = loader
+        self.output_dir = output_dir
+        self.period = period
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self.comm_hook = comm_hook
+        self.trace_iters = tuple(trace_iters) if comm.get_rank() in trace_ranks else ()
+        self.trace_mode = trace_mode
+        self.trace = None
+        self.logger = logging.getLogger(__name__)
+        self.times = dict()
+        self.allreduce = 0.
+        self.sums = dict.fromkeys(self.STAGES, 0.)
+
+    def _synchronize(self):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+
+    def _forward_start(self, module, inputs):
+        if module.training:
+            self.times['forward_start'] = time.perf_counter()
+
+    def _forward_end(self, module, inputs, outputs):
+        if module.training:
+            self._synchronize()
+            self.times['forward_end'] = time.perf_counter()
+
+    def _timed_step(self, step):
+        # wraps keeps the attributes the LR scheduler put on step
+        @functools.wraps(step)
+        def wrapped(*args, **kwargs):
+            self._synchronize()
+            self.times['optimizer_start'] = time.perf_counter()
+            ret = step(*args, **kwargs)
+            self._synchronize()
+            self.times['optimizer_end'] = time.perf_counter()
+            return ret
+        return wrapped
+
+    def _timed_allreduce(self, state, bucket):
+        from torch.distributed.algorithms.ddp_comm_hooks.default_hooks import allreduce_hook
+
+        start = time.perf_counter()
+
+        def done(future):
+            self.allreduce += time.perf_counter() - start
+            return future.value()
+        return allreduce_hook(state, bucket).then(done)
+
+    def before_train(self):
+        # DefaultTrainer runs a SimpleTrainer since detectron2 v0.4, it was one before
+        trainer = getattr(self.trainer, '_trainer', self.trainer)
+        model, optimizer = trainer.model, trainer.optimizer
+        model.register_forward_pre_hook(self._forward_start)
+        model.register_forward_hook(self._forward_end)
+        optimizer.step = self._timed_step(optimizer.step)
+        if self.comm_hook and isinstance(model, torch.nn.parallel.DistributedDataParallel):
+            if hasattr(model, 'register_comm_hook'):    # torch >= 1.8
+                model.register_comm_hook(None, self._timed_allreduce)
+            else:
+                self.logger.warning('DDP comm hooks need torch >= 1.8, all-reduce is not timed')
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.file = open(os.path.join(self.output_dir, 'rank{}.csv'.format(comm.get_rank())), 'a', newline='')
+        self.writer = csv.writer(self.file)
+        if self.file.tell() == 0:
+            self.writer.writerow(['iteration'] + ['{}_seconds'.format(stage) if stage != 'queue_depth' else stage
+                                                  for stage in self.STAGES])
+
+    def before_step(self):
+        if self.trace_iters and self.trainer.iter == self.trace_iters[0]:
+            self._start_trace()
+        self._synchronize()
+        self.times = {'start': time.perf_counter()}
+        self.allreduce = 0.
+
+    def after_step(self):
+        self._synchronize()
+        end = time.perf_counter()
+        times = self.times
+        stats = dict(self.loader.last, iteration=end - times['start'], allreduce=self.allreduce)
+        if 'forward_end' in times:
+            stats['forward'] = times['forward_end'] - times['forward_start']
+            if 'optimizer_start' in times:
+                stats['backward'] = times['optimizer_start'] - times['forward_end']
+                stats['optimizer'] = times['optimizer_end'] - times['optimizer_start']
+        stats = {stage: stats.get(stage, 0.) for stage in self.STAGES}
+
+        self.trainer.storage.put_scalars(**{'profile/' + stage: value for stage, value in stats.items()})
+        self.writer.writerow([self.trainer.iter] + [stats[stage] if stage == 'queue_depth' else '{:.6f}'.format(stats[stage])
+                                                      for stage in self.STAGES])
+        for stage, value in stats.items():
+            self.sums[stage] += value
+        if (self.trainer.iter + 1) % self.period == 0:
+            self.file.flush()
+            self.logger.info('profile of the last {} iterations (ms, depth in samples): '.format(self.period) + ', '.join(
+                '{}: {:.1f}'.format(stage, self.sums[stage] / self.period * (1 if stage == 'queue_depth' else 1000))
+                for stage in self.STAGES))
+            self.sums = dict.fromkeys(self.STAGES, 0.)
+        if self.trace is not None and self.trainer.iter + 1 >= self.trace_iters[1]:
+            self._stop_trace()
+
+    def after_train(self):
+        if self.trace is not None:
+            self._stop_trace()
+        self.file.close()
+
+    def _trace_filename(self):
+        return os.path.join(self.output_dir, 'trace_rank{}_iter{}-{}{}.json'.format(
+            comm.get_rank(), self.trace_iters[0], self.trace_iters[1], '_py-spy' if self.trace_mode == 'py-spy' else ''))
+
+    def _start_trace(self):
+        if self.trace_mode == 'torch':
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.trace = torch.profiler.profile(activities=activities, record_shapes=True, with_stack=True)
+            self.trace.start()
+        else:
+            # samples the Python stacks of this process (and the loader workers) from outside
+            try:
+                self.trace = subprocess.Popen([
+                    'py-spy', 'record', '--pid', str(os.getpid()), '--subprocesses', '--rate', '100',
+                    '--format', 'chrometrace', '--output', self._trace_filename(),
+                ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            except OSError as e:
+                self.logger.warning('Cannot start py-spy, no trace: {}'.format(e))
+                self.trace_iters = ()
+                return
+        self.logger.info('Start {} trace of iterations [{}, {})'.format(self.trace_mode, *self.trace_iters))
+
+    def _stop_trace(self):
+        filename = self._trace_filename()
+        if self.trace_mode == 'torch':
+            self.trace.stop()
+            self.trace.export_chrome_trace(filename)
+        else:
+            # py-spy writes the trace when interrupted
+            self.trace.send_signal(signal.SIGINT)
+            self.trace.wait()
+        self.trace = None
+        self.logger.info('Successfully save trace to {}'.format(filename))
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2021-01-30
+# @Author  : Yifer Huang
+# @File    : inference.py
+# @Desc    : batched inference (eval-only on CPU nodes)
+
+import datetime
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Sampler
+
+from detectron2.data import DatasetFromList, DatasetMapper, MapDataset, get_detection_dataset_dicts
+from detectron2.evaluation.coco_evaluation import instances_to_coco_json
+from detectron2.evaluation.evaluator import inference_context
+from detectron2.utils import comm
+
+from datasets.writer import dumps
+
+
+class AspectRatioBatchSampler(Sampler):
+    """batches of test images with similar aspect ratios, so the padded batch tensor
+    wastes little compute on padding
+
+    The images are split across ranks in contiguous shards like detectron2's
+    InferenceSampler, each shard is sorted by aspect ratio and cut into batches. Every
+    image is visited exactly once, in an order the evaluators do not depend on.
+
+    Args:
+        dataset_dicts (list): dataset dicts with height and width
+        batch_size (int): images per batch
+        distributed (bool): False to batch all images in every process
+    """
+    def __init__(self, dataset_dicts, batch_size, distributed=True):
+        size = len(dataset_dicts)
+        rank, world_size = (comm.get_rank(), comm.get_world_size()) if distributed else (0, 1)
+        shard_size = (size - 1) // world_size + 1
+        begin, end = shard_size * rank, min(shard_size * (rank + 1), size)
+        ratios = np.asarray([dataset_dicts[i]['width'] / dataset_dicts[i]['height'] for i in range(begin, end)])
+        order = np.argsort(ratios, kind='stable') + begin
+        self.batches = [order[i:i + batch_size].tolist() for i in range(0, len(order), batch_size)]
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+class TimedMapper(object):
+    """run a dataset mapper and record its seconds in the output dict, so the time
+    spent in the loader workers can be reported by the main process
+    """
+    def __init__(self, mapper):
+        self.mapper = mapper
+
+    def __call__(self, dataset_dict):
+        start = time.perf_counter()
+        ret = self.mapper(dataset_dict)
+        ret['preprocess_time'] = time.perf_counter() - start
+        return ret
+
+
+def _worker_init(worker_id):
+    # the workers only decode and resize, many workers times many intra-op threads
+    # would oversubscribe the cores the model runs on
+    torch.set_num_threads(1)
+
+
+def _collate(batch):
+    return batch
+
+
+def build_batched_test_loader(cfg, dataset_name, mapper=None, dataset_dicts=None, distributed=True):
+    """test loader yielding TEST.IMS_PER_BATCH images bucketed by aspect ratio, mapped in
+    TEST.NUM_WORKERS processes
+
+    Args:
+        dataset_dicts (list): images to load instead of all of dataset_name
+        distributed (bool): see `AspectRatioBatchSampler`
+
+    Returns:
+        DataLoader: lists of mapped dicts
+    """
+    if dataset_dicts is None:
+        dataset_dicts = get_detection_dataset_dicts([dataset_name], filter_empty=False)
+    if mapper is None:
+        mapper = DatasetMapper(cfg, False)
+    dataset = MapDataset(DatasetFromList(dataset_dicts, copy=False), TimedMapper(mapper))
+    return DataLoader(
+        dataset,
+        batch_sampler=AspectRatioBatchSampler(dataset_dicts, cfg.TEST.IMS_PER_BATCH, distributed),
+        num_workers=cfg.TEST.NUM_WORKERS,
+        collate_fn=_collate,
+        worker_init_fn=_worker_init,
+    )
+
+
+def batched_inference_on_dataset(model, data_loader, evaluator):
+    """detectron2's inference_on_dataset for batched loaders, additionally reports the
+    images/sec of each stage
+
+    load: main process waiting for the loader, preprocess: mapper (summed over the
+    workers, i.e. per worker), model: forward pass, evaluate: evaluator.process
+
+    Returns:
+        dict: evaluator.evaluate() results
+    """
+    logger = logging.getLogger(__name__)
+    logger.info('Start batched inference on {} batches, {} intra-op threads'.format(
+        len(data_loader), torch.get_num_threads()))
+    evaluator.reset()
+    timing = OrderedDict((stage, 0.) for stage in ['load', 'preprocess', 'model', 'evaluate'])
+    num_images = 0
+    start = time.perf_counter()
+    with inference_context(model), torch.no_grad():
+        data_start = time.perf_counter()
+        for idx, inputs in enumerate(data_loader):
+            timing['load'] += time.perf_counter() - data_start
+            timing['preprocess'] += sum(inputs_i.pop('preprocess_time', 0.) for inputs_i in inputs)
+
+            stage_start = time.perf_counter()
+            outputs = model(inputs)
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            timing['model'] += time.perf_counter() - stage_start
+
+            stage_start = time.perf_counter()
+            evaluator.process(inputs, outputs)
+            timing['evaluate'] += time.perf_counter() - stage_start
+            num_images += len(inputs)
+            if (idx + 1) % 20 == 0:
+                logger.info('Inference done {}/{} batches, {:.2f} images/s'.format(
+                    idx + 1, len(data_loader), num_images / (time.perf_counter() - start)))
+            data_start = time.perf_counter()
+
+    total_time = time.perf_counter() - start
+    logger.info('Total batched inference time: {} ({:.2f} images/s on {} devices)'.format(
+        datetime.timedelta(seconds=int(total_time)), num_images / max(total_time, 1e-9), comm.get_world_size()))
+    logger.info('Per stage: ' + ', '.join('{}: {:.2f} images/s ({:.1f}s)'.format(
+        stage, num_images / max(seconds, 1e-9), seconds) for stage, seconds in timing.items()))
+
+    results = evaluator.evaluate()
+    # same as inference_on_dataset, the evaluator returns None on non-main processes
+    if results is None:
+        results = {}
+    return results
+
+
+# .{OUTPUT_DIR}/inference/{dataset_name}/shards
+# ├── shard_0000-of-0008.jsonl          # finished shard, one {image_id, instances} per line
+# └── shard_0001-of-0008.jsonl.partial  # shard in progress, appended batch by batch
+
+def shard_filename(shard_dir, shard_id, num_shards):
+    return os.path.join(shard_dir, 'shard_{:04d}-of-{:04d}.jsonl'.format(shard_id, num_shards))
+
+
+def shard_indices(size, num_shards, shard_id):
+    """contiguous, deterministic slice of the dataset belonging to a shard"""
+    shard_size = (size - 1) // num_shards + 1 if size > 0 else 0
+    return range(shard_size * shard_id, min(shard_size * (shard_id + 1), size))
+
+
+def load_shard(filename, truncate=False):
+    """predictions saved in a shard file, in COCOEvaluator's per-image format
+
+    Args:
+        filename (str): finished or partial shard
+        truncate (bool): cut a torn last line (crash while writing) off the file
+
+    Returns:
+        list: {image_id, instances} dicts
+    """
+    predictions = list()
+    if not os.path.exists(filename):
+        return predictions
+    with open(filename, 'rb+' if truncate else 'rb') as f:
+        offset = 0
+        for line in f:
+            if not line.endswith(b'\n'):   break
+            try:
+                predictions.append(json.loads(line))
+            except ValueError:
+                break
+            offset += len(line)
+        if truncate:
+            f.truncate(offset)
+    return predictions
+
+
+def inference_on_shard(model, cfg, dataset_name, dataset_dicts, shard_id, num_shards, shard_dir):
+    """predict one shard of a dataset and persist the predictions batch by batch
+
+    A finished shard is skipped, a partial one continues after its last saved image,
+    so a crashed evaluation loses at most one batch.
+
+    Args:
+        dataset_dicts (list): all images of dataset_name, in the registered order
+        shard_id (int): shard to predict, see `shard_indices`
+        num_shards (int): number of shards of the dataset
+        shard_dir (str): directory of the shard files, shared by all processes/machines
+    """
+    logger = logging.getLogger(__name__)
+    filename = shard_filename(shard_dir, shard_id, num_shards)
+    if os.path.exists(filename):
+        logger.info('Skip finished shard {}'.format(filename))
+        return
+    partial_filename = filename + '.partial'
+    done = set(prediction['image_id'] for prediction in load_shard(partial_filename, truncate=True))
+    dataset_dicts = [dataset_dicts[i] for i in shard_indices(len(dataset_dicts), num_shards, shard_id)]
+    remaining = [record for record in dataset_dicts if record['image_id'] not in done]
+    logger.info('Shard {}/{}: {} images, {} already predicted'.format(
+        shard_id, num_shards, len(dataset_dicts), len(dataset_dicts) - len(remaining)))
+    open(partial_filename, 'ab').close()    # a shard may have no images, see shard_indices
+    if len(remaining) > 0:
+        data_loader = build_batched_test_loader(cfg, dataset_name, dataset_dicts=remaining, distributed=False)
+        with open(partial_filename, 'ab') as f, inference_context(model), torch.no_grad():
+            for inputs in data_loader:
+                outputs = model(inputs)
+                for inputs_i, outputs_i in zip(inputs, outputs):
+                    instances = outputs_i['instances'].to('cpu')
+                    f.write(dumps({
+                        'image_id': inputs_i['image_id'],
+                        'instances': instances_to_coco_json(instances, inputs_i['image_id']),
+                    }) + b'\n')
+                f.flush()
+    os.replace(partial_filename, filename)
+
+
+def merge_shards(evaluator, shard_dir, num_shards):
+    """evaluate the predictions of all shards of a dataset
+
+    Args:
+        evaluator (ShardCOCOEvaluator or FastCOCOEvaluator): non-distributed evaluator of the
+            dataset, with load_predictions
+
+    Returns:
+        dict: evaluation results, None while some shards are unfinished
+    """
+    missing = [shard_id for shard_id in range(num_shards)
+               if not os.path.exists(shard_filename(shard_dir, shard_id, num_shards))]
+    if len(missing) > 0:
+        logging.getLogger(__name__).info('Cannot merge {}, shards {} are unfinished'.format(shard_dir, missing))
+        return None
+    evaluator.reset()
+    for shard_id in range(num_shards):
+        evaluator.load_predictions(load_shard(shard_filename(shard_dir, shard_id, num_shards)))
+    return evaluator.evaluate()
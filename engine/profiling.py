@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2021-02-02
+# @Author  : Yifer Huang
+# @File    : profiling.py
+# @Desc    : per-stage timers of the training loop (data loader side)
+
+import multiprocessing
+import time
+
+import numpy as np
+from detectron2.data import detection_utils
+
+_read_image = detection_utils.read_image
+_decode_seconds = [0.]      # read_image seconds of the sample being mapped in this process
+
+
+def timed_read_image(*args, **kwargs):
+    """detection_utils.read_image, adding its seconds to the sample being mapped"""
+    start = time.perf_counter()
+    try:
+        return _read_image(*args, **kwargs)
+    finally:
+        _decode_seconds[0] += time.perf_counter() - start
+
+
+class LoaderCounters(object):
+    """samples mapped by the data loader workers and consumed by the trainer, the
+    difference is the number of prefetched samples waiting in the loader queues
+
+    `produced` lives in shared memory, create the counters before the data loader forks
+    its workers (like FrameCache).
+    """
+    def __init__(self):
+        self.produced = multiprocessing.Value('q', 0)
+        self.consumed = 0   # trainer process only
+
+    def depth(self):
+        return self.produced.value - self.consumed
+
+
+class ProfilingMapper(object):
+    """run a dataset mapper and attach the seconds spent decoding (read_image) and
+    augmenting (everything else) to the mapped dict, see `ProfilingLoader`
+
+    Both DatasetMapper and CachedDatasetMapper read images through
+    detection_utils.read_image, which is replaced by `timed_read_image`; with the frame
+    cache, hits cost no decode time.
+
+    Args:
+        mapper (callable): DatasetMapper
+        counters (LoaderCounters): counts the mapped samples
+    """
+    def __init__(self, mapper, counters):
+        self.mapper = mapper
+        self.counters = counters
+        detection_utils.read_image = timed_read_image
+
+    def __call__(self, dataset_dict):
+        _decode_seconds[0] = 0.
+        start = time.perf_counter()
+        ret = self.mapper(dataset_dict)
+        end = time.perf_counter()
+        if ret is None:     # dropped, MapDataset maps another sample
+            return ret
+        # perf_counter is CLOCK_MONOTONIC, comparable across the processes of a node
+        ret['profiling'] = {'decode': _decode_seconds[0], 'augment': end - start - _decode_seconds[0], 'mapped_at': end}
+        with self.counters.produced.get_lock():
+            self.counters.produced.value += 1
+        return ret
+
+
+class ProfilingLoader(object):
+    """iterate a train loader, recording how long the trainer waits for each batch and
+    the worker timings ProfilingMapper attached to its samples
+
+    `last` holds the stats of the latest batch: data_wait (trainer blocked on the
+    loader), decode and augment (summed over the batch, worker seconds), prefetch_age
+    (mean time the samples waited in the loader after being mapped) and queue_depth
+    (samples mapped but not consumed yet).
+
+    Args:
+        data_loader (iterable): train loader built with a ProfilingMapper
+        counters (LoaderCounters): counters of that mapper
+    """
+    def __init__(self, data_loader, counters):
+        self.data_loader = data_loader
+        self.counters = counters
+        self.last = dict()
+
+    def __iter__(self):
+        iterator = iter(self.data_loader)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            end = time.perf_counter()
+            timings = [timing for timing in (dataset_dict.pop('profiling', None) for dataset_dict in batch)
+                       if timing is not None]
+            self.counters.consumed += len(batch)
+            self.last = {
+                'data_wait': end - start,
+                'decode': sum(timing['decode'] for timing in timings),
+                'augment': sum(timing['augment'] for timing in timings),
+                'prefetch_age': float(np.mean([end - timing['mapped_at'] for timing in timings])) if timings else 0.,
+                'queue_depth': self.counters.depth(),
+            }
+            yield batch
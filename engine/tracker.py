@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2021-01-29
+# @Author  : Yifer Huang
+# @File    : tracker.py
+# @Desc    : online linking of per-frame detections into trajectories
+
+import os
+
+import numpy as np
+
+from datasets.writer import dumps
+from engine.boxes import assign, iou_matrix
+
+
+class TrackletLinker(object):
+    """associate the detections of a video, fed frame by frame in order, into tracklets
+
+    Each frame's detections are matched to the active tracklets of the same category
+    by IoU with their last box (one IoU matrix, one assignment per frame). Unmatched
+    detections start tracklets, tracklets unmatched for more than `max_gap` frames are
+    finished and handed back, so memory is bounded by the tracklets alive at a time,
+    not by the length of the video.
+
+    Args:
+        score_threshold (float): detections below it are ignored
+        iou_threshold (float): minimum IoU of a match
+        max_gap (int): sampled frames a tracklet may miss before it is finished
+        min_length (int): shorter tracklets are dropped when finished
+    """
+    def __init__(self, score_threshold=0.3, iou_threshold=0.3, max_gap=2, min_length=2):
+        self.score_threshold = score_threshold
+        self.iou_threshold = iou_threshold
+        self.max_gap = max_gap
+        self.min_length = min_length
+        self.tracklets = list()     # active, dicts of category_id, boxes {frame_index: box}, scores, missed
+        self.boxes = np.zeros((0, 4), dtype=np.float32)     # last box of each active tracklet
+        self.category_ids = np.zeros(0, dtype=np.int64)
+
+    def _finish(self, tracklets):
+        for tracklet in tracklets:
+            if len(tracklet['boxes']) < self.min_length:    continue
+            yield {
+                'category_id': tracklet['category_id'],
+                'score': float(np.mean(tracklet['scores'])),
+                'trajectory': tracklet['boxes'],
+            }
+
+    def update(self, frame_index, boxes, scores, category_ids):
+        """link the detections of the next frame
+
+        Args:
+            frame_index (int): index of the frame in the video, increasing
+            boxes (array-like): [N, 4] xyxy boxes
+            scores (array-like): [N]
+            category_ids (array-like): [N]
+
+        Returns:
+            list: tracklets finished by this frame, see `finish`
+        """
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        scores = np.asarray(scores, dtype=np.float32)
+        category_ids = np.asarray(category_ids, dtype=np.int64)
+        keep = scores >= self.score_threshold
+        boxes, scores, category_ids = boxes[keep], scores[keep], category_ids[keep]
+
+        affinity = iou_matrix(self.boxes, boxes)
+        affinity[self.category_ids[:, None] != category_ids[None, :]] = 0
+        rows, cols = assign(affinity, self.iou_threshold)
+
+        matched = np.zeros(len(self.tracklets), dtype=bool)
+        matched[rows] = True
+        for row, col in zip(rows.tolist(), cols.tolist()):
+            tracklet = self.tracklets[row]
+            tracklet['boxes'][str(frame_index)] = boxes[col].tolist()
+            tracklet['scores'].append(float(scores[col]))
+            tracklet['missed'] = 0
+        self.boxes[rows] = boxes[cols]
+
+        unmatched = np.ones(len(boxes), dtype=bool)
+        unmatched[cols] = False
+        for col in np.nonzero(unmatched)[0].tolist():
+            self.tracklets.append({
+                'category_id': int(category_ids[col]),
+                'boxes': {str(frame_index): boxes[col].tolist()},
+                'scores': [float(scores[col])],
+                'missed': 0,
+            })
+
+        alive = np.ones(len(self.tracklets), dtype=bool)
+        for i in np.nonzero(~matched)[0].tolist():
+            self.tracklets[i]['missed'] += 1
+            alive[i] = self.tracklets[i]['missed'] <= self.max_gap
+        finished = [tracklet for tracklet, keep in zip(self.tracklets, alive) if not keep]
+        self.tracklets = [tracklet for tracklet, keep in zip(self.tracklets, alive) if keep]
+        self.boxes = np.concatenate([self.boxes, boxes[unmatched]])[alive]
+        self.category_ids = np.concatenate([self.category_ids, category_ids[unmatched]])[alive]
+        return list(self._finish(finished))
+
+    def finish(self):
+        """finish the remaining tracklets at the end of the video
+
+        Returns:
+            list: dicts of category_id, score (mean detection score) and trajectory
+                {frame_index: [xmin, ymin, xmax, ymax]}
+        """
+        finished = list(self._finish(self.tracklets))
+        self.tracklets = list()
+        self.boxes = np.zeros((0, 4), dtype=np.float32)
+        self.category_ids = np.zeros(0, dtype=np.int64)
+        return finished
+
+
+class TrajectoryWriter(object):
+    """stream video object detection results in the VidOR submission format
+
+    {"version": "VERSION 1.0", "results": {video_id: [{"category", "score", "trajectory"}]}}
+
+    Videos are appended as they are linked and the file is renamed into place on close.
+
+    Args:
+        filename (str): output json
+        categories (list): vidor categories, maps category ids to names
+    """
+    def __init__(self, filename, categories):
+        self.filename = filename
+        self.temp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+        self.id2name = {item['id']: item['name'] for item in categories}
+        self.file = open(self.temp_filename, 'wb')
+        self.file.write(b'{"version":"VERSION 1.0","results":{')
+        self.num_videos = 0
+        self.num_trajectories = 0
+
+    def add_video(self, video_id, tracklets):
+        results = [{
+            'category': self.id2name[tracklet['category_id']],
+            'score': tracklet['score'],
+            'trajectory': tracklet['trajectory'],
+        } for tracklet in tracklets]
+        if self.num_videos > 0:
+            self.file.write(b',')
+        self.file.write(dumps(str(video_id)) + b':' + dumps(results))
+        self.num_videos += 1
+        self.num_trajectories += len(results)
+
+    def close(self):
+        self.file.write(b'}}')
+        self.file.close()
+        os.replace(self.temp_filename, self.filename)
+        print('>>> Successfully export {} trajectories of {} videos to {}'.format(
+            self.num_trajectories, self.num_videos, self.filename))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        self.file.close()
+        os.remove(self.temp_filename)
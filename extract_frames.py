@@ -6,25 +6,68 @@
 # @Desc    : extract frames from videos
 
 import argparse
+import errno
+import functools
+import hashlib
+import itertools
+import multiprocessing
 import os
 import json
+import queue
+import shutil
+import threading
+import time
 import cv2
+import numpy as np
 from tqdm import tqdm
 
+from datasets import shards
+from datasets.writer import coco_header, open_annotation_writer
+from engine.boxes import near_duplicate
+
 def args_parser():
     parser = argparse.ArgumentParser(description='extract frames from videos')
     parser.add_argument('--dataset', default='vidvrd', help='choose dataset')
     parser.add_argument('--f', dest='frequency', type=int, default=1, help='sample frequency')
     parser.add_argument('--input', help='path of dataset')
     parser.add_argument('--output', help='path to store images extracted from video')
-    parser.add_argument('--split', default='train', help='(train, test), ANNOTATOR NEED!')
+    parser.add_argument('--split', default='train', help='(train, test), ANNOTATOR and --anno-driven NEED!')
     parser.add_argument('--anno-only', dest='need_anno', action='store_true')
+    parser.add_argument('--format', dest='anno_format', default='coco', help='(coco, columnar), ANNOTATOR NEED!')
+    parser.add_argument('--workers', type=int, default=1, help='number of extraction/annotation processes')
+    parser.add_argument('--decode', default='auto', help='(auto, grab, seek), how to skip unsampled frames')
+    parser.add_argument('--writers', type=int, default=2, help='encoder/writer threads per extraction process')
+    parser.add_argument('--queue-depth', dest='queue_depth', type=int, default=16,
+                        help='decoded frames buffered between the decoder and the writers')
+    parser.add_argument('--jpeg-quality', dest='jpeg_quality', type=int, default=95, help='IMWRITE_JPEG_QUALITY')
+    parser.add_argument('--pack', action='store_true', help='pack the frames of each video into a tar shard')
+    parser.add_argument('--anno-driven', dest='anno_driven', action='store_true',
+                        help='only extract sampled frames with boxes in the --split annotations')
+    parser.add_argument('--dedup', type=int, default=-1,
+                        help='drop sampled frames whose 64-bit perceptual hash is within this Hamming distance '
+                             'of the last kept frame of the video, -1 keeps all frames')
+    parser.add_argument('--dedup-iou', dest='dedup_iou', type=float, default=0.9,
+                        help='--dedup keeps a frame anyway if a box moved below this IoU (--anno-driven)')
+    parser.add_argument('--hash', dest='hash_method', default='dct', help='(dct, average) perceptual hash of --dedup')
+    parser.add_argument('--sampling', default='uniform',
+                        help='(uniform, motion) every --f-th frame, or --budget frames per video where boxes '
+                             '(frame differences without --anno-driven) change most')
+    parser.add_argument('--budget', type=float, default=0.25,
+                        help='frames per video of --sampling motion, as a fraction of what --f samples')
     args = parser.parse_args()
 
     assert args.dataset in ['vidvrd', 'vidor']
     assert args.input is not None
+    assert args.workers >= 1
+    assert args.decode in ['auto', 'grab', 'seek']
+    assert args.anno_format in ['coco', 'columnar']
+    assert args.writers >= 1 and args.queue_depth >= 1
+    assert 0 <= args.jpeg_quality <= 100
+    assert args.dedup <= 64 and args.hash_method in ['dct', 'average']
+    assert args.sampling in ['uniform', 'motion'] and args.budget > 0
+    args.sampling = {'method': 'motion', 'budget': args.budget} if args.sampling == 'motion' else None
     if args.output is None:
-        args.output = os.path.join(args.input, 'frames@{}'.format(args.frequency))
+        args.output = os.path.join(args.input, 'frames@{}'.format(sampling_tag(args.frequency, args.sampling)))
 
     return args
 
@@ -38,33 +81,725 @@ def check_dirs(path):
         os.makedirs(path)
         print('>>> Successfully create directory {}.'.format(path))
 
-def dump_coco_file(filename, categories, annotations, images, dataset):
-    from datasets.vocab import coco_liscenses, coco_info
-    coco_annotations = {
-        'info': coco_info[dataset],
-        'type': 'instances',
-        'liscenses': coco_liscenses,
-        'categories': categories,
-        'images': images,
-        'annotations': annotations,
-    }
-    with open(filename, 'w') as f:
-        json.dump(coco_annotations, f)
-        print('>>> Successfully export annotations to {}'.format(filename))
-    
-def vidvrd_extractor(frequency, input, output):
+def vidvrd_extractor(frequency, input, output, **kwargs):
     pass
 
-def vidvrd_annotator(frequency, input, output):
+def vidvrd_annotator(frequency, input, output, **kwargs):
     pass
 
-def vidor_extractor(frequency, input, output):
+def find_annotation(input, sub_dir, video_id):
+    """raw annotation of a video, in training/ or validation/, None if it has none (test videos)"""
+    for prefix in ('training', 'validation'):
+        anno_fn = os.path.join(input, prefix, sub_dir, video_id + '.json')
+        if os.path.exists(anno_fn):
+            return anno_fn
+    return None
+
+def list_videos(input):
+    """list all videos under the videos directory, with their raw annotation if any
+
+    Args:
+        input (string): vidor dataset directory, videos are under {input}/videos
+
+    Returns:
+        list: (video_id, filename, annotation filename or None) tuples, e.g. (2401075277,
+            ~/datasets/vidor/videos/0000/2401075277.mp4, ~/datasets/vidor/training/0000/2401075277.json)
+    """
+    videos_dir = os.path.join(input, 'videos')
+    videos = list()
+    for sub_dir in sorted(os.listdir(videos_dir)):  # sub_dir: 0000, 0001, 0002
+        sub_dir_path = os.path.join(videos_dir, sub_dir)
+        for basename in sorted(os.listdir(sub_dir_path)):  # basename: 2401075277.mp4
+            video_id = os.path.splitext(basename)[0]
+            videos.append((video_id, os.path.join(sub_dir_path, basename), find_annotation(input, sub_dir, video_id)))
+    return videos
+
+def list_annotations(input, split):
+    """list raw vidor annotation files of the given split
+
+    Args:
+        input (string): vidor dataset directory
+        split (string): (train, test)
+
+    Returns:
+        list: filenames, e.g. ~/datasets/vidor/training/1021/2405668450.json
+    """
+    prefix = 'training' if split == 'train' else "validation"
+    root_dir = os.path.join(input, prefix)  # vidor/training
+    anno_vidor_fns = list()
+    for sub_dir in sorted(os.listdir(root_dir)):
+        sub_dir_path = os.path.join(root_dir, sub_dir)  # vidor/training/0000/
+        for basename in sorted(os.listdir(sub_dir_path)):
+            anno_vidor_fns.append(os.path.join(sub_dir_path, basename))
+    return anno_vidor_fns
+
+def list_annotated_videos(input, split):
+    """list videos of the given split together with their raw annotation
+
+    Returns:
+        list: (video_id, filename, annotation filename) tuples
+    """
+    videos = list()
+    for anno_fn in list_annotations(input, split):  # vidor/training/0000/2401075277.json
+        sub_dir = os.path.basename(os.path.dirname(anno_fn))
+        video_id = os.path.splitext(os.path.basename(anno_fn))[0]
+        videos.append((video_id, os.path.join(input, 'videos', sub_dir, video_id + '.mp4'), anno_fn))
+    return videos
+
+def annotated_frames(anno_fn, frequency):
+    """indices of the sampled frames which carry at least one box, i.e. the frames
+    `vidor_annotator` turns into images
+
+    Args:
+        anno_fn (string): raw vidor annotation filename
+        frequency (int): sampling frequency
+
+    Returns:
+        list: increasing frame indices
+    """
+    with open(anno_fn, 'r') as f:
+        trajectories = json.load(f)['trajectories']
+    return [frame_index for frame_index in range(0, len(trajectories), frequency)
+            if len(trajectories[frame_index]) != 0]
+
+def sampling_tag(frequency, sampling=None):
+    """suffix of the frames directory and annotation file, 16 or 16-motion0.25"""
+    if sampling is None:
+        return str(frequency)
+    return '{}-{}{:g}'.format(frequency, sampling['method'], sampling['budget'])
+
+def box_motion(trajectories):
+    """change of the boxes from each frame to the next one, summed over the objects in
+    both frames: centre shift, in units of the box size (square root of its area), plus
+    size change (absolute log of the area ratio); 1 for every object entering or leaving
+
+    Unlike 1 - IoU, it keeps growing once a fast object's boxes stop overlapping.
+
+    Args:
+        trajectories (list): per-frame boxes of a raw vidor annotation
+
+    Returns:
+        ndarray: [num_frames], motion[t] is the change from frame t - 1 to frame t
+    """
+    motion = np.zeros(len(trajectories), dtype=np.float32)
+    previous = dict()
+    for frame_index, trajectory in enumerate(trajectories):
+        current = {box['tid']: [box['bbox']['xmin'], box['bbox']['ymin'], box['bbox']['xmax'], box['bbox']['ymax']]
+                   for box in trajectory}
+        common = sorted(previous.keys() & current.keys())
+        if len(common) > 0:
+            boxes1 = np.asarray([previous[tid] for tid in common], dtype=np.float32)
+            boxes2 = np.asarray([current[tid] for tid in common], dtype=np.float32)
+            area1 = np.maximum((boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1]), 1.)
+            area2 = np.maximum((boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1]), 1.)
+            shift = np.linalg.norm((boxes2[:, :2] + boxes2[:, 2:] - boxes1[:, :2] - boxes1[:, 2:]) / 2, axis=1)
+            motion[frame_index] = np.sum(shift / np.sqrt((area1 + area2) / 2) + np.abs(np.log(area2 / area1)))
+        motion[frame_index] += len(previous.keys() ^ current.keys()) if frame_index > 0 else 0
+        previous = current
+    return motion
+
+def appearance_motion(filename, size=64):
+    """frame difference energy, the motion of videos without annotation: mean absolute
+    difference between the grayscale thumbnails of consecutive frames
+
+    Returns:
+        ndarray: [num_frames], motion[t] is the change from frame t - 1 to frame t
+    """
+    capture = cv2.VideoCapture(filename)
+    motion = list()
+    previous = None
+    while True:
+        status, frame = capture.read()
+        if not status:  break
+        thumbnail = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), (size, size),
+                               interpolation=cv2.INTER_AREA).astype(np.float32)
+        motion.append(0. if previous is None else float(np.abs(thumbnail - previous).mean()))
+        previous = thumbnail
+    capture.release()
+    return np.asarray(motion, dtype=np.float32)
+
+def motion_sampling(motion, candidates, budget, floor=0.1):
+    """pick `budget` candidate frames, each covering the same amount of change
+
+    Frames are placed at equal steps of the cumulative motion, so they are dense where
+    boxes move and sparse over static shots; `floor` (a fraction of the mean motion) is
+    added to every frame so long static shots still get a frame. Picks colliding on the
+    same candidate are replaced by the unpicked candidates of highest motion.
+
+    Args:
+        motion (ndarray): [num_frames] change from each frame to the next, see `box_motion`
+        candidates (list): increasing frame indices which may be picked
+        budget (int): number of frames to pick
+
+    Returns:
+        list: increasing frame indices
+    """
+    candidates = np.asarray(candidates, dtype=np.int64)
+    if budget >= len(candidates):
+        return candidates.tolist()
+    energy = motion + floor * max(float(motion.mean()), 1e-6)
+    cumulative = np.cumsum(energy)[candidates]
+    targets = (np.arange(budget) + 0.5) / budget * cumulative[-1]
+    right = np.clip(np.searchsorted(cumulative, targets), 1, len(candidates) - 1)
+    nearest = np.where(targets - cumulative[right - 1] < cumulative[right] - targets, right - 1, right)
+    picked = np.zeros(len(candidates), dtype=bool)
+    picked[nearest] = True
+    missing = budget - picked.sum()
+    if missing > 0:
+        rest = np.nonzero(~picked)[0]
+        picked[rest[np.argsort(-energy[candidates[rest]], kind='stable')[:missing]]] = True
+    return candidates[picked].tolist()
+
+def motion_frames(filename, anno_fn, frequency, budget, method='motion', anno_driven=False):
+    """frames of a video picked by `motion_sampling`, from the box motion of its
+    annotation or, without annotation, its frame differences
+
+    Args:
+        anno_fn (string): raw vidor annotation of the video, None if it has none
+        budget (float): fraction of the frames uniform sampling at `frequency` takes
+        anno_driven (bool): pick only frames with boxes
+
+    Returns:
+        list: increasing frame indices
+    """
+    if anno_fn is not None:
+        with open(anno_fn, 'r') as f:
+            trajectories = json.load(f)['trajectories']
+        motion = box_motion(trajectories)
+        if anno_driven:
+            candidates = [frame_index for frame_index, trajectory in enumerate(trajectories) if len(trajectory) != 0]
+        else:
+            candidates = list(range(len(trajectories)))
+        uniform = len([frame_index for frame_index in candidates if frame_index % frequency == 0])
+    else:
+        motion = appearance_motion(filename)
+        candidates = list(range(len(motion)))
+        uniform = (len(motion) - 1) // frequency + 1 if len(motion) > 0 else 0
+    if len(candidates) == 0:
+        return []
+    return motion_sampling(motion, candidates, max(int(round(uniform * budget)), 1))
+
+def init_worker():
+    """keep opencv single-threaded inside extraction processes, otherwise N processes
+    each spawn a full set of opencv threads and oversubscribe the machine
+    """
+    cv2.setNumThreads(1)
+
+def seek(capture, frame_index, fps):
+    """jump to the given frame and read it
+
+    CAP_PROP_POS_FRAMES only echoes back the value set, so the frame is checked after the
+    read against its timestamp: CAP_PROP_POS_MSEC has to be within half a frame of
+    frame_index / fps, backends which seek to the wrong frame or report no timestamps fail.
+
+    Returns:
+        ndarray: the frame, None if it could not be verified, the capture is then rewound to frame 0
+    """
+    capture.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+    status, frame = capture.read()
+    if status and fps > 0 and \
+            abs(capture.get(cv2.CAP_PROP_POS_MSEC) - frame_index * 1000. / fps) < 500. / fps:
+        return frame
+    capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    return None
+
+def sample_frames(capture, frame_indices, strategy='auto'):
+    """decode only the wanted frames of a video
+
+    grab() demuxes and decodes a frame but skips retrieve() (colour conversion and copy),
+    seeking jumps to the previous keyframe and decodes forward from there. Seeking pays
+    off once the stride is larger than the GOP, which we cannot read from opencv, so
+    `auto` times one skipped run of grab() against one seek and keeps the cheaper one
+    for the rest of the video. Every seek is verified (see seek()), the first one that
+    lands on another frame switches the video to grab().
+
+    Args:
+        capture (cv2.VideoCapture): opened video
+        frame_indices (iterable): increasing indices of the frames to decode
+        strategy (str): (auto, grab, seek)
+
+    Yields:
+        tuple: (frame_index, frame)
+    """
+    position = 0    # index of the frame the next grab()/read() returns
+    grab_cost = None    # seconds per skipped frame with grab()
+    # never seek past the reported length (opencv clamps silently), grab() finds the real end
+    num_frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    for frame_index in frame_indices:
+        gap = frame_index - position
+        start = time.perf_counter()
+        frame = None
+        if gap > 0 and frame_index < num_frames and strategy != 'grab' and \
+                (strategy == 'seek' or grab_cost is not None):
+            frame = seek(capture, frame_index, fps)
+            if frame is None:
+                position = 0
+                strategy = 'grab'   # inaccurate seeking for this video, fall back
+        if frame is None:
+            while position < frame_index:
+                if not capture.grab():  return
+                position += 1
+        if strategy == 'auto' and gap > 0:
+            cost = (time.perf_counter() - start) / gap
+            if grab_cost is None:
+                grab_cost = cost    # first skipped run was grabbed, next one seeks
+            else:
+                strategy = 'seek' if cost < grab_cost else 'grab'
+        if frame is None:
+            status, frame = capture.read()
+            if not status:  return
+        position = frame_index + 1
+        yield frame_index, frame
+
+def dct_matrix(size):
+    """orthonormal DCT-II matrix, D @ x is the DCT of the columns of x"""
+    k = np.arange(size)[:, None]
+    matrix = np.cos(np.pi * (2 * np.arange(size)[None, :] + 1) * k / (2 * size)) * np.sqrt(2. / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+DCT_32 = dct_matrix(32)
+
+def perceptual_hash(frames, method='dct'):
+    """64-bit perceptual hashes of frames, close images have hashes at a small Hamming
+    distance
+
+    dct (pHash): 8x8 lowest frequencies of the 32x32 grayscale thumbnail, a bit per
+    frequency above their median. average (aHash): 8x8 grayscale thumbnail, a bit per
+    pixel above its mean.
+
+    Args:
+        frames (list): BGR uint8 frames
+        method (str): (dct, average)
+
+    Returns:
+        ndarray: [N] uint64 hashes
+    """
+    size = 32 if method == 'dct' else 8
+    thumbnails = np.stack([
+        cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), (size, size), interpolation=cv2.INTER_AREA)
+        for frame in frames
+    ]).astype(np.float32)
+    if method == 'dct':
+        coefficients = (DCT_32 @ thumbnails @ DCT_32.T)[:, :8, :8].reshape(len(frames), 64)
+        # the DC term only follows brightness, leave it out of the median
+        bits = coefficients > np.median(coefficients[:, 1:], axis=1, keepdims=True)
+    else:
+        pixels = thumbnails.reshape(len(frames), 64)
+        bits = pixels > pixels.mean(axis=1, keepdims=True)
+    return np.packbits(bits, axis=1).view('>u8')[:, 0].astype(np.uint64)
+
+def hamming(hash1, hash2):
+    return bin(int(hash1) ^ int(hash2)).count('1')
+
+def frame_boxes(anno_fn):
+    """boxes of every frame of a raw vidor annotation
+
+    Returns:
+        list: (boxes [N, 4] xyxy, tids [N]) per frame
+    """
+    with open(anno_fn, 'r') as f:
+        trajectories = json.load(f)['trajectories']
+    return [(
+        np.asarray([[box['bbox']['xmin'], box['bbox']['ymin'], box['bbox']['xmax'], box['bbox']['ymax']]
+                    for box in trajectory], dtype=np.float32).reshape(-1, 4),
+        np.asarray([box['tid'] for box in trajectory], dtype=np.int64)
+    ) for trajectory in trajectories]
+
+class FrameDeduplicator(object):
+    """drop the sampled frames of a video which look like its last kept frame
+
+    A frame is dropped if its perceptual hash is within `max_distance` of the last kept
+    frame's, unless the annotation says an object appeared, left or moved (IoU below
+    `iou` for the same tid), see `engine.boxes.near_duplicate`.
+
+    Args:
+        max_distance (int): Hamming distance of near duplicate hashes
+        iou (float): minimum IoU of every box for a near duplicate
+        method (str): perceptual hash, see `perceptual_hash`
+        boxes (list): per-frame (boxes, tids) of the annotation, see `frame_boxes`, None without
+    """
+    def __init__(self, max_distance, iou=0.9, method='dct', boxes=None):
+        self.max_distance = max_distance
+        self.iou = iou
+        self.method = method
+        self.boxes = boxes
+        self.last = None        # (frame index, hash) of the last kept frame
+        self.dropped = list()   # [frame index, index of the kept frame it duplicates]
+
+    def keep(self, frame_index, frame):
+        frame_hash = perceptual_hash([frame], self.method)[0]
+        if self.last is not None and hamming(frame_hash, self.last[1]) <= self.max_distance:
+            # frames past the end of the annotation have no boxes to compare
+            if self.boxes is None or frame_index >= len(self.boxes) or \
+                    near_duplicate(*self.boxes[self.last[0]], *self.boxes[frame_index], self.iou):
+                self.dropped.append([frame_index, self.last[0]])
+                return False
+        self.last = (frame_index, frame_hash)
+        return True
+
+def frame_basename(video_id, frame_index):
+    # max frame count of vidor videos is 5395
+    return "{}_{:04d}.jpg".format(video_id, frame_index)
+
+def file_stat(filename):
+    """mtime and size of a source file, used to tell whether it changed since extraction"""
+    stat = os.stat(filename)
+    return {'mtime': stat.st_mtime, 'size': stat.st_size}
+
+def manifest_filename(frames_dir, video_id):
+    return os.path.join(frames_dir, '.manifest', '{}.json'.format(video_id))
+
+def load_manifest(frames_dir, video_id):
+    """load the completion manifest of a video, None if the video was never (fully) extracted"""
+    filename = manifest_filename(frames_dir, video_id)
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+def dump_manifest(frames_dir, manifest):
+    """write the manifest atomically, a crash never leaves a half-written manifest behind
+
+    .frames_dir
+    ├── .manifest/
+    │   └── 2401075277.json     # {video_id, frequency, quality, packed, source, dedup, sampling, frames, dropped, checksum}
+    └── 2401075277_0000.jpg
+    """
+    filename = manifest_filename(frames_dir, manifest['video_id'])
+    check_dirs(os.path.dirname(filename))
+    temp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(temp_filename, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(temp_filename, filename)
+
+def read_frame(frames_dir, video_id, frame_index, packed):
+    """bytes of an extracted frame, loose or packed into the video's shard"""
+    basename = frame_basename(video_id, frame_index)
+    if packed:
+        return shards.read_frame(frames_dir, basename)
+    with open(os.path.join(frames_dir, basename), 'rb') as f:
+        return f.read()
+
+def frames_exist(frames_dir, manifest):
+    """whether the frames a manifest lists are still there: one stat() per loose frame,
+    the offset index and the shard size of a packed video"""
+    video_id = manifest['video_id']
+    basenames = [frame_basename(video_id, frame_index) for frame_index in manifest['frames']]
+    if not manifest['packed']:
+        return all(os.path.isfile(os.path.join(frames_dir, basename)) for basename in basenames)
+    index_fn, shard_fn = shards.index_filename(frames_dir, video_id), shards.shard_filename(frames_dir, video_id)
+    if not os.path.isfile(index_fn) or not os.path.isfile(shard_fn):
+        return False
+    with open(index_fn, 'r') as f:
+        index = json.load(f)
+    if any(basename not in index for basename in basenames):
+        return False
+    return os.path.getsize(shard_fn) >= max([offset + size for offset, size in index.values()], default=0)
+
+def remove_other_layout(frames_dir, video_id, packed, manifest):
+    """delete the frames a previous extraction of the video left in the other layout
+    (loose files vs shard), so switching --pack never leaves both behind
+
+    Args:
+        packed (bool): layout of the new extraction
+        manifest (dict): manifest of the previous extraction, None if there was none
+    """
+    if not packed:
+        for filename in [shards.shard_filename(frames_dir, video_id), shards.index_filename(frames_dir, video_id)]:
+            if os.path.exists(filename):
+                os.remove(filename)
+    elif manifest is not None and not manifest['packed']:
+        for frame_index in manifest['frames']:
+            stale = os.path.join(frames_dir, frame_basename(video_id, frame_index))
+            if os.path.exists(stale):
+                os.remove(stale)
+
+def link_frames(video_id, frame_indices, frequency, quality, packed, source, frames_dir, donor_dirs):
+    """reuse frames of a video already extracted at a finer frequency (e.g. frames@8 for
+    frames@16) instead of decoding the video again, loose frames are hard-linked, frames
+    going into or coming from a shard are copied. A failed link (other than across file
+    systems, where the frame is copied) removes the frames linked so far and raises, so
+    no manifest is written for the video
+
+    Args:
+        frame_indices (list): wanted frame indices, None for every sampled frame
+        quality (int): JPEG quality, must match the donor's
+        packed (bool): pack the frames into a shard, see `datasets.shards`
+        source (dict): source file stats of the video, must match the donor's
+
+    Returns:
+        tuple: (linked frame indices, checksum), (None, None) if no donor directory holds all wanted frames
+    """
+    for donor_dir in donor_dirs:
+        donor = load_manifest(donor_dir, video_id)
+        if donor is None or donor['source']['video'] != source['video'] or donor['quality'] != quality:
+            continue
+        if donor.get('dedup') is not None or donor.get('sampling') is not None:   # not every sampled frame
+            continue
+        if frame_indices is None:
+            # only a full stride extraction holds every multiple of its frequency
+            if donor['anno_driven'] or \
+                    frequency % donor['frequency'] != 0:
+                continue
+            linked = [frame_index for frame_index in donor['frames'] if frame_index % frequency == 0]
+        elif set(frame_indices) <= set(donor['frames']):
+            linked = frame_indices
+        else:
+            continue
+        md5 = hashlib.md5()
+        shard = shards.ShardWriter(frames_dir, video_id) if packed else None
+        written = list()    # loose frames of this call
+        try:
+            for frame_index in linked:
+                data = read_frame(donor_dir, video_id, frame_index, donor['packed'])
+                md5.update(hashlib.md5(data).digest())
+                basename = frame_basename(video_id, frame_index)
+                if shard is not None:
+                    shard.add(basename, data)
+                    continue
+                src = os.path.join(donor_dir, basename)
+                dst = os.path.join(frames_dir, basename)
+                if os.path.exists(dst):
+                    os.remove(dst)
+                written.append(dst)
+                if donor['packed']:
+                    with open(dst, 'wb') as f:
+                        f.write(data)
+                    continue
+                try:
+                    os.link(src, dst)
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+                    shutil.copyfile(src, dst)   # across file systems
+        except BaseException:
+            if shard is not None:
+                shard.abort()
+            for dst in written:
+                if os.path.exists(dst):
+                    os.remove(dst)
+            raise
+        if shard is not None:
+            shard.close()
+        return linked, md5.hexdigest()
+    return None, None
+
+class FrameWriter(object):
+    """encode and write decoded frames on a pool of threads fed through a bounded queue,
+    so the decoder never waits on JPEG encoding or (network) file system latency.
+    imencode and file writes release the GIL, so the threads really run in parallel.
+
+    Args:
+        frames_dir (string): directory to store extracted images
+        video_id (string): video the frames belong to
+        num_threads (int): number of encoder/writer threads
+        queue_depth (int): max number of decoded frames waiting for a writer
+        quality (int): JPEG quality, opencv's default 95 keeps the bytes of cv2.imwrite
+        packed (bool): append the frames to the video's shard instead of loose files
+    """
+    def __init__(self, frames_dir, video_id, num_threads=2, queue_depth=16, quality=95, packed=False):
+        self.frames_dir = frames_dir
+        self.video_id = video_id
+        self.shard = shards.ShardWriter(frames_dir, video_id) if packed else None
+        self.params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        self.queue = queue.Queue(maxsize=queue_depth)
+        self.digests = dict()   # frame_index -> md5 digest
+        self.seq = 0            # frames put so far, shard members follow this order
+        self.encode_time = 0.   # summed over threads
+        self.error = None
+        self.aborted = False    # queued frames are dropped, see close
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._run, daemon=True) for _ in range(num_threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:    break
+            if self.aborted:    continue
+            seq, frame_index, frame = item
+            try:
+                start = time.perf_counter()
+                _, buffer = cv2.imencode('.jpg', frame, self.params)
+                data = buffer.tobytes()
+                basename = frame_basename(self.video_id, frame_index)
+                if self.shard is not None:
+                    self.shard.add(basename, data, seq)
+                else:
+                    with open(os.path.join(self.frames_dir, basename), 'wb') as f:
+                        f.write(data)
+                digest = hashlib.md5(data).digest()
+                elapsed = time.perf_counter() - start
+                with self.lock:
+                    self.digests[frame_index] = digest
+                    self.encode_time += elapsed
+            except Exception as e:
+                self.error = e
+
+    def put(self, frame_index, frame):
+        """queue a decoded frame, blocks while `queue_depth` frames are already waiting"""
+        if self.error is not None:
+            raise self.error
+        self.queue.put((self.seq, frame_index, frame))
+        self.seq += 1
+
+    def close(self, abort=False):
+        """wait for all queued frames to be written, the threads are stopped and joined
+        even if writing failed, and an unfinished shard is removed
+
+        Args:
+            abort (bool): drop the queued frames and the shard, e.g. after a decode error
+
+        Returns:
+            string: md5 over the md5 digests of the frames in index order, None if aborted
+        """
+        self.aborted = abort
+        failed = True
+        try:
+            for _ in self.threads:
+                self.queue.put(None)
+            for thread in self.threads:
+                thread.join()
+            if self.error is not None and not abort:
+                raise self.error
+            if self.shard is not None and not abort:
+                self.shard.close()
+            failed = abort
+        finally:
+            if failed and self.shard is not None:
+                self.shard.abort()
+        if abort:
+            return None
+        md5 = hashlib.md5()
+        for frame_index in sorted(self.digests):
+            md5.update(self.digests[frame_index])
+        return md5.hexdigest()
+
+def extract_video(video, frequency, frames_dir, strategy='auto', donor_dirs=(),
+                  writers=2, queue_depth=16, quality=95, packed=False, dedup=None, sampling=None,
+                  anno_driven=False):
+    """extract frames from a single video, unless the manifest says it is already done
+
+    Args:
+        video (tuple): (video_id, filename, annotation filename or None), the annotation
+            boxes guide dedup and motion sampling
+        frequency (int): sampling frequency
+        frames_dir (string): directory to store extracted images
+        strategy (str): how to skip unsampled frames, see `sample_frames`
+        donor_dirs (list): directories extracted at a finer frequency, see `link_frames`
+        writers, queue_depth, quality, packed: see `FrameWriter`
+        dedup (dict): max_distance, iou and method of a `FrameDeduplicator`, None keeps
+            every frame; the dropped frames are listed in the manifest
+        sampling (dict): method (motion) and budget of `motion_frames`, None samples every
+            `frequency`-th frame
+        anno_driven (bool): skip the sampled frames without boxes in the annotation
+
+    Returns:
+        tuple: (video_id, number of frames, status, timing), status is one of (extracted, linked, skipped),
+            timing holds the decode and encode seconds and the number of dropped frames
+    """
+    video_id, filename, anno_fn = video
+    timing = {'decode': 0., 'encode': 0., 'dropped': 0}
+    source = {
+        'video': file_stat(filename),
+        'annotation': file_stat(anno_fn) if anno_fn is not None else None
+    }
+    manifest = load_manifest(frames_dir, video_id)
+    if manifest is not None and manifest['frequency'] == frequency and manifest['quality'] == quality \
+            and manifest['packed'] == packed and manifest['source'] == source and manifest.get('dedup') == dedup \
+            and manifest.get('sampling') == sampling and manifest.get('anno_driven') == anno_driven \
+            and frames_exist(frames_dir, manifest):
+        return video_id, len(manifest['frames']), 'skipped', timing
+
+    if sampling is not None:
+        frame_indices = motion_frames(filename, anno_fn, frequency, anno_driven=anno_driven, **sampling)
+    else:
+        frame_indices = annotated_frames(anno_fn, frequency) if anno_driven and anno_fn is not None else None
+    # deduplication needs the decoded frames, donors hold every frame
+    frames, checksum = None, None
+    if dedup is None:
+        frames, checksum = link_frames(video_id, frame_indices, frequency, quality, packed,
+                                       source, frames_dir, donor_dirs)
+    deduplicator = None
+    if frames is not None:
+        status = 'linked'
+    else:
+        status = 'extracted'
+        if frame_indices is None:
+            frame_indices = itertools.count(0, frequency)
+        if dedup is not None:
+            deduplicator = FrameDeduplicator(boxes=frame_boxes(anno_fn) if anno_fn is not None else None, **dedup)
+        frames = list()
+        writer = FrameWriter(frames_dir, video_id, writers, queue_depth, quality, packed)
+        capture = cv2.VideoCapture(filename)
+        decoded = False     # a decode or encode error aborts the writer
+        try:
+            samples = sample_frames(capture, frame_indices, strategy)
+            while True:
+                start = time.perf_counter()
+                sample = next(samples, None)
+                timing['decode'] += time.perf_counter() - start
+                if sample is None:  break
+                if deduplicator is not None and not deduplicator.keep(*sample):
+                    continue
+                writer.put(*sample)
+                frames.append(sample[0])
+            decoded = True
+        finally:
+            capture.release()
+            checksum = writer.close(abort=not decoded)
+        timing['encode'] = writer.encode_time
+        if deduplicator is not None and not packed:
+            # left over by an extraction without dedup
+            for frame_index, _ in deduplicator.dropped:
+                stale = os.path.join(frames_dir, frame_basename(video_id, frame_index))
+                if os.path.exists(stale):
+                    os.remove(stale)
+    remove_other_layout(frames_dir, video_id, packed, manifest)
+
+    dump_manifest(frames_dir, {
+        'video_id': video_id,
+        'frequency': frequency,
+        'quality': quality,
+        'packed': packed,
+        'source': source,
+        'dedup': dedup,
+        'sampling': sampling,
+        'anno_driven': anno_driven,
+        'frames': frames,
+        'dropped': deduplicator.dropped if deduplicator is not None else [],
+        'checksum': checksum
+    })
+    timing['dropped'] = len(deduplicator.dropped) if deduplicator is not None else 0
+    return video_id, len(frames), status, timing
+
+def vidor_extractor(frequency, input, output, workers=1, strategy='auto', split=None,
+                    writers=2, queue_depth=16, quality=95, packed=False, dedup=None, sampling=None):
     """extracte images from vidor video dataset according given frequency
 
     Args:
         input (string): vidor dataset directory
         output (string ): directory to store extracted images
         frequency (int): sampling frequency
+        workers (int): number of extraction processes, videos are spread across them
+        strategy (str): how to skip unsampled frames (auto, grab, seek)
+        split (string): if given (train, test), only extract the videos of this split and
+            only the sampled frames with boxes, which is all `vidor_annotator` needs
+        writers (int): encoder/writer threads per process, see `FrameWriter`
+        queue_depth (int): decoded frames buffered per video, see `FrameWriter`
+        quality (int): JPEG quality
+        packed (bool): write one tar shard + offset index per video instead of loose
+            JPEGs, see `datasets.shards`
+        dedup (dict): drop near duplicate frames, see `FrameDeduplicator`, None keeps all;
+            `vidor_annotator` skips the frames the manifests list as dropped
+        sampling (dict): pick frames by motion instead of every `frequency`-th one, see
+            `motion_frames`; `vidor_annotator` annotates the frames the manifests list
+
+    A manifest per finished video (see `dump_manifest`) makes reruns skip unchanged videos,
+    and frames already extracted into a finer `frames@{k}` are hard-linked, not decoded.
     
     .input (vidvrd dataset directory)
     ├── training/                   # annotations for train split
@@ -72,108 +807,226 @@ def vidor_extractor(frequency, input, output):
     ├── frames@{frequency}/         # if not exist, then mkdir
     └── videos/                     # all videos of vidvrd dataset
     """
-    videos_dir = os.path.join(input, 'videos')
     frames_dir = output
     check_dirs(frames_dir)
 
-    sub_dirs = os.listdir(videos_dir)
-    for sub_dir in tqdm(sub_dirs):  # sub_dir: 0000, 0001, 0002
-        sub_dir_path = os.path.join(videos_dir, sub_dir)
-        video_basenames = os.listdir(sub_dir_path)
+    if split is None:
+        videos = list_videos(input)
+    else:
+        videos = list_annotated_videos(input, split)
+    # finer frequencies that divide ours (frames@8 for frames@16), coarsest first
+    donor_dirs = [os.path.join(input, 'frames@{}'.format(donor_frequency))
+                  for donor_frequency in range(frequency - 1, 0, -1) if frequency % donor_frequency == 0]
+    donor_dirs = [donor_dir for donor_dir in donor_dirs
+                  if os.path.isdir(donor_dir) and os.path.abspath(donor_dir) != os.path.abspath(frames_dir)]
+    job = functools.partial(extract_video, frequency=frequency, frames_dir=frames_dir,
+                            strategy=strategy, donor_dirs=donor_dirs,
+                            writers=writers, queue_depth=queue_depth, quality=quality, packed=packed,
+                            dedup=dedup, sampling=sampling, anno_driven=split is not None)
+    pool = multiprocessing.Pool(workers, initializer=init_worker) if workers > 1 else None
+    results = pool.imap_unordered(job, videos) if pool is not None else map(job, videos)
+    total_frames = 0
+    decoded_frames = 0
+    dropped_frames = 0
+    statuses = {'extracted': 0, 'linked': 0, 'skipped': 0}
+    timing = {'decode': 0., 'encode': 0.}
+    with tqdm(total=len(videos), unit='video') as pbar:
+        for video_id, frame_count, status, video_timing in results:
+            total_frames += frame_count
+            statuses[status] += 1
+            if status == 'extracted':
+                decoded_frames += frame_count + video_timing['dropped']
+                dropped_frames += video_timing['dropped']
+                timing['decode'] += video_timing['decode']
+                timing['encode'] += video_timing['encode']
+            pbar.set_postfix(video=video_id, frames=frame_count, total=total_frames, **statuses)
+            pbar.update()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    print('>>> Successfully extract {} frames ({}) from vidor dataset, {}.'.format(
+        total_frames, '1/{}'.format(frequency) if sampling is None else sampling_tag(frequency, sampling), ', '.join('{} videos {}'.format(n, k) for k, n in statuses.items())))
+    if dedup is not None:
+        print('>>> dropped {} near duplicate frames of the extracted videos'.format(dropped_frames))
+    if decoded_frames > 0:
+        # per process and per writer thread, i.e. not divided by --workers / --writers
+        print('>>> decode: {:.1f} frames/s, encode+write: {:.1f} frames/s'.format(
+            decoded_frames / max(timing['decode'], 1e-9),
+            (decoded_frames - dropped_frames) / max(timing['encode'], 1e-9)))
 
-        # basename: 2401075277.mp4
-        # filename: ~/datasets/vidor/videos/0000/2401075277.mp4
-        # video_id: 2401075277
-        for basename in video_basenames:
-            filename = os.path.join(sub_dir_path, basename)
-            video_id = os.path.splitext(basename)[0]
-            frame_index = 0
-            video = cv2.VideoCapture(filename)
-            while True:
-                status, frame = video.read()
-                if not status:  break
-                if frame_index % frequency == 0:
-                     # max frame count of vidor videos is 5395
-                    frame_filename = os.path.join(frames_dir, "{}_{:04d}.jpg".format(video_id, frame_index))
-                    cv2.imwrite(frame_filename, frame)
-                frame_index += 1
-    print('>>> Successfully extract frames (1/{}) from vidor dataset.'.format(frequency))
-
-def vidor_annotator(frequency, input, output, split):
+def list_frames(frames_dir):
+    """basenames of all extracted frames, from one scan of the frames directory (plus the
+    offset index of each shard) instead of one stat() per frame. A video with both loose
+    frames and a shard (e.g. an interrupted extraction after switching --pack) is rejected,
+    extract it again
+
+    Returns:
+        set: e.g. {2401075277_0000.jpg, 2401075277_0016.jpg, ...}
+    """
+    frames, packed = set(), set()
+    for entry in os.scandir(frames_dir):
+        if entry.name.endswith('.jpg'):
+            frames.add(entry.name)
+        elif entry.name.endswith('.idx.json'):  # packed video, see `vidor_extractor`
+            with open(entry.path, 'r') as f:
+                packed.update(json.load(f))
+    mixed = {shards.video_of(basename) for basename in frames} & {shards.video_of(basename) for basename in packed}
+    assert not mixed, 'videos with both loose and packed frames in {}, extract them again: {}'.format(
+        frames_dir, sorted(mixed)[:10])
+    return frames | packed
+
+def load_manifests(frames_dir):
+    """extraction manifests of all videos of a frames directory
+
+    Returns:
+        dict: video_id -> manifest, see `dump_manifest`
+    """
+    manifests = dict()
+    manifest_dir = os.path.join(frames_dir, '.manifest')
+    if not os.path.isdir(manifest_dir):
+        return manifests
+    for entry in os.scandir(manifest_dir):
+        if not entry.name.endswith('.json'):    continue
+        with open(entry.path, 'r') as f:
+            manifest = json.load(f)
+        manifests[manifest['video_id']] = manifest
+    return manifests
+
+def dropped_frames(manifests):
+    """basenames of the frames dropped as near duplicates by the extraction
+
+    Returns:
+        set: e.g. {2401075277_0016.jpg, ...}
+    """
+    return set(frame_basename(video_id, frame_index)
+               for video_id, manifest in manifests.items() for frame_index, _ in manifest.get('dropped', []))
+
+def convert_vidor_annotation(anno_fn, frequency, cat2id, frame_indices=None):
+    """convert the raw annotation of one vidor video
+
+    Args:
+        anno_fn (string): raw vidor annotation filename
+        frequency (int): sampling frequency
+        cat2id (dict): category name -> category id
+        frame_indices (list): frames to convert instead of every `frequency`-th one
+
+    Returns:
+        list: (frame_index, image, annotations) of the sampled frames with boxes, annotations without instance id
+    """
+    with open(anno_fn, 'r') as f:
+        raw_data = json.load(f)
+
+    width = raw_data['width']
+    height = raw_data['height']
+    video_id = raw_data['video_id']
+    trajectories = raw_data['trajectories']
+    category_dict = raw_data['subject/objects']
+
+    tid2index = dict()      # map tid to object class id
+    for item in category_dict:
+        tid = str(item['tid'])
+        tid2index[tid] = cat2id[item['category']]
+
+    results = list()
+    frame_indices = set(frame_indices) if frame_indices is not None else None
+    for frame_index, trajectory in enumerate(trajectories):
+        if frame_indices is None and frame_index % frequency != 0: continue
+        if frame_indices is not None and frame_index not in frame_indices: continue
+        if len(trajectory) == 0: continue       # pass empty anno
+        image_id = int("{}{:04d}".format(video_id, frame_index))
+        image = {
+            "file_name": frame_basename(video_id, frame_index),    # 4460320158_0000.jpg
+            "height": height,
+            "width":width,
+            "id": image_id
+        }
+        annotations_image = list()          # image = instance1 + instance2 + ...
+        for instance in trajectory:
+            tid = instance['tid']
+            category_id = tid2index[str(tid)]
+            x = instance['bbox']['xmin']
+            y = instance['bbox']['ymin']
+            h = instance['bbox']['ymax'] - instance['bbox']['ymin']
+            w = instance['bbox']['xmax'] - instance['bbox']['xmin']
+            annotation_instance = {
+                "category_id": category_id,
+                "area": w*h,
+                "bbox": [x, y, w, h],
+                "bbox_mode": 1,
+                "image_id": image_id,
+                "iscrowd": 0
+            }
+            annotations_image.append(annotation_instance)
+        results.append((frame_index, image, annotations_image))
+    return results
+
+def _convert_video(item, frequency, cat2id):
+    anno_fn, frame_indices = item
+    return convert_vidor_annotation(anno_fn, frequency, cat2id, frame_indices)
+
+def vidor_annotator(frequency, input, output, split, workers=1, anno_format='coco', sampling=None):
+    """convert raw vidor annotations of the given split to a coco-style annotation file,
+    or to the columnar store (datasets/columnar.py) if anno_format is columnar
+
+    Raw annotations are parsed by `workers` processes, in order, and instance ids are
+    assigned here, so the result does not depend on the number of workers.
+
+    With `sampling` (see `vidor_extractor`), the frames listed in the extraction
+    manifests are annotated, into d2_{split}_{frequency}-motion{budget}.json, and their
+    indices are written next to it into d2_{split}_{frequency}-motion{budget}.indices.json
+    """
 #   BEFORE RUN
     check_dirs(output)
-    prefix = 'training' if split == 'train' else "validation"
     # import statistic data
     from datasets.vocab import vidor_categories
     cat2id = {item['name']: item['id'] for item in vidor_categories}    # categories to id
     instance_index = 1      # instance counter
-    annotations = list()    # all annotation (coco-style)
-    images = list()
     # prepare raw vidor annotation filenames
-    root_dir = os.path.join(input, prefix)  # vidor/training
-    sub_dirs = os.listdir(root_dir)
-    anno_vidor_fns = list()
-    for sub_dir in tqdm(sub_dirs):
-        sub_dir_path = os.path.join(root_dir, sub_dir)  # vidor/training/0000/
-        basenames = os.listdir(sub_dir_path)
-        for basename in basenames:
-            filename = os.path.join(sub_dir_path, basename) # vidor/training/1021/2405668450.json
-            anno_vidor_fns.append(filename)
+    anno_vidor_fns = list_annotations(input, split)
     print('>>> Successfully prepare vidor annotation files')
+    frames = list_frames(output)     # extracted frames, to check frame images
+    manifests = load_manifests(output)
+    dropped = dropped_frames(manifests)     # near duplicates dropped by the extraction, not annotated
+    print('>>> Successfully list {} extracted frames, {} dropped as duplicates'.format(len(frames), len(dropped)))
+    frame_indices = [None] * len(anno_vidor_fns)
+    if sampling is not None:
+        # frames picked by the extraction, videos are named after their annotation file
+        video_ids = [os.path.splitext(os.path.basename(anno_fn))[0] for anno_fn in anno_vidor_fns]
+        missing = [video_id for video_id in video_ids if manifests.get(video_id, {}).get('sampling') != sampling]
+        assert len(missing) == 0, 'videos not extracted with {}: {}'.format(sampling, missing[:10])
+        frame_indices = [manifests[video_id]['frames'] for video_id in video_ids]
+    # images and annotations (coco-style) are streamed to the annotation file
+    res_anno_fn = os.path.join(input, 'd2_{}_{}.json'.format(split, sampling_tag(frequency, sampling)))
     
 #   RUNING
-    for fn in tqdm(anno_vidor_fns):
-        with open(fn, 'r') as f:
-            raw_data = json.load(f)
-
-        width = raw_data['width']
-        height = raw_data['height']
-        video_id = raw_data['video_id']
-        trajectories = raw_data['trajectories']
-        category_dict = raw_data['subject/objects']
-        
-        tid2index = dict()      # map tid to object class id
-        for item in category_dict:
-            tid = str(item['tid'])
-            tid2index[tid] = cat2id[item['category']]
-        
-        for frame_index, trajectory in enumerate(trajectories):
-            if frame_index % frequency != 0: continue
-            image_id = int("{}{:04d}".format(video_id, frame_index))
-            image_basename = '{}_{:04d}.jpg'.format(video_id, frame_index)
-            assert os.path.exists(os.path.join(output, image_basename)) # check frame image
-            if len(trajectory) == 0: continue       # pass empty anno
-            image = {
-                "file_name": image_basename,    # 4460320158_0000q.jpg
-                "height": height,
-                "width":width,
-                "id": image_id
-            }
-            images.append(image)
-            annotations_image = list()          # image = instance1 + instance2 + ...
-            for instance in trajectory:
-                tid = instance['tid']
-                category_id = tid2index[str(tid)]
-                x = instance['bbox']['xmin']
-                y = instance['bbox']['ymin']
-                h = instance['bbox']['ymax'] - instance['bbox']['ymin']
-                w = instance['bbox']['xmax'] - instance['bbox']['xmin']
-                annotation_instance = {
-                    "category_id": category_id,
-                    "area": w*h,
-                    "bbox": [x, y, w, h],
-                    "bbox_mode": 1,
-                    "image_id": image_id,
-                    "id": instance_index,
-                    "iscrowd": 0
-                }
-                instance_index += 1
-                annotations_image.append(annotation_instance)   
-            annotations.extend(annotations_image)   # add to all annotation dict
+    job = functools.partial(_convert_video, frequency=frequency, cat2id=cat2id)
+    items = list(zip(anno_vidor_fns, frame_indices))
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    results = pool.imap(job, items, chunksize=16) if pool is not None else map(job, items)
+    sampled = dict()        # video_id -> annotated frame indices, with sampling
+    # a failure keeps the previous annotation file and removes the .part files
+    with open_annotation_writer(res_anno_fn, coco_header('vidor', vidor_categories), anno_format) as writer:
+        for anno_fn, video_results in tqdm(zip(anno_vidor_fns, results), total=len(anno_vidor_fns)):
+            video_id = os.path.splitext(os.path.basename(anno_fn))[0]
+            for frame_index, image, annotations_image in video_results:
+                if image['file_name'] in dropped:   continue
+                assert image['file_name'] in frames, image['file_name']   # check frame image
+                sampled.setdefault(video_id, []).append(frame_index)
+                writer.add_image(image)
+                for annotation_instance in annotations_image:
+                    annotation_instance['id'] = instance_index
+                    instance_index += 1
+                writer.add_annotations(annotations_image)   # add to all annotation dict
+    if pool is not None:
+        pool.close()
+        pool.join()
     
 #   AFTER RUN
-    res_anno_fn = os.path.join(input, 'd2_{}_{}.json'.format(split, frequency))   # coco-style annotation filename
-    dump_coco_file(res_anno_fn, vidor_categories, annotations, images, 'vidor')
+    if sampling is not None:
+        with open(os.path.splitext(res_anno_fn)[0] + '.indices.json', 'w') as f:
+            json.dump({'sampling': sampling, 'frequency': frequency, 'frames': sampled}, f)
+        print('>>> Successfully annotate {} sampled frames of {} videos'.format(
+            sum(len(indices) for indices in sampled.values()), len(sampled)))
 
 if __name__ == "__main__":
     args = args_parser()
@@ -190,6 +1043,11 @@ if __name__ == "__main__":
     }
 
     if args.need_anno:
-        annotator[args.dataset](args.frequency, args.input, args.output, args.split)
+        annotator[args.dataset](args.frequency, args.input, args.output, args.split, workers=args.workers,
+                                anno_format=args.anno_format, sampling=args.sampling)
     else:
-        extractor[args.dataset](args.frequency, args.input, args.output)
\ No newline at end of file
+        extractor[args.dataset](args.frequency, args.input, args.output, workers=args.workers, strategy=args.decode,
+                                split=args.split if args.anno_driven else None, writers=args.writers,
+                                queue_depth=args.queue_depth, quality=args.jpeg_quality, packed=args.pack,
+                                dedup={'max_distance': args.dedup, 'iou': args.dedup_iou, 'method': args.hash_method}
+                                if args.dedup >= 0 else None, sampling=args.sampling)
\ No newline at end of file
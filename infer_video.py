@@ -0,0 +1,547 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2021-01-28
+# @Author  : Yifer Huang
+# @File    : infer_video.py
+# @Desc    : run the detector directly on videos (no extracted frames)
+
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+import torch
+from tqdm import tqdm
+
+import datasets.dataset
+
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.config import get_cfg
+from detectron2.data import DatasetCatalog, MetadataCatalog
+from detectron2.data import transforms as T
+from detectron2.modeling import build_model
+
+from config import add_vidor_config
+from datasets.vocab import vidor_categories
+from datasets.shards import video_of
+from engine.tracker import TrackletLinker, TrajectoryWriter
+from extract_frames import sample_frames
+from link_tracklets import link_video
+
+_END = object()     # end of a video, followed by the video_id and the number of frames
+
+
+def args_parser():
+    parser = argparse.ArgumentParser(description='run the detector directly on videos')
+    parser.add_argument('--config-file', dest='config_file', help='path to config file')
+    parser.add_argument('--input', help='a video, or a directory searched for videos (e.g. vidor/videos)')
+    parser.add_argument('--output', help='directory to store the detections, one {video_id}.json per video')
+    parser.add_argument('--f', dest='frequency', type=int, default=16, help='sample frequency')
+    parser.add_argument('--decode', default='auto', help='(auto, grab, seek), how to skip unsampled frames')
+    parser.add_argument('--batch-size', dest='batch_size', type=int, default=4, help='frames per forward pass')
+    parser.add_argument('--queue-depth', dest='queue_depth', type=int, default=16,
+                        help='frames buffered between the pipeline stages')
+    parser.add_argument('--keyframe-interval', dest='keyframe_interval', type=int, default=1,
+                        help='run the detector on every k-th sampled frame, propagate boxes in between')
+    parser.add_argument('--gate', type=float, default=None,
+                        help='also run the detector once the frame differs from the last keyframe by '
+                             'this mean absolute difference (0-255), see `VideoPredictor`')
+    parser.add_argument('--eval-json', dest='eval_json', default=None,
+                        help='coco annotation (e.g. datasets/vidor/d2_test_16.json), compare the '
+                             'per-frame detector with keyframe propagation on its videos')
+    parser.add_argument('--dataset', default=None,
+                        help='dataset whose category ids the detections use, DATASETS.TEST[0] by default')
+    parser.add_argument('--link', action='store_true',
+                        help='also link the detections into {output}/trajectories.json, see link_tracklets.py')
+    parser.add_argument('opts', default=None, nargs=argparse.REMAINDER,
+                        help='modify config options, e.g. MODEL.WEIGHTS model.pth MODEL.DEVICE cpu')
+    return parser.parse_args()
+
+
+def setup(args):
+    """config of the model, see train_net.setup"""
+    cfg = get_cfg()
+    add_vidor_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    if not torch.cuda.is_available():
+        cfg.MODEL.DEVICE = 'cpu'
+    cfg.freeze()
+    return cfg
+
+
+def list_video_files(input):
+    """(video_id, filename) of a video file or of every video under a directory
+
+    Args:
+        input (string): ~/datasets/vidor/videos/0000/2401075277.mp4 or ~/datasets/vidor/videos
+
+    Returns:
+        list: e.g. [(2401075277, ~/datasets/vidor/videos/0000/2401075277.mp4)]
+    """
+    if os.path.isfile(input):
+        return [(os.path.splitext(os.path.basename(input))[0], input)]
+    videos = list()
+    for dirpath, dirnames, filenames in os.walk(input):
+        dirnames.sort()
+        for basename in sorted(filenames):
+            if os.path.splitext(basename)[1].lower() in ('.mp4', '.avi', '.mkv', '.mov'):
+                videos.append((os.path.splitext(basename)[0], os.path.join(dirpath, basename)))
+    return videos
+
+
+class Stopped(Exception):
+    """raised inside a stage once its pipeline is stopped"""
+
+
+class Stage(threading.Thread):
+    """pipeline stage thread, runs `target(put)` and passes exceptions on to the consumer
+
+    Queue operations wait in short timeouts and give up once `stop` is set, so stages
+    never block forever on a consumer which stopped reading (e.g. raised).
+
+    Args:
+        target (callable): produces items through put(item)
+        queue_depth (int): bound of the output queue, the producer blocks once it is full
+        stop (threading.Event): set by the consumer to stop every stage of the pipeline
+    """
+    def __init__(self, target, queue_depth, stop):
+        super().__init__(daemon=True)
+        self.target = target
+        self.queue = queue.Queue(maxsize=queue_depth)
+        self.stop = stop
+
+    def put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        raise Stopped()
+
+    def run(self):
+        try:
+            self.target(self.put)
+            self.put(None)
+        except Stopped:
+            pass
+        except BaseException as e:     # re-raised by the consumer
+            try:
+                self.put(e)
+            except Stopped:
+                pass
+
+    def __iter__(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                if self.stop.is_set():
+                    raise Stopped()
+                continue
+            if item is None:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+
+def propagate_boxes(prev_gray, gray, boxes, grid=5):
+    """move boxes from one frame to the next with sparse Lucas-Kanade optical flow
+
+    A grid of points inside each box is tracked, the box is shifted by their median
+    displacement and scaled by the median change of their distances to the centre.
+
+    Args:
+        prev_gray (ndarray): grayscale frame the boxes belong to
+        gray (ndarray): grayscale next frame, same size
+        boxes (ndarray): [N, 4] xyxy boxes in the coordinates of the gray frames
+        grid (int): tracked points per box side
+
+    Returns:
+        ndarray: [N, 4] xyxy boxes, unchanged where no point could be tracked
+    """
+    if len(boxes) == 0:
+        return boxes
+    steps = (np.arange(grid, dtype=np.float32) + 0.5) / grid
+    ys, xs = np.meshgrid(steps, steps, indexing='ij')
+    x0, y0, x1, y1 = [boxes[:, i:i + 1] for i in range(4)]
+    points = np.stack([x0 + xs.reshape(1, -1) * (x1 - x0), y0 + ys.reshape(1, -1) * (y1 - y0)], axis=-1)
+    moved, status, _ = cv2.calcOpticalFlowPyrLK(
+        prev_gray, gray, points.reshape(-1, 1, 2).astype(np.float32), None, winSize=(15, 15), maxLevel=2)
+    moved = moved.reshape(len(boxes), -1, 2)
+    status = status.reshape(len(boxes), -1).astype(bool)
+    propagated = boxes.copy()
+    for i in np.nonzero(status.any(axis=1))[0]:
+        before, after = points[i][status[i]], moved[i][status[i]]
+        shift = np.median(after - before, axis=0)
+        scale = 1.0
+        if len(before) > 1:
+            spread_before = np.linalg.norm(before - before.mean(axis=0), axis=1)
+            spread_after = np.linalg.norm(after - after.mean(axis=0), axis=1)
+            valid = spread_before > 1e-3
+            if valid.any():
+                scale = float(np.clip(np.median(spread_after[valid] / spread_before[valid]), 0.5, 2.0))
+        center = (boxes[i, :2] + boxes[i, 2:]) / 2 + shift
+        half = (boxes[i, 2:] - boxes[i, :2]) / 2 * scale
+        propagated[i] = np.concatenate([center - half, center + half])
+    height, width = gray.shape
+    propagated[:, 0::2] = propagated[:, 0::2].clip(0, width)
+    propagated[:, 1::2] = propagated[:, 1::2].clip(0, height)
+    return propagated
+
+
+def dataset_category_ids(dataset):
+    """dataset category id of each contiguous class id, the inverse of the dataset's
+    thing_dataset_id_to_contiguous_id, which is set once its annotations are loaded
+
+    Returns:
+        ndarray: [num_classes] int64
+    """
+    metadata = MetadataCatalog.get(dataset)
+    if not hasattr(metadata, 'thing_dataset_id_to_contiguous_id'):
+        DatasetCatalog.get(dataset)
+    id_map = metadata.thing_dataset_id_to_contiguous_id
+    category_ids = np.zeros(len(id_map), dtype=np.int64)
+    for dataset_id, contiguous_id in id_map.items():
+        category_ids[contiguous_id] = dataset_id
+    return category_ids
+
+
+class VideoPredictor(object):
+    """detect objects on the sampled frames of videos, decoding, preprocessing and the
+    model run in a pipeline instead of one after another
+
+    decode thread (sample_frames) -> preprocess thread (resize, to tensor) -> model (caller's thread)
+
+    Decoding and resizing release the GIL inside opencv, so both overlap the forward
+    pass, on CPU as well as on GPU. Frames never touch disk.
+
+    With keyframe_interval > 1 the detector only runs on keyframes, every k-th sampled
+    frame and, with `gate`, every frame whose mean absolute difference to the last
+    keyframe (on a 64x64 thumbnail) exceeds it. Boxes of the other frames are propagated
+    from the previous frame with optical flow (`propagate_boxes`), which costs a few
+    milliseconds instead of a backbone pass.
+
+    Args:
+        cfg (CfgNode): config of a trained GeneralizedRCNN, MODEL.WEIGHTS is loaded
+        frequency (int): sampling frequency, frames 0, f, 2f, ... are detected
+        strategy (str): how to skip unsampled frames, see `extract_frames.sample_frames`
+        batch_size (int): keyframes per forward pass
+        queue_depth (int): frames buffered between the stages
+        keyframe_interval (int): 1 runs the detector on every sampled frame
+        gate (float): frame difference (0-255) which forces a keyframe, None to disable
+        flow_size (int): long side of the frames optical flow runs on
+        dataset (str): registered dataset whose category ids the predicted classes are
+            mapped to, like COCOEvaluator does, DATASETS.TEST[0] if None
+    """
+    def __init__(self, cfg, frequency=16, strategy='auto', batch_size=4, queue_depth=16,
+                 keyframe_interval=1, gate=None, flow_size=320, dataset=None):
+        self.cfg = cfg
+        self.frequency = frequency
+        self.strategy = strategy
+        self.batch_size = batch_size
+        self.queue_depth = queue_depth
+        self.keyframe_interval = keyframe_interval
+        self.gate = gate
+        self.flow_size = flow_size
+        self.model = build_model(cfg)
+        self.model.eval()
+        DetectionCheckpointer(self.model).load(cfg.MODEL.WEIGHTS)
+        self.resize = T.ResizeShortestEdge([cfg.INPUT.MIN_SIZE_TEST] * 2, cfg.INPUT.MAX_SIZE_TEST)
+        self.category_ids = dataset_category_ids(dataset if dataset is not None else cfg.DATASETS.TEST[0])
+        self.reset_timing()
+
+    def reset_timing(self):
+        self.timing = {'decode': 0., 'preprocess': 0., 'model': 0., 'propagate': 0.}
+        self.num_keyframes = 0
+
+    def _decode(self, videos, put):
+        for video_id, filename in videos:
+            capture = cv2.VideoCapture(filename)
+            try:
+                samples = sample_frames(capture, range(0, 1 << 31, self.frequency), self.strategy)
+                num_frames = 0
+                while True:
+                    start = time.perf_counter()
+                    sample = next(samples, None)
+                    self.timing['decode'] += time.perf_counter() - start
+                    if sample is None:  break
+                    put((video_id,) + sample)
+                    num_frames += 1
+            finally:
+                capture.release()
+            put((_END, video_id, num_frames))
+
+    def _preprocess(self, frames, put):
+        propagating = self.keyframe_interval > 1 or self.gate is not None
+        since_keyframe = 0
+        keyframe_thumbnail = None
+        for item in frames:
+            if item[0] is _END:
+                since_keyframe = 0
+                keyframe_thumbnail = None
+                put(item)
+                continue
+            video_id, frame_index, frame = item
+            start = time.perf_counter()
+            height, width = frame.shape[:2]
+            is_keyframe, gray = True, None
+            if propagating:
+                gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+                scale = min(1.0, self.flow_size / max(height, width))
+                if scale < 1.0:
+                    gray = cv2.resize(gray, (int(width * scale + 0.5), int(height * scale + 0.5)),
+                                      interpolation=cv2.INTER_AREA)
+                gray = (gray, scale)
+                thumbnail = cv2.resize(gray[0], (64, 64), interpolation=cv2.INTER_AREA).astype(np.int16)
+                is_keyframe = keyframe_thumbnail is None or since_keyframe >= self.keyframe_interval or \
+                    (self.gate is not None and np.abs(thumbnail - keyframe_thumbnail).mean() > self.gate)
+                if is_keyframe:
+                    since_keyframe = 0
+                    keyframe_thumbnail = thumbnail
+                since_keyframe += 1
+            inputs = None   # non-keyframes never reach the model
+            if is_keyframe:
+                if self.cfg.INPUT.FORMAT == 'RGB':
+                    frame = frame[:, :, ::-1]
+                image = self.resize.get_transform(frame).apply_image(frame)
+                image = torch.as_tensor(image.astype('float32').transpose(2, 0, 1))
+                inputs = {'image': image, 'height': height, 'width': width}
+            self.timing['preprocess'] += time.perf_counter() - start
+            put((video_id, frame_index, inputs, gray))
+
+    def _forward(self, batch):
+        start = time.perf_counter()
+        with torch.no_grad():
+            outputs = self.model([inputs for inputs in batch])
+        detections = list()
+        for output in outputs:
+            instances = output['instances'].to('cpu')
+            detections.append({
+                'boxes': instances.pred_boxes.tensor.numpy(),   # xyxy, in the original resolution
+                'scores': instances.scores.tolist(),
+                'category_ids': self.category_ids[instances.pred_classes.numpy()].tolist(),
+            })
+        self.timing['model'] += time.perf_counter() - start
+        self.num_keyframes += len(batch)
+        return detections
+
+    def _flush(self, pending, previous):
+        """detect the keyframes of `pending` in one batch, then propagate boxes to the
+        frames in between in order
+
+        Args:
+            pending (list): preprocessed frames of one video, in order
+            previous (tuple): (gray, detections) of the frame before pending[0], or None
+
+        Returns:
+            tuple: (per-frame detections, (gray, detections) of the last frame)
+        """
+        keyframes = [inputs for _, _, inputs, _ in pending if inputs is not None]
+        detections = iter(self._forward(keyframes)) if len(keyframes) > 0 else iter(())
+        frames = list()
+        for _, frame_index, inputs, gray in pending:
+            if inputs is not None:
+                current = next(detections)
+            else:
+                start = time.perf_counter()
+                (prev_gray, scale), prev = previous
+                current = dict(prev, boxes=propagate_boxes(prev_gray, gray[0], prev['boxes'] * scale) / scale)
+                self.timing['propagate'] += time.perf_counter() - start
+            previous = (gray, current)
+            frames.append(dict(current, frame_index=frame_index, boxes=current['boxes'].tolist(),
+                               keyframe=inputs is not None))
+        return frames, previous
+
+    def __call__(self, videos):
+        """detections of each video, in the order of `videos`
+
+        Args:
+            videos (list): (video_id, filename) tuples
+
+        Yields:
+            tuple: (video_id, list of per-frame detections)
+        """
+        stop = threading.Event()
+        decoder = Stage(lambda put: self._decode(videos, put), self.queue_depth, stop)
+        preprocessor = Stage(lambda put: self._preprocess(decoder, put), self.queue_depth, stop)
+        decoder.start()
+        preprocessor.start()
+        pending = list()    # frames of the current video waiting for a batch of keyframes
+        num_keyframes = 0
+        previous = None
+        frames = list()     # detections of the current video
+        try:
+            for item in preprocessor:
+                if item[0] is _END:
+                    # batches stay within a video, so its detections are complete here
+                    if len(pending) > 0:
+                        frames.extend(self._flush(pending, previous)[0])
+                    yield item[1], frames
+                    pending, num_keyframes, previous, frames = list(), 0, None, list()
+                    continue
+                if item[2] is not None and num_keyframes == self.batch_size:
+                    video_frames, previous = self._flush(pending, previous)
+                    frames.extend(video_frames)
+                    pending, num_keyframes = list(), 0
+                pending.append(item)
+                num_keyframes += item[2] is not None
+        finally:
+            # the model or the caller raised, or the generator was dropped: stop the stages
+            stop.set()
+            decoder.join()
+            preprocessor.join()
+
+
+def dump_detections(output, video_id, frequency, frames):
+    """write {output}/{video_id}.json under a temporary name and rename it"""
+    filename = os.path.join(output, '{}.json'.format(video_id))
+    temp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(temp_filename, 'w') as f:
+        json.dump({
+            'video_id': video_id,
+            'frequency': frequency,
+            'categories': vidor_categories,
+            'frames': frames,
+        }, f)
+    os.replace(temp_filename, filename)
+
+
+def run_videos(predictor, videos, output, frequency, on_video=None):
+    """detect all videos with the predictor and dump their detections, on_video(video_id,
+    frames) is called on the detections of each video as soon as it is done, which are
+    then dropped
+
+    Returns:
+        tuple: (number of frames, seconds)
+    """
+    os.makedirs(output, exist_ok=True)
+    total_frames = 0
+    start = time.perf_counter()
+    with tqdm(total=len(videos), unit='video') as pbar:
+        for video_id, frames in predictor(videos):
+            dump_detections(output, video_id, frequency, frames)
+            if on_video is not None:
+                on_video(video_id, frames)
+            total_frames += len(frames)
+            pbar.set_postfix(video=video_id, frames=len(frames), total=total_frames)
+            pbar.update()
+    return total_frames, time.perf_counter() - start
+
+
+def print_timing(predictor, total_frames):
+    # stages overlap, so the sum of their seconds exceeds the wall time
+    print('>>> ' + ', '.join('{}: {:.1f} frames/s'.format(name, total_frames / max(seconds, 1e-9))
+                             for name, seconds in predictor.timing.items()))
+
+
+def coco_results(video_id, frames, image_ids):
+    """coco-style results of the detections of one video
+
+    Args:
+        frames (list): per-frame detections, see `VideoPredictor`
+        image_ids (set): image ids of the evaluated annotation, other frames are dropped
+    """
+    results = list()
+    for frame in frames:
+        image_id = int('{}{:04d}'.format(video_id, frame['frame_index']))     # see convert_vidor_annotation
+        if image_id not in image_ids:   continue
+        for (x0, y0, x1, y1), score, category_id in zip(frame['boxes'], frame['scores'], frame['category_ids']):
+            results.append({'image_id': image_id, 'category_id': category_id,
+                            'bbox': [x0, y0, x1 - x0, y1 - y0], 'score': score})
+    return results
+
+
+def evaluate(eval_json, results):
+    """bbox AP of video detections against a coco annotation of the same sampled frames
+
+    Args:
+        eval_json (str): e.g. datasets/vidor/d2_test_16.json
+        results (list): coco-style results, see `coco_results`
+
+    Returns:
+        tuple: (AP, AP50), in percent
+    """
+    from pycocotools.coco import COCO
+    from pycocotools.cocoeval import COCOeval
+
+    if len(results) == 0:
+        return 0., 0.
+    coco_gt = COCO(eval_json)
+    coco_eval = COCOeval(coco_gt, coco_gt.loadRes(results), 'bbox')
+    coco_eval.evaluate()
+    coco_eval.accumulate()
+    coco_eval.summarize()
+    return coco_eval.stats[0] * 100, coco_eval.stats[1] * 100
+
+
+def compare(predictor, args):
+    """accuracy/latency of the per-frame detector against keyframe propagation on the
+    videos of a coco split, e.g. vidor_test_16 (--f must match the split's frequency)
+    """
+    with open(args.eval_json, 'r') as f:
+        images = json.load(f)['images']
+    image_ids = set(image['id'] for image in images)
+    video_ids = set(video_of(os.path.splitext(os.path.basename(image['file_name']))[0]) for image in images)
+    videos = [video for video in list_video_files(args.input) if video[0] in video_ids]
+    print('>>> {} of {} videos in {} found under {}'.format(len(videos), len(video_ids), args.eval_json, args.input))
+
+    modes = [('per-frame', 1, None), ('keyframe', args.keyframe_interval, args.gate)]
+    rows = list()
+    for mode, keyframe_interval, gate in modes:
+        predictor.keyframe_interval, predictor.gate = keyframe_interval, gate
+        predictor.reset_timing()
+        # only the detections of annotated frames are kept, as coco results
+        results = list()
+        total_frames, elapsed = run_videos(
+            predictor, videos, os.path.join(args.output, mode), args.frequency,
+            lambda video_id, frames: results.extend(coco_results(video_id, frames, image_ids)))
+        print_timing(predictor, total_frames)
+        ap, ap50 = evaluate(args.eval_json, results)
+        rows.append((mode, keyframe_interval, gate, predictor.num_keyframes / max(total_frames, 1),
+                     ap, ap50, total_frames / max(elapsed, 1e-9)))
+    print('>>> {:10} {:>8} {:>6} {:>10} {:>6} {:>6} {:>9}'.format(
+        'mode', 'interval', 'gate', 'keyframes', 'AP', 'AP50', 'frames/s'))
+    for mode, keyframe_interval, gate, keyframes, ap, ap50, fps in rows:
+        print('>>> {:10} {:>8} {:>6} {:>9.1f}% {:>6.2f} {:>6.2f} {:>9.2f}'.format(
+            mode, keyframe_interval, str(gate), keyframes * 100, ap, ap50, fps))
+
+
+def main(args):
+    cfg = setup(args)
+    predictor = VideoPredictor(cfg, args.frequency, args.decode, args.batch_size, args.queue_depth,
+                               args.keyframe_interval, args.gate, dataset=args.dataset)
+    if args.eval_json is not None:
+        return compare(predictor, args)
+
+    videos = list_video_files(args.input)
+    if not args.link:
+        total_frames, elapsed = run_videos(predictor, videos, args.output, args.frequency)
+    else:
+        linker = TrackletLinker()
+        os.makedirs(args.output, exist_ok=True)
+        with TrajectoryWriter(os.path.join(args.output, 'trajectories.json'), vidor_categories) as writer:
+            total_frames, elapsed = run_videos(
+                predictor, videos, args.output, args.frequency,
+                lambda video_id, frames: writer.add_video(video_id, link_video(linker, (
+                    (frame['frame_index'], frame['boxes'], frame['scores'], frame['category_ids'])
+                    for frame in frames
+                )))
+            )
+    print('>>> Successfully detect {} frames (1/{}) of {} videos on {}, {} keyframes, {:.1f} frames/s'.format(
+        total_frames, args.frequency, len(videos), cfg.MODEL.DEVICE, predictor.num_keyframes,
+        total_frames / max(elapsed, 1e-9)))
+    print_timing(predictor, total_frames)
+
+
+if __name__ == "__main__":
+    args = args_parser()
+    for key, value in vars(args).items():
+        print('>>> {:10}: {}'.format(key, value))
+    main(args)
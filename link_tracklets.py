@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# @Time    : 2021-01-29
+# @Author  : Yifer Huang
+# @File    : link_tracklets.py
+# @Desc    : link per-frame detections into vidor trajectories
+
+import argparse
+import itertools
+import json
+import os
+
+from tqdm import tqdm
+
+from datasets.vocab import vidor_categories
+from engine.tracker import TrackletLinker, TrajectoryWriter
+
+
+def args_parser():
+    parser = argparse.ArgumentParser(description='link per-frame detections into vidor trajectories')
+    parser.add_argument('--input', help='directory of infer_video.py detections, or coco_instances_results.json '
+                                        'of COCOEvaluator on a vidor split')
+    parser.add_argument('--output', help='trajectories json (vidor video object detection results)')
+    parser.add_argument('--score-threshold', dest='score_threshold', type=float, default=0.3)
+    parser.add_argument('--iou-threshold', dest='iou_threshold', type=float, default=0.3)
+    parser.add_argument('--max-gap', dest='max_gap', type=int, default=2,
+                        help='sampled frames a tracklet may miss before it ends')
+    parser.add_argument('--min-length', dest='min_length', type=int, default=2, help='frames of the shortest tracklet')
+    return parser.parse_args()
+
+
+def video_detections(input):
+    """per-frame detections of each video, frames in order
+
+    Args:
+        input (str): directory of {video_id}.json written by infer_video.py, or the
+            coco-style results of COCOEvaluator, whose image ids are {video_id}{frame_index:04d}
+
+    Yields:
+        tuple: (video_id, iterable of (frame_index, boxes xyxy, scores, category_ids))
+    """
+    if os.path.isdir(input):
+        for basename in sorted(os.listdir(input)):
+            if not basename.endswith('.json'):  continue
+            with open(os.path.join(input, basename), 'r') as f:
+                detections = json.load(f)
+            yield detections['video_id'], ((frame['frame_index'], frame['boxes'], frame['scores'], frame['category_ids'])
+                                           for frame in detections['frames'])
+        return
+    with open(input, 'r') as f:
+        results = json.load(f)
+    results.sort(key=lambda result: result['image_id'])
+    for video_id, video_results in itertools.groupby(results, key=lambda result: result['image_id'] // 10000):
+        frames = list()
+        for image_id, frame_results in itertools.groupby(video_results, key=lambda result: result['image_id']):
+            frame_results = list(frame_results)
+            frames.append((
+                image_id % 10000,
+                [[x, y, x + w, y + h] for x, y, w, h in (result['bbox'] for result in frame_results)],
+                [result['score'] for result in frame_results],
+                [result['category_id'] for result in frame_results],
+            ))
+        yield str(video_id), frames
+
+
+def link_video(linker, frames):
+    """tracklets of one video, see `TrackletLinker`"""
+    tracklets = list()
+    for frame_index, boxes, scores, category_ids in frames:
+        tracklets.extend(linker.update(frame_index, boxes, scores, category_ids))
+    tracklets.extend(linker.finish())
+    return tracklets
+
+
+def main(args):
+    linker = TrackletLinker(args.score_threshold, args.iou_threshold, args.max_gap, args.min_length)
+    with TrajectoryWriter(args.output, vidor_categories) as writer:
+        for video_id, frames in tqdm(video_detections(args.input), unit='video'):
+            writer.add_video(video_id, link_video(linker, frames))
+
+
+if __name__ == "__main__":
+    args = args_parser()
+    for key, value in vars(args).items():
+        print('>>> {:10}: {}'.format(key, value))
+    main(args)
@@ -6,25 +6,238 @@
 # @Desc    : object detector (based on detectron2)
 # https://github.com/facebookresearch/detectron2/blob/master/tools/train_net.py
 
+import hashlib
+import json
+import logging
 import os
+from collections import OrderedDict
+
+import torch
 
 import datasets.dataset
 
 from detectron2.engine import DefaultTrainer, default_argument_parser, default_setup, launch
 from detectron2.checkpoint import DetectionCheckpointer
 from detectron2.config import get_cfg
-from detectron2.evaluation import COCOEvaluator
+from detectron2.data import DatasetFromList, DatasetMapper, MetadataCatalog, build_detection_train_loader, \
+    get_detection_dataset_dicts
+from detectron2.data.detection_utils import check_metadata_consistency
+from detectron2.evaluation import print_csv_format
+from detectron2.utils import comm
+
+from config import add_vidor_config
+from datasets.cache import FrameCache
+from datasets.mapper import CachedDatasetMapper
+from datasets.sampler import WeightedSourceSampler
+from datasets.serialize import PackedRecords, build_packed
+from engine.evaluation import FastCOCOEvaluator, ShardCOCOEvaluator
+from engine.hooks import FrameCacheHook, ProfilingHook
+from engine.inference import batched_inference_on_dataset, build_batched_test_loader, inference_on_shard, \
+    merge_shards
+from engine.profiling import LoaderCounters, ProfilingLoader, ProfilingMapper
 
 
 class Trainer(DefaultTrainer):
+    frame_cache = None  # FrameCache of the train loader, if INPUT.CACHE.ENABLED
+    profiling_loader = None     # ProfilingLoader wrapping the train loader, if PROFILING.ENABLED
+
+    @staticmethod
+    def load_train_dataset_dicts(cfg):
+        """get_detection_dataset_dicts of DATASETS.TRAIN, each dict tagged with `source`, the
+        index of its dataset in DATASETS.TRAIN (see datasets/sampler.py)
+        """
+        min_keypoints = cfg.MODEL.ROI_KEYPOINT_HEAD.MIN_KEYPOINTS_PER_IMAGE if cfg.MODEL.KEYPOINT_ON else 0
+        proposal_files = cfg.DATASETS.PROPOSAL_FILES_TRAIN if cfg.MODEL.LOAD_PROPOSALS else None
+        dataset_dicts = list()
+        for source, name in enumerate(cfg.DATASETS.TRAIN):
+            dataset_dicts_i = get_detection_dataset_dicts(
+                [name],
+                filter_empty=cfg.DATALOADER.FILTER_EMPTY_ANNOTATIONS,
+                min_keypoints=min_keypoints,
+                proposal_files=proposal_files[source:source + 1] if proposal_files else None,
+            )
+            for dataset_dict in dataset_dicts_i:
+                dataset_dict['source'] = source
+            dataset_dicts.extend(dataset_dicts_i)
+        # loaded one by one, so the check get_detection_dataset_dicts runs over all of them is repeated here
+        check_metadata_consistency('thing_classes', cfg.DATASETS.TRAIN)
+        return dataset_dicts
+
+    @classmethod
+    def build_train_dataset(cls, cfg):
+        """dataset dicts of DATASETS.TRAIN (see `load_train_dataset_dicts`) packed into one
+        memory-mapped file under DATALOADER.PACKED_DICTS_DIR
+
+        A list of dicts is copied into every data loader worker and refcount updates turn
+        the copy-on-write pages into private memory over a long run. The packed records
+        hold no Python objects, records are unpickled on access, and the GPU processes of
+        a node build the file once and share its pages, so worker RSS stays flat.
+
+        Returns:
+            DatasetFromList or None: None if DATALOADER.PACKED_DICTS_DIR is empty and
+                detectron2 may load the dicts itself (no WeightedSourceSampler)
+        """
+        if not cfg.DATALOADER.PACKED_DICTS_DIR:
+            if cfg.DATALOADER.SAMPLER_TRAIN != 'WeightedSourceSampler':
+                return None
+            return DatasetFromList(cls.load_train_dataset_dicts(cfg), copy=False)
+        # the merged dicts depend on the datasets, their annotation files (or columnar
+        # stores) and the filtering ('source': the dicts are tagged with their dataset
+        # since WeightedSourceSampler)
+        sources = []
+        annotation_bytes = 0    # to estimate the size of the packed dicts
+        for name in cfg.DATASETS.TRAIN:
+            meta = MetadataCatalog.get(name)
+            filename = meta.get('json_file')
+            if filename is None and meta.get('columnar_dir') is not None:
+                filename = os.path.join(meta.columnar_dir, 'meta.json')   # rewritten with the store
+                annotation_bytes += sum(entry.stat().st_size for entry in os.scandir(meta.columnar_dir)) \
+                    if os.path.isdir(meta.columnar_dir) else 0
+            source = [name]
+            if filename is not None and os.path.exists(filename):
+                stat = os.stat(filename)
+                source += [os.path.abspath(filename), stat.st_mtime, stat.st_size]
+                annotation_bytes += stat.st_size if meta.get('json_file') is not None else 0
+            sources.append(source)
+        min_keypoints = cfg.MODEL.ROI_KEYPOINT_HEAD.MIN_KEYPOINTS_PER_IMAGE if cfg.MODEL.KEYPOINT_ON else 0
+        proposal_files = cfg.DATASETS.PROPOSAL_FILES_TRAIN if cfg.MODEL.LOAD_PROPOSALS else None
+        key = json.dumps([list(cfg.DATASETS.TRAIN), sources, cfg.DATALOADER.FILTER_EMPTY_ANNOTATIONS,
+                          min_keypoints, proposal_files and list(proposal_files), 'source'])
+        # /dev/shm first, a disk directory if it is too small; never the per-process list
+        dirnames = [cfg.DATALOADER.PACKED_DICTS_DIR,
+                    cfg.DATALOADER.PACKED_DICTS_FALLBACK_DIR or os.path.join(cfg.OUTPUT_DIR, 'dataset_dicts')]
+        # pickled dicts take about as much as their json, twice that leaves some headroom
+        records, path = build_packed(lambda: cls.load_train_dataset_dicts(cfg), dirnames,
+                                     hashlib.sha1(key.encode()).hexdigest()[:16], min_free=2 * annotation_bytes)
+        logger = logging.getLogger(__name__)
+        if os.path.normpath(os.path.dirname(path)) != os.path.normpath(dirnames[0]):
+            logger.warning('Not enough space in {}, packed dataset dicts are in {}'.format(
+                cfg.DATALOADER.PACKED_DICTS_DIR, path))
+        if comm.get_local_rank() == 0:
+            removed = PackedRecords.remove_stale(os.path.dirname(path), path)
+            if removed > 0:
+                logger.info('Removed {} stale packed dataset dicts from {}'.format(removed, os.path.dirname(path)))
+        # the records are already serialized, DatasetFromList must not pickle them again
+        return DatasetFromList(records, copy=False, serialize=False)
+
+    @classmethod
+    def build_train_sampler(cls, cfg, dataset):
+        """WeightedSourceSampler of the train dataset if DATALOADER.SAMPLER_TRAIN selects
+        it, None for the detectron2 samplers
+        """
+        if cfg.DATALOADER.SAMPLER_TRAIN != 'WeightedSourceSampler':
+            return None
+        return WeightedSourceSampler(
+            dataset,
+            cfg.SOLVER.IMS_PER_BATCH // comm.get_world_size(),
+            weights=cfg.DATALOADER.SOURCE_WEIGHTS,
+            frame_stride=cfg.DATALOADER.FRAME_STRIDE,
+            dedup_iou=cfg.DATALOADER.DEDUP_IOU,
+            aspect_ratio_bins=cfg.DATALOADER.ASPECT_RATIO_BINS,
+        )
+
     @classmethod
-    def build_evaluator(cls, cfg, dataset_name, output_folder=None):
+    def build_train_loader(cls, cfg):
+        mapper = None   # DatasetMapper
+        if cfg.INPUT.CACHE.ENABLED:
+            # created before the loader forks its workers, they share its counters
+            cls.frame_cache = FrameCache(cfg.INPUT.CACHE.DIR, int(cfg.INPUT.CACHE.MAX_GB * 1024 ** 3))
+            mapper = CachedDatasetMapper(cfg, True, cache=cls.frame_cache)
+        dataset = cls.build_train_dataset(cfg)
+        sampler = cls.build_train_sampler(cfg, dataset) if dataset is not None else None
+        if not cfg.PROFILING.ENABLED:
+            return build_detection_train_loader(cfg, mapper=mapper, dataset=dataset, sampler=sampler)
+        # created before the loader forks its workers, they share its counters
+        counters = LoaderCounters()
+        mapper = ProfilingMapper(mapper if mapper is not None else DatasetMapper(cfg, True), counters)
+        data_loader = build_detection_train_loader(cfg, mapper=mapper, dataset=dataset, sampler=sampler)
+        cls.profiling_loader = ProfilingLoader(data_loader, counters)
+        return cls.profiling_loader
+
+    def build_hooks(self):
+        hooks = super().build_hooks()
+        if self.frame_cache is not None and comm.is_main_process():
+            hooks.insert(-1, FrameCacheHook(self.frame_cache, self.cfg.INPUT.CACHE.LOG_PERIOD))
+        if self.profiling_loader is not None:
+            cfg = self.cfg.PROFILING
+            # right after IterationTimer, so the iteration time excludes checkpointing and evaluation
+            hooks.insert(1, ProfilingHook(
+                self.profiling_loader, os.path.join(self.cfg.OUTPUT_DIR, 'profiling'), cfg.PERIOD,
+                sync_cuda=cfg.SYNC_CUDA, comm_hook=cfg.COMM_HOOK, trace_iters=cfg.TRACE_ITERS,
+                trace_mode=cfg.TRACE_MODE, trace_ranks=cfg.TRACE_RANKS,
+            ))
+        return hooks
+
+    @classmethod
+    def build_evaluator(cls, cfg, dataset_name, output_folder=None, distributed=True):
         if output_folder is None:
             output_folder = os.path.join(cfg.OUTPUT_DIR, "inference")
-        return COCOEvaluator(dataset_name=dataset_name, 
-                             tasks=('bbox',), 
-                             distributed=True, 
-                             output_dir=output_folder)
+        if cfg.TEST.EVALUATOR == 'fast_coco':
+            return FastCOCOEvaluator(dataset_name, distributed=distributed, output_dir=output_folder,
+                                     workers=cfg.TEST.EVAL_WORKERS)
+        # COCOEvaluator, which also evaluates the saved shards of test_sharded
+        return ShardCOCOEvaluator(dataset_name=dataset_name,
+                                  tasks=('bbox',),
+                                  distributed=distributed,
+                                  output_dir=output_folder)
+
+
+    @classmethod
+    def test_sharded(cls, cfg, model):
+        """evaluate in TEST.SHARDS.NUM_SHARDS resumable shards, see engine/inference.py"""
+        logger = logging.getLogger(__name__)
+        num_shards = cfg.TEST.SHARDS.NUM_SHARDS
+        shard_ids = list(cfg.TEST.SHARDS.IDS) or list(range(num_shards))
+        results = OrderedDict()
+        for dataset_name in cfg.DATASETS.TEST:
+            if cfg.TEST.SHARDS.DIR:
+                shard_dir = os.path.join(cfg.TEST.SHARDS.DIR, dataset_name)
+            else:
+                shard_dir = os.path.join(cfg.OUTPUT_DIR, 'inference', dataset_name, 'shards')
+            os.makedirs(shard_dir, exist_ok=True)
+            dataset_dicts = get_detection_dataset_dicts([dataset_name], filter_empty=False)
+            for shard_id in shard_ids[comm.get_rank()::comm.get_world_size()]:
+                inference_on_shard(model, cfg, dataset_name, dataset_dicts, shard_id, num_shards, shard_dir)
+            comm.synchronize()
+            if not comm.is_main_process():
+                continue
+            evaluator = cls.build_evaluator(cfg, dataset_name, distributed=False)
+            results_i = merge_shards(evaluator, shard_dir, num_shards)
+            if results_i is None:
+                continue
+            results[dataset_name] = results_i
+            logger.info('Evaluation results for {} in csv format:'.format(dataset_name))
+            print_csv_format(results_i)
+        if len(results) == 1:
+            results = list(results.values())[0]
+        return results
+
+    @classmethod
+    def test(cls, cfg, model, evaluators=None):
+        if cfg.TEST.SHARDS.NUM_SHARDS > 1:
+            return cls.test_sharded(cfg, model)
+        if cfg.TEST.IMS_PER_BATCH <= 1:
+            return super().test(cfg, model, evaluators)
+        # TEST.IMS_PER_BATCH images per forward pass, see engine/inference.py
+        results = OrderedDict()
+        for idx, dataset_name in enumerate(cfg.DATASETS.TEST):
+            data_loader = build_batched_test_loader(cfg, dataset_name)
+            evaluator = evaluators[idx] if evaluators is not None else cls.build_evaluator(cfg, dataset_name)
+            results[dataset_name] = batched_inference_on_dataset(model, data_loader, evaluator)
+            if comm.is_main_process():
+                logging.getLogger(__name__).info('Evaluation results for {} in csv format:'.format(dataset_name))
+                print_csv_format(results[dataset_name])
+        if len(results) == 1:
+            results = list(results.values())[0]
+        return results
+
+
+def setup_threads(cfg):
+    """apply TEST.NUM_THREADS / TEST.NUM_INTEROP_THREADS, before the model runs anything"""
+    if cfg.TEST.NUM_THREADS > 0:
+        torch.set_num_threads(cfg.TEST.NUM_THREADS)
+    if cfg.TEST.NUM_INTEROP_THREADS > 0:
+        torch.set_num_interop_threads(cfg.TEST.NUM_INTEROP_THREADS)
 
 
 def setup(args):
@@ -34,6 +247,7 @@ def setup(args):
         args (*): args
     """
     cfg = get_cfg()
+    add_vidor_config(cfg)
     cfg.merge_from_file(args.config_file)
     cfg.merge_from_list(args.opts)
     cfg.freeze()
@@ -45,6 +259,7 @@ def main(args):
     cfg = setup(args)
 
     if args.eval_only:
+        setup_threads(cfg)
         model = Trainer.build_model(cfg)
         DetectionCheckpointer(model, save_dir=cfg.OUTPUT_DIR).resume_or_load(
             cfg.MODEL.WEIGHTS, resume=args.resume